@@ -0,0 +1,282 @@
+"""annotations.py
+
+Indexed MinKNOW annotations (IntermediateData reads and StateData states)
+for each channel of a bulk FAST5 file. Events are held as sorted numpy arrays
+so window queries and jumping to the next or previous event are binary
+searches instead of scans of a DataFrame. Indexes are saved in the bulkvis
+cache directory, so they are built once and reused by every server process.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+from pathlib import Path
+import threading
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from bulkvis.cache import cache_dir
+
+LOGGER = logging.getLogger(__name__)
+ANNOTATIONS_VERSION = 2
+
+
+def enum_labels(dataset, field):
+    """Return {value: name} for an enumerated field of a compound dataset"""
+    dataset_dtype = h5py.check_dtype(enum=dataset.dtype[field])
+    if not dataset_dtype:
+        return OrderedDict()
+    # this may lose some names if there are duplicate values
+    return OrderedDict((v, k) for k, v in dataset_dtype.items())
+
+
+def read_events(reads):
+    """Return a DataFrame of IntermediateData rows, once per read and classification
+    Parameters
+    ----------
+    reads : h5py.Dataset or numpy.ndarray
+        IntermediateData Reads of a channel, or some of its rows
+    Returns
+    -------
+    pandas.DataFrame
+        read_id (bytes), read_start and modal_classification columns
+    """
+    return pd.DataFrame(
+        {
+            "read_id": reads["read_id"],
+            "read_start": reads["read_start"],
+            "modal_classification": reads["modal_classification"],
+        }
+    ).drop_duplicates(subset=["read_id", "modal_classification"], keep="first")
+
+
+class ChannelAnnotations:
+    """Annotation events for one channel, sorted by time
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sample index of each event
+    codes : numpy.ndarray
+        Enumeration value of each event
+    read_ids : numpy.ndarray
+        Read id of each event, empty for state changes
+    labels : OrderedDict
+        Enumeration value to name
+    n_states : int
+        Number of StateData rows read, later rows are newer than the index
+    n_reads : int
+        Number of IntermediateData rows read, later rows are newer than the
+        index
+    """
+
+    def __init__(self, times, codes, read_ids, labels, n_states=0, n_reads=0):
+        order = np.argsort(times, kind="stable")
+        self.times = np.asarray(times, dtype=np.int64)[order]
+        self.codes = np.asarray(codes, dtype=np.int64)[order]
+        self.read_ids = np.asarray(read_ids, dtype=object)[order]
+        self.labels = labels
+        self.n_states = n_states
+        self.n_reads = n_reads
+        # per-code times, for jumping to the next/previous event of a type
+        self._code_times = {
+            code: self.times[self.codes == code] for code in np.unique(self.codes)
+        }
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_bulkfile(cls, bulkfile, channel_str):
+        """Read and index the annotations of a channel from an open bulk file"""
+        reads = bulkfile["IntermediateData"][channel_str]["Reads"]
+        labels = enum_labels(reads, "modal_classification")
+        read_df = read_events(reads)
+
+        states = bulkfile["StateData"][channel_str]["States"]
+        labels.update(enum_labels(states, "summary_state"))
+        state_times = states["acquisition_raw_index"]
+        state_codes = states["summary_state"]
+
+        read_ids = read_df["read_id"].str.decode("utf8").to_numpy(dtype=object)
+        return cls(
+            np.concatenate([read_df["read_start"].to_numpy(), state_times]),
+            np.concatenate([read_df["modal_classification"].to_numpy(), state_codes]),
+            np.concatenate([read_ids, np.full(len(state_times), "", dtype=object)]),
+            labels,
+            n_states=len(state_times),
+            n_reads=len(reads),
+        )
+
+    def save(self, path, stamp):
+        """Atomically write the index to an .npz file
+        Parameters
+        ----------
+        path : pathlib.Path
+            Where to write the index
+        stamp : tuple
+            (size, mtime) of the bulk file the index was built from
+        """
+        tmp_path = path.with_name("{n}.{pid}.tmp".format(n=path.name, pid=os.getpid()))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp_path.open("wb") as fh:
+            np.savez(
+                fh,
+                version=ANNOTATIONS_VERSION,
+                stamp=np.asarray(stamp, dtype=np.int64),
+                times=self.times,
+                codes=self.codes,
+                read_ids=self.read_ids.astype(str),
+                label_codes=np.asarray(list(self.labels), dtype=np.int64),
+                label_names=np.asarray(list(self.labels.values()), dtype=str),
+                n_states=self.n_states,
+                n_reads=self.n_reads,
+            )
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path, stamp):
+        """Read an index written by save, None if it is missing or stale"""
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                if int(saved["version"]) != ANNOTATIONS_VERSION:
+                    return None
+                if tuple(saved["stamp"].tolist()) != tuple(stamp):
+                    return None
+                labels = OrderedDict(
+                    zip(saved["label_codes"].tolist(), saved["label_names"].tolist())
+                )
+                return cls(
+                    saved["times"],
+                    saved["codes"],
+                    saved["read_ids"].astype(object),
+                    labels,
+                    n_states=int(saved["n_states"]),
+                    n_reads=int(saved["n_reads"]),
+                )
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def window(self, start, end, codes=None):
+        """Return indices of events with start <= time <= end
+        Parameters
+        ----------
+        start : int
+            First sample of the window
+        end : int
+            Last sample of the window
+        codes : list or None
+            Only return events with these enumeration values
+        Returns
+        -------
+        numpy.ndarray
+        """
+        lo = np.searchsorted(self.times, start, side="left")
+        hi = np.searchsorted(self.times, end, side="right")
+        idx = np.arange(lo, hi)
+        if codes is not None:
+            idx = idx[np.isin(self.codes[lo:hi], list(codes))]
+        return idx
+
+    def next_event(self, code, after):
+        """Return the time of the first event of a type after a sample, or None"""
+        times = self._code_times.get(code)
+        if times is None:
+            return None
+        i = np.searchsorted(times, after, side="right")
+        return int(times[i]) if i < len(times) else None
+
+    def previous_event(self, code, before):
+        """Return the time of the last event of a type before a sample, or None"""
+        times = self._code_times.get(code)
+        if times is None:
+            return None
+        i = np.searchsorted(times, before, side="left")
+        return int(times[i - 1]) if i > 0 else None
+
+    def label_text(self, idx):
+        """Return display labels, '<name> - <read_id>', for events"""
+        return [
+            (
+                "{n} - {r}".format(n=self.labels.get(c, c), r=r)
+                if r
+                else self.labels.get(c, c)
+            )
+            for c, r in zip(self.codes[idx], self.read_ids[idx])
+        ]
+
+
+def _stamp(path):
+    """Return (size, mtime) of a bulk file, used to detect stale indexes"""
+    stat = Path(path).stat()
+    return int(stat.st_size), int(stat.st_mtime)
+
+
+class AnnotationStore:
+    """Process wide cache of ChannelAnnotations, built lazily
+
+    Keeps the most recently used `max_channels` channels across all bulk
+    files and sessions. Indexes are also saved to disk, where other server
+    processes, and this one after a restart, read them instead of indexing
+    the channel again.
+    Parameters
+    ----------
+    max_channels : int
+        Number of channels held in memory
+    directory : str, pathlib.Path or None
+        Where indexes are saved, defaults to 'annotations' in the cache
+        directory
+    """
+
+    def __init__(self, max_channels=64, directory=None):
+        self.max_channels = max_channels
+        self.directory = directory
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index_path(self, filename, channel_str):
+        directory = self.directory
+        if directory is None:
+            directory = cache_dir() / "annotations"
+        digest = hashlib.sha1(filename.encode()).hexdigest()[:16]
+        return Path(directory) / "{d}-{c}.npz".format(d=digest, c=channel_str)
+
+    def _load_or_build(self, bulkfile, channel_str):
+        """Return a channel's index from disk, building and saving it if needed"""
+        filename = os.path.realpath(bulkfile.filename)
+        path = self._index_path(filename, channel_str)
+        stamp = _stamp(filename)
+        annotations = ChannelAnnotations.load(path, stamp)
+        if annotations is None:
+            annotations = ChannelAnnotations.from_bulkfile(bulkfile, channel_str)
+            try:
+                annotations.save(path, stamp)
+            except OSError as e:
+                LOGGER.warning(f"Could not save annotation index {path}: {e}")
+        return annotations
+
+    def get(self, bulkfile, channel_str):
+        """Return the ChannelAnnotations for a channel of an open bulk file"""
+        key = (os.path.realpath(bulkfile.filename), channel_str)
+        with self._lock:
+            annotations = self._channels.get(key)
+            if annotations is not None:
+                self._channels.move_to_end(key)
+                return annotations
+        annotations = self._load_or_build(bulkfile, channel_str)
+        with self._lock:
+            self._channels[key] = annotations
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        return annotations
+
+    def discard_file(self, filename):
+        """Remove every channel belonging to a file"""
+        filename = os.path.realpath(filename)
+        with self._lock:
+            for key in [k for k in self._channels if k[0] == filename]:
+                del self._channels[key]
+
+
+annotation_store = AnnotationStore()
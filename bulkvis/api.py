@@ -0,0 +1,282 @@
+"""api.py
+
+HTTP endpoints for reading bulk files from scripts and notebooks, served by
+`bulkvis serve` next to the viewer:
+
+    /api/v1/files
+    /api/v1/<file>/<channel>/<start>-<end>/signal[?mode=minmax&bins=N]
+    /api/v1/<file>/<channel>/<start>-<end>/annotations
+    /api/v1/<file>/<channel>/<start>-<end>/mappings
+
+start and end are sample positions. Windows are read like the viewer reads
+them, through the shared file handles, signal cache (short windows only),
+pyramid sidecars, annotation indexes and mapping indexes, in the viewer's
+worker pool.
+
+Except for the file list, responses are columns of little-endian arrays,
+one after the other. The X-Bulkvis-Columns header lists the name, numpy
+dtype string and length of each column and X-Bulkvis-Meta holds the window
+actually read, the sample rate and anything else needed to interpret them,
+both as JSON. A response is decoded with:
+
+    offset = 0
+    for name, dtype, length in json.loads(headers["X-Bulkvis-Columns"]):
+        column = np.frombuffer(body, dtype, length, offset)
+        offset += column.nbytes
+"""
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import json
+from pathlib import Path
+
+import numpy as np
+from tornado.ioloop import IOLoop
+from tornado.web import HTTPError, RequestHandler
+
+from bulkvis.annotations import annotation_store
+from bulkvis.bmf import load_mapping_index
+from bulkvis.cache import CHUNK_SIZE, signal_cache
+from bulkvis.downsample import minmax_downsample
+from bulkvis.handles import file_pool
+from bulkvis.jobs import executor
+from bulkvis.manifest import get_bulk_directory, read_metadata
+from bulkvis.metrics import job_seconds, points_sent, timed
+from bulkvis.pyramid import open_pyramid, read_envelope
+from bulkvis.raw import (
+    channel_calibration,
+    clamp_window,
+    read_signal,
+    refresh_length,
+)
+
+CONTENT_TYPE = "application/octet-stream"
+# Most raw samples read for one request, longer windows need mode=minmax and
+# a pyramid sidecar
+MAX_SAMPLES = 1 << 26
+# Longest window read through the viewer's signal cache, longer windows are
+# read directly so scripts don't evict the chunks sessions are browsing
+CACHED_SAMPLES = 4 * CHUNK_SIZE
+# Number of min/max bins returned by default
+DEFAULT_BINS = 1000
+WINDOW_PATTERN = r"/api/v1/([^/]+)/([0-9]+)/([0-9]+)-([0-9]+)/"
+
+
+def api_patterns(bulk_dir):
+    """Return the URL patterns of the API, for the Bokeh server's extra_patterns"""
+    kwargs = dict(bulk_dir=bulk_dir)
+    return [
+        (r"/api/v1/files", FilesHandler, kwargs),
+        (WINDOW_PATTERN + r"signal", SignalHandler, kwargs),
+        (WINDOW_PATTERN + r"annotations", AnnotationsHandler, kwargs),
+        (WINDOW_PATTERN + r"mappings", MappingsHandler, kwargs),
+    ]
+
+
+def encode_columns(columns):
+    """Return the X-Bulkvis-Columns header and body for some arrays
+    Parameters
+    ----------
+    columns : OrderedDict
+        Column name to 1D numpy array, numeric or fixed width bytes
+    Returns
+    -------
+    tuple
+        (header, body) where header is JSON and body is bytes
+    """
+    header, chunks = [], []
+    for name, values in columns.items():
+        values = np.ascontiguousarray(values)
+        values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+        header.append([name, values.dtype.str, len(values)])
+        chunks.append(values.tobytes())
+    return json.dumps(header), b"".join(chunks)
+
+
+def _bytes_column(values):
+    """Return strings as a fixed width, UTF-8 encoded bytes array"""
+    encoded = [str(v).encode() for v in values]
+    return np.array(encoded, dtype="S{n}".format(n=max(map(len, encoded), default=1)))
+
+
+class _ApiHandler(RequestHandler):
+    """Base of the API handlers, finds files in the served bulk directory"""
+
+    def initialize(self, bulk_dir):
+        self.bulk_dir = get_bulk_directory(bulk_dir)
+        self.bulk_dir.start_watching()
+
+    def bulk_path(self, name):
+        """Return the path of a bulk file, 404 unless the viewer lists it"""
+        if name not in self.bulk_dir.files():
+            raise HTTPError(404, reason="Unknown bulk file {n}".format(n=name))
+        return self.bulk_dir.directory / name
+
+    def metadata(self, bulk_path, bulkfile):
+        """Return (sf, attribute values) of a bulk file, from the manifest if known"""
+        metadata = self.bulk_dir.metadata(bulk_path.name)
+        return metadata if metadata is not None else read_metadata(bulkfile)
+
+    async def run_job(self, kind, work, *args):
+        """Run work(*args) in the viewer's worker pool"""
+        job = timed(job_seconds, kind="api_" + kind)(work)
+        return await IOLoop.current().run_in_executor(executor, job, *args)
+
+    def write_columns(self, kind, columns, meta):
+        header, body = encode_columns(columns)
+        points_sent.inc(len(next(iter(columns.values()), ())), source="api_" + kind)
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("X-Bulkvis-Columns", header)
+        self.set_header("X-Bulkvis-Meta", json.dumps(meta))
+        self.write(body)
+
+
+class FilesHandler(_ApiHandler):
+    """List the bulk files that can be read, as JSON"""
+
+    def get(self):
+        self.write({"files": self.bulk_dir.files()})
+
+
+class _WindowHandler(_ApiHandler, metaclass=ABCMeta):
+    """Read a sample window of one channel, in the worker pool"""
+
+    kind = None
+
+    async def get(self, name, channel, start, end):
+        bulk_path = self.bulk_path(name)
+        channel_str = "Channel_{ch}".format(ch=int(channel))
+        start, end = int(start), int(end)
+        if end <= start:
+            raise HTTPError(400, reason="Empty window, end must be after start")
+        columns, meta = await self.run_job(
+            self.kind, self.load, bulk_path, channel_str, start, end
+        )
+        self.write_columns(self.kind, columns, meta)
+
+    def load(self, bulk_path, channel_str, start, end):
+        """Return (columns, meta) for a window, called in a worker thread"""
+        with file_pool.borrow(bulk_path) as bulkfile:
+            if channel_str not in bulkfile["Raw"]:
+                raise HTTPError(
+                    404, reason="No {c} in {f}".format(c=channel_str, f=bulk_path.name)
+                )
+            sf, values = self.metadata(bulk_path, bulkfile)
+            length = refresh_length(bulkfile, channel_str)
+            start, end = clamp_window(start, end, length)
+            meta = OrderedDict(
+                channel=int(channel_str.split("_")[-1]),
+                start=start,
+                end=end,
+                length=length,
+                sample_rate=sf,
+            )
+            columns = self.window(bulkfile, bulk_path, channel_str, start, end, meta)
+        return columns, meta
+
+    @abstractmethod
+    def window(self, bulkfile, bulk_path, channel_str, start, end, meta):
+        """Return the columns of a clamped window, adding to meta if needed"""
+
+
+class SignalHandler(_WindowHandler):
+    """Signal of a window, raw or as min/max bins
+
+    mode=raw, the default, returns every sample as 'signal'. mode=minmax
+    returns 'x', the sample position of each point, and 'y', alternating bin
+    minimum and maximum, for about bins bins; from the pyramid sidecar when
+    it has a level that coarse, otherwise from the raw signal. meta has the
+    channel's pA calibration, or null.
+    """
+
+    kind = "signal"
+
+    def prepare(self):
+        self.mode = self.get_query_argument("mode", "raw")
+        if self.mode not in ("raw", "minmax"):
+            raise HTTPError(400, reason="mode must be raw or minmax")
+        try:
+            self.bins = int(self.get_query_argument("bins", DEFAULT_BINS))
+        except ValueError:
+            raise HTTPError(400, reason="bins must be an integer")
+        if self.bins < 1:
+            raise HTTPError(400, reason="bins must be at least 1")
+
+    def window(self, bulkfile, bulk_path, channel_str, start, end, meta):
+        calibration = channel_calibration(bulkfile, channel_str)
+        meta["calibration"] = None if calibration is None else calibration._asdict()
+        meta["mode"] = self.mode
+        if self.mode == "minmax":
+            pyramid = open_pyramid(bulk_path)
+            try:
+                envelope = read_envelope(pyramid, channel_str, start, end, self.bins)
+            finally:
+                if pyramid is not None:
+                    pyramid.close()
+            if envelope is not None:
+                x, y = envelope
+                return OrderedDict(x=x.astype(np.int64), y=y)
+        if end - start > MAX_SAMPLES:
+            raise HTTPError(
+                400,
+                reason="Window longer than {n} samples, use mode=minmax with a "
+                "pyramid sidecar (see 'bulkvis pyramid')".format(n=MAX_SAMPLES),
+            )
+        cache = signal_cache if end - start <= CACHED_SAMPLES else None
+        signal = read_signal(bulkfile, channel_str, start, end, cache=cache)
+        if self.mode == "raw":
+            return OrderedDict(signal=signal)
+        keep_index, y = minmax_downsample(signal, n_bins=self.bins)
+        return OrderedDict(x=keep_index.astype(np.int64) + start, y=y)
+
+
+class AnnotationsHandler(_WindowHandler):
+    """Annotation events in a window: 'time', 'code' and 'read_id'
+
+    meta has 'labels', the name of each code.
+    """
+
+    kind = "annotations"
+
+    def window(self, bulkfile, bulk_path, channel_str, start, end, meta):
+        annotations = annotation_store.get(bulkfile, channel_str)
+        index = annotations.window(start, end)
+        meta["labels"] = {str(k): v for k, v in annotations.labels.items()}
+        return OrderedDict(
+            time=annotations.times[index],
+            code=annotations.codes[index].astype(np.int16),
+            read_id=_bytes_column(annotations.read_ids[index]),
+        )
+
+
+class MappingsHandler(_WindowHandler):
+    """Mappings overlapping a window, from <run id>.bmf in the bulk directory
+
+    Columns are 'start' and 'end' in samples, 'strand', 'read_id',
+    'target_name' and 'label'.
+    """
+
+    kind = "mappings"
+
+    def window(self, bulkfile, bulk_path, channel_str, start, end, meta):
+        sf = meta["sample_rate"]
+        _, values = self.metadata(bulk_path, bulkfile)
+        run_id = values.get("Run ID")
+        bmf_path = Path(self.bulk_dir.directory) / "{r}.bmf".format(r=run_id)
+        try:
+            mappings = load_mapping_index(bmf_path, run_id=run_id)
+        except FileNotFoundError:
+            raise HTTPError(404, reason="No mappings for run {r}".format(r=run_id))
+        df = mappings.overlapping(meta["channel"], start / sf, end / sf)
+        meta["run_id"] = run_id
+        return OrderedDict(
+            start=np.floor(df["start_time"].to_numpy(dtype=np.float64) * sf).astype(
+                np.int64
+            ),
+            end=np.ceil(df["end_time"].to_numpy(dtype=np.float64) * sf).astype(
+                np.int64
+            ),
+            strand=_bytes_column(df["strand"]),
+            read_id=_bytes_column(df["read_id"]),
+            target_name=_bytes_column(df["target_name"]),
+            label=_bytes_column(df["label"]),
+        )
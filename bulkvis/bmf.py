@@ -0,0 +1,113 @@
+"""bmf.py
+
+Indexed access to bulkvis mapping files (.bmf, written by `bulkvis mappings`).
+Mappings are sorted by channel and start time once, with a running maximum
+of end times per channel, so the mappings overlapping a window are found by
+binary search instead of masking the whole table on every redraw.
+"""
+import os
+from pathlib import Path
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class MappingIndex:
+    """Mappings from a bmf file, indexed by channel and time
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        bmf rows, these must include 'channel', 'start_time' and 'end_time'
+    """
+
+    def __init__(self, df):
+        self.df = df.sort_values(["channel", "start_time"], kind="mergesort")
+        self.df = self.df.reset_index(drop=True)
+        self._starts = self.df["start_time"].to_numpy()
+        self._ends = self.df["end_time"].to_numpy()
+        channels, first = np.unique(self.df["channel"].to_numpy(), return_index=True)
+        bounds = np.append(first, len(self.df))
+        self._bounds = {
+            int(c): (int(bounds[i]), int(bounds[i + 1])) for i, c in enumerate(channels)
+        }
+        self._max_ends = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.df)
+
+    def _max_end(self, channel):
+        """Return the running maximum end time of a channel's mappings"""
+        with self._lock:
+            max_end = self._max_ends.get(channel)
+            if max_end is None:
+                lo, hi = self._bounds[channel]
+                max_end = np.maximum.accumulate(self._ends[lo:hi])
+                self._max_ends[channel] = max_end
+        return max_end
+
+    def overlapping(self, channel, start, end):
+        """Return the mappings on a channel that overlap (start, end)
+        Parameters
+        ----------
+        channel : int
+            Channel number
+        start : int or float
+            Window start, in seconds
+        end : int or float
+            Window end, in seconds
+        Returns
+        -------
+        pandas.DataFrame
+            Rows with start_time < end and end_time > start, sorted by start_time
+        """
+        if channel not in self._bounds:
+            return self.df.iloc[0:0]
+        lo, hi = self._bounds[channel]
+        # Mappings starting before the window ends are a prefix of the channel,
+        # and the running max end finds the first that could still overlap it
+        last = lo + np.searchsorted(self._starts[lo:hi], end, side="left")
+        first = lo + np.searchsorted(self._max_end(channel), start, side="right")
+        if first >= last:
+            return self.df.iloc[0:0]
+        keep = np.flatnonzero(self._ends[first:last] > start) + first
+        return self.df.iloc[keep]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_mapping_index(path, run_id=None):
+    """Return a MappingIndex for a bmf file, shared while the file is unchanged
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        Path to the bmf file
+    run_id : str or None
+        If set, only mappings from this run are kept
+    Returns
+    -------
+    MappingIndex
+    Raises
+    ------
+    FileNotFoundError
+        If the bmf file does not exist
+    """
+    path = Path(path)
+    stat = path.stat()
+    key = (os.path.realpath(path), run_id)
+    stamp = (stat.st_size, stat.st_mtime)
+    with _indexes_lock:
+        cached = _indexes.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    df = pd.read_csv(path, sep="\t")
+    if run_id is not None:
+        # filter mappings to just this run
+        df = df[df["run_id"] == run_id]
+    index = MappingIndex(df)
+    with _indexes_lock:
+        _indexes[key] = (stamp, index)
+    return index
@@ -1,5 +1,4 @@
 import configparser
-from dateutil import parser
 import math
 from pathlib import Path
 import re
@@ -8,9 +7,8 @@ import argparse
 import logging
 from collections import OrderedDict
 
-import h5py
 import numpy as np
-import pandas as pd
+from bokeh.events import Tap
 from bokeh.layouts import row, column
 from bokeh.models import (
     TextInput,
@@ -19,133 +17,69 @@ from bokeh.models import (
     Range1d,
     Label,
     Span,
-    Title,
-    LabelSet,
     RadioButtonGroup,
 )
 from bokeh.models import (
     CheckboxGroup,
+    ColumnDataSource,
+    DataTable,
     Dropdown,
+    NumberFormatter,
     PreText,
     Select,
     Button,
-    ColumnDataSource,
+    TableColumn,
 )
+from bokeh.models import FuncTickFormatter, LinearColorMapper
+from bokeh.palettes import Category10, Category20
 from bokeh.plotting import curdoc, figure
 
-
-def export_read_file(channel, start_index, end_index, bulkfile, output_dir):
-    """
-    Export a read file generated from index coordinates and
-    :param channel: int, channel number
-    :param start_index: int, start index for read
-    :param end_index: int, end index for read
-    :param bulkfile: bulkfile object
-    :param output_dir: str, output directory, including trailing slash
-    :return: 0 for success
-    """
-    out_filename = Path(bulkfile.filename).stem
-    # out_filename = (
-    #     bulkfile["UniqueGlobalKey"]["context_tags"].attrs["filename"].decode("utf8")
-    # )
-
-    output_arg = "{dir}/{fn}_bulkvis-read_{start}-{end}_ch_{ch}.fast5".format(
-        dir=output_dir,
-        fn=out_filename,
-        start=start_index,
-        end=end_index,
-        ch=channel,
-    )
-
-    LOGGER.info(f"Exporting to {output_arg}")
-
-    readfile = h5py.File(output_arg, "w")
-    read_id_str = "{ch}-{start}-{end}".format(
-        ch=channel, start=start_index, end=end_index
-    )
-    version_num = 0.6
-
-    ch_num = channel
-    ch_str = "Channel_{ch}".format(ch=ch_num)
-
-    ugk = readfile.create_group("UniqueGlobalKey")
-
-    bulkfile.copy("UniqueGlobalKey/context_tags", ugk)
-    bulkfile.copy("UniqueGlobalKey/tracking_id", ugk)
-    bulkfile.copy("IntermediateData/{ch}/Meta".format(ch=ch_str), ugk)
-
-    readfile["UniqueGlobalKey"]["channel_id"] = readfile["UniqueGlobalKey"]["Meta"]
-    readfile["UniqueGlobalKey"]["channel_id"].attrs.create(
-        "sampling_rate",
-        readfile["UniqueGlobalKey"]["Meta"].attrs["sample_rate"],
-        None,
-        dtype="Float64",
-    )
-    del readfile["UniqueGlobalKey"]["Meta"]
-
-    readfile["UniqueGlobalKey"]["channel_id"].attrs.create(
-        "channel_number", ch_num, None, dtype="<S4"
-    )
-    remove_attrs = [
-        "description",
-        "elimit",
-        "scaling_used",
-        "smallest_event",
-        "threshold",
-        "window",
-        "sample_rate",
-    ]
-    for attr in remove_attrs:
-        del readfile["UniqueGlobalKey"]["channel_id"].attrs[attr]
-
-    int_data_path = bulkfile["IntermediateData"][ch_str]["Reads"]
-    int_dict = {
-        "read_start": int_data_path["read_start"],
-        "median_before": int_data_path["median_before"],
-        # "current_well_id": int_data_path["current_well_id"],
-    }
-    df = pd.DataFrame(data=int_dict)
-    df = df.where(df.read_start > start_index).dropna()
-    read_number = 0
-    attrs = {
-        "duration": {"val": end_index - start_index, "d": "uint32"},
-        "median_before": {"val": df.iloc[0].median_before, "d": "Float64"},
-        "read_id": {"val": read_id_str, "d": "<S38"},
-        "read_number": {"val": read_number, "d": "uint16"},
-        # "start_mux": {"val": int(df.iloc[0].current_well_id), "d": "uint8"},
-        "start_time": {"val": start_index, "d": "uint64"},
-    }
-
-    dataset = bulkfile["Raw"][ch_str]["Signal"][()]
-    dataset = dataset[start_index:end_index]
-
-    readfile.create_group("Raw/Reads/Read_{n}".format(n=read_number))
-    readfile.attrs.create("file_version", version_num, None, dtype="Float64")
-    # add read_### attrs
-    for k, v in attrs.items():
-        readfile["Raw"]["Reads"]["Read_{n}".format(n=read_number)].attrs.create(
-            k, v["val"], None, dtype=v["d"]
-        )
-
-    ms = [18446744073709551615]
-    readfile.create_dataset(
-        "Raw/Reads/Read_{n}/Signal".format(n=read_number),
-        data=(dataset),
-        maxshape=(ms),
-        chunks=True,
-        dtype="int16",
-        compression="gzip",
-        compression_opts=1,
-    )
-
-    readfile.close()
-    return 0
-
+from bulkvis.annotations import ChannelAnnotations, annotation_store, read_events
+from bulkvis.bmf import load_mapping_index
+from bulkvis.cache import signal_cache
+from bulkvis.downsample import minmax_downsample
+from bulkvis.export import compression_option, export_read_file
+from bulkvis.figure import (
+    LABEL_PIXELS,
+    LINE_EXTENT,
+    annotation_source_data,
+    cull,
+    cull_segments,
+    fit_y_range,
+    hlines,
+    set_signal_x,
+    squiggle_figure,
+    vline,
+)
+from bulkvis.handles import file_pool
+from bulkvis.index import find_read
+from bulkvis.jobs import SessionJobs
+from bulkvis.manifest import ATTRIBUTES, get_bulk_directory, read_metadata
+from bulkvis.metrics import (
+    callback_seconds,
+    points_sent,
+    sessions,
+    start_sharing,
+    timed,
+)
+from bulkvis.overview import NO_DATA, overview_store
+from bulkvis.prefetch import neighbour_windows, prefetcher
+from bulkvis.profiling import profiled
+from bulkvis.pyramid import open_pyramid, read_envelope
+from bulkvis.raw import (
+    channel_calibration,
+    read_signal,
+    refresh_length,
+    signal_length,
+)
+from bulkvis.stats import read_stats
 
 LOGGER = logging.getLogger("bokeh")
 
 arg_parser = argparse.ArgumentParser()
 arg_parser.add_argument("dir")
+arg_parser.add_argument("--compression", type=compression_option, default="gzip:1")
+arg_parser.add_argument("--chunk-size", type=int, default=0)
 args = arg_parser.parse_args()
 
 LOGGER.info(f"Using dir: {args.dir}")
@@ -157,6 +91,11 @@ cfg = f"""
 dir = {args.dir}
 map = {args.dir}
 out = {args.dir}
+poll_interval = 10
+live_interval = 1
+live_max_interval = 10
+compression = {args.compression}
+chunk_size = {args.chunk_size}
 
 [plot_opts]
 wdg_width = 300
@@ -167,7 +106,15 @@ y_max = 4000
 label_height = 750
 upper_cut_off = 10000
 lower_cut_off = -4100
-output_backend = canvas
+output_backend = webgl
+units = raw
+
+[plot_opts_pa]
+y_min = 0
+y_max = 300
+label_height = 200
+upper_cut_off = 1700
+lower_cut_off = -750
 
 [labels]
 adapter = True
@@ -180,9 +127,15 @@ unblocking = True
 
 config.read_file(io.StringIO(cfg))
 cfg_po = config["plot_opts"]
+# defaults used instead of plot_opts when the signal is shown in pA
+cfg_pa = config["plot_opts_pa"]
 cfg_dr = config["data"]
 cfg_lo = config["labels"]
-output_backend = {"canvas", "svg", "webgl"}
+# Most annotations kept in the plot while following a live file
+LIVE_ANNOTATIONS = 1000
+# Milliseconds the plot must stay still after a zoom or pan before its
+# annotations and mappings are culled again for the visible range
+RECULL_DELAY = 300
 
 """
 
@@ -194,6 +147,32 @@ if cfg_dr[out] == '':
 """
 
 
+def profile_tags():
+    """Describe what the session is showing, for the names of profile files"""
+    app_vars = app_data["app_vars"]
+    window = None
+    if app_vars.get("start_time") is not None and app_vars.get("sf"):
+        window = int((app_vars["end_time"] - app_vars["start_time"]) * app_vars["sf"])
+    return OrderedDict(
+        [
+            ("file", Path(app_data["file_src"]).name if app_data["file_src"] else None),
+            ("channel", app_vars.get("channel_str")),
+            ("samples", window),
+        ]
+    )
+
+
+@profiled("refresh_file_list", profile_tags)
+def refresh_file_list():
+    """Add files found by the directory watcher to the file selector"""
+    files = [("", "--")] + [(x, x) for x in bulk_dir.files()]
+    if files != app_data["app_vars"]["files"]:
+        app_data["app_vars"]["files"] = files
+        app_data["wdg_dict"]["file_list"].options = files
+    # close pooled file handles no session has used recently
+    file_pool.reap()
+
+
 def init_wdg_dict():
     """
     Initialise the widget dictionary, adds in the initial bulkfile selector
@@ -206,14 +185,31 @@ def init_wdg_dict():
         title="Select bulk FAST5 file:", options=app_data["app_vars"]["files"]
     )
     wdg_dict["file_list"].on_change("value", update_file)
+    wdg_dict["loading"] = Div(text="Loading...", css_classes=["loading"])
+    wdg_dict["loading"].visible = jobs.busy
     return wdg_dict
 
 
+def show_loading(busy):
+    """Show the loading indicator while the session has background work"""
+    if app_data.get("wdg_dict") and "loading" in app_data["wdg_dict"]:
+        app_data["wdg_dict"]["loading"].visible = busy
+
+
+@profiled("update_file", profile_tags)
 def update_file(attr, old, new):
     """"""
+    # results still being loaded are for the old file
+    jobs.reset()
+    stop_live()
+    cancel_recull()
     if app_data["bulkfile"]:
-        app_data["bulkfile"].flush()
-        app_data["bulkfile"].close()
+        # the handle stays open in the pool for other sessions
+        file_pool.release(app_data["bulkfile"])
+        app_data["bulkfile"] = None
+    if app_data.get("pyramid"):
+        app_data["pyramid"].close()
+        app_data["pyramid"] = None
 
     if new == "":
         app_data["wdg_dict"] = init_wdg_dict()
@@ -234,7 +230,7 @@ def update_file(attr, old, new):
     map_file_list = app_data["app_vars"]["map_files"]
     # Clear old bulkfile data and build new data structures
     app_data.clear()
-    app_data["app_vars"] = {}
+    app_data.update(session_data())
     app_data["wdg_dict"] = OrderedDict()
     app_data["label_dt"] = OrderedDict()
     app_data["file_src"] = Path(Path(cfg_dr["dir"]) / file_src)
@@ -247,14 +243,17 @@ def update_file(attr, old, new):
         app_data["app_vars"]["sf"],
         app_data["app_vars"]["attributes"],
     ) = open_bulkfile(app_data["file_src"])
+    app_data["pyramid"] = open_pyramid(app_data["file_src"])
+    if app_data["pyramid"] is not None:
+        LOGGER.info(f"Using signal pyramid for {app_data['file_src']}")
 
     raw_path = app_data["bulkfile"]["Raw"]
     for i, member in enumerate(raw_path):
         if i == 0:
-            signal_ds = raw_path[member]["Signal"][()]
-            # get dataset length in seconds
-            # app_data['app_vars']['len_ds'] = math.ceil(len(signal_ds) / app_data['app_vars']['sf'])
-            app_data["app_vars"]["len_ds"] = len(signal_ds) / app_data["app_vars"]["sf"]
+            # get dataset length in seconds, from the dataset shape only
+            app_data["app_vars"]["len_ds"] = (
+                signal_length(app_data["bulkfile"], member) / app_data["app_vars"]["sf"]
+            )
 
     # add fastq and position inputs
     app_data["wdg_dict"] = init_wdg_dict()
@@ -262,137 +261,94 @@ def update_file(attr, old, new):
     # app_data['wdg_dict']['maps_list'] = Select(title="Select mapping file:", options=map_file_list)
     # app_data['wdg_dict']['position_label'] = Div(text='Position', css_classes=['position-dropdown', 'help-text'])
     app_data["wdg_dict"]["position_text"] = Div(
-        text="""Enter a position in your bulk FAST5 file as <code>channel:start-end</code> or a <code>complete FASTQ header</code>.""",
+        text="""Enter a position in your bulk FAST5 file as <code>channel:start-end</code>, a <code>read id</code> or a <code>complete FASTQ header</code>.""",
         css_classes=["position-drop"],
     )
     app_data["wdg_dict"]["position"] = TextInput(
         value="",
-        placeholder="e.g 391:120-150 or complete FASTQ header",
+        placeholder="e.g 391:120-150, a read id or complete FASTQ header",
         css_classes=["position-label"],
     )
-    read_bmf(app_data["app_vars"]["Run ID"])
     app_data["wdg_dict"]["position"].on_change("value", parse_position)
 
     layout.children[0] = column(
         list(app_data["wdg_dict"].values()), width=int(cfg_po["wdg_width"])
     )
+    # jobs run in order, so the mappings are set before the first window is
+    # drawn, which reads them on the event loop
+    run_id = app_data["app_vars"]["Run ID"]
+    jobs.submit("mappings", lambda: read_bmf(run_id), set_bmf)
+    # the overview is built once per bulk file and shared between sessions,
+    # which can take a while, so it is shown whenever it is ready
+    file_src = app_data["file_src"]
+    jobs.detach("overview", lambda: overview_store.get(file_src), show_overview)
+    # channel statistics are only shown if `bulkvis stats` has been run
+    jobs.submit("stats", lambda: read_stats(file_src), show_stats)
 
 
 def read_bmf(run_id):
-    run_id = run_id + ".bmf"
+    """Return the MappingIndex of a run, or None, called in the worker pool"""
+    bmf_path = Path(Path(cfg_dr["map"]) / (run_id + ".bmf"))
     try:
-        app_data["bmf"] = pd.read_csv(Path(Path(cfg_dr["map"]) / run_id), sep="\t")
-        # filter mappings to just this run
-        app_data["bmf"] = app_data["bmf"][
-            app_data["bmf"]["run_id"] == app_data["app_vars"]["Run ID"]
-        ]
+        # indexed by channel and start time once, shared between sessions
+        return load_mapping_index(bmf_path, run_id=run_id)
     except FileNotFoundError:
         pass
     except Exception as e:
         print(e)
-    return
+    return None
 
 
-def open_bulkfile(path):
-    # !!! add in check to see if this is a ONT bulkfile
-    # Open bulkfile in read-only mode
-    open_file = h5py.File(path, "r")
-    # Get sample frequency, how many data points are collected each second
-    sf = int(
-        open_file["UniqueGlobalKey"]["context_tags"]
-        .attrs["sample_frequency"]
-        .decode("utf8")
-    )
-    attributes = OrderedDict(
-        [
-            (
-                "tracking_id",
-                [
-                    ("Experiment", "sample_id"),
-                    ("Flowcell ID", "flow_cell_id"),
-                    ("MinKNOW version", "version"),
-                    ("Protocols version", "protocols_version"),
-                    ("MinION ID", "device_id"),
-                    ("Hostname", "hostname"),
-                    ("Run ID", "run_id"),
-                    ("ASIC ID", "asic_id"),
-                    ("Experiment start", "exp_start_time"),
-                ],
-            ),
-            (
-                "context_tags",
-                [
-                    ("Sequencing kit", "sequencing_kit"),
-                    ("Flowcell type", "flowcell_type"),
-                ],
-            ),
-        ]
-    )
+def set_bmf(bmf):
+    app_data["bmf"] = bmf
 
-    for k, v in attributes.items():
-        for attribute in v:
-            try:
-                app_data["app_vars"][attribute[0]] = (
-                    open_file["UniqueGlobalKey"][k].attrs[attribute[1]].decode("utf8")
-                )
-                if attribute[1] == "exp_start_time":
-                    app_data["app_vars"][attribute[0]] = parser.parse(
-                        app_data["app_vars"][attribute[0]]
-                    ).strftime("%d-%b-%Y %H:%M:%S")
-            except KeyError:
-                app_data["app_vars"][attribute[0]] = "N/A"
-    return open_file, sf, attributes
+
+def open_bulkfile(path):
+    # Borrow a read-only handle, shared with other sessions viewing the file
+    open_file = file_pool.acquire(path)
+    # Sample frequency and attributes come from the manifest when possible
+    metadata = bulk_dir.metadata(Path(path).name)
+    if metadata is None:
+        metadata = read_metadata(open_file)
+    sf, values = metadata
+    app_data["app_vars"].update(values)
+    return open_file, sf, ATTRIBUTES
 
 
 # noinspection PyUnboundLocalVariable
+@timed(callback_seconds, callback="parse_position")
+@profiled("parse_position", profile_tags)
 def parse_position(attr, old, new):
-    if re.match(r"^(\@[a-f0-9\-]{36})([a-z0-9=\s]{1,})ch=[0-9]{1,4}", new):
-        # https://regex101.com/r/9VvgNM/4
-        # Match UUID / read_id as fastq str
-        #   ^(\@[a-f0-9\-]{36})
-        # Match lowercase a-z, 0-9, '=' and whitespace
-        #   ([a-z0-9=\s]{1,})
-        # Match 'ch=' and up to 4 numbers
-        #   ch=[0-9]{1,4}
-        # if new[0] == "@":
+    read_match = re.match(r"^\@?([a-f0-9\-]{36})(\s|\Z)", new)
+    if read_match:
+        # A read id, on its own or as a complete FASTQ header
+        #   ^\@?([a-f0-9\-]{36})
         input_error(app_data["wdg_dict"]["position"], "remove")
-        fq = new[1:]
-        fq_list = fq.split(" ")
-        # split out read_id and channel
-        for k, item in enumerate(fq_list):
-            if k == 0:
-                read_id = item
-            if item.split("=")[0] == "ch":
-                channel_num = item.split("=")[1]
-                channel_str = "Channel_{num}".format(num=channel_num)
-        # Get ch_str, start, end
-        # If read_id and ch not set...
-        # noinspection PyUnboundLocalVariable
-        if read_id and channel_str:
-            int_data_path = app_data["bulkfile"]["IntermediateData"][channel_str][
-                "Reads"
-            ]
-            int_data_labels = {
-                "read_id": int_data_path["read_id"],
-                "read_start": int_data_path["read_start"],
-            }
-            df = pd.DataFrame(data=int_data_labels)
-            df.read_start = df.read_start / app_data["app_vars"]["sf"]
-            df.read_id = df.read_id.str.decode("utf8")
-            df = df.where(df.read_id == read_id)
-            df = df.dropna()
-            if len(df) > 2:
-                start_time = math.floor(df.iloc[0, :].read_start)
-                end_time = math.ceil(df.iloc[-1, :].read_start)
-            else:
+        read_id = read_match.group(1)
+        current = app_data["wdg_dict"]["file_list"].value
+        names = [current] + [x for x in bulk_dir.files() if x != current]
+        paths = [Path(cfg_dr["dir"]) / x for x in names]
+        bulkfile, sf = app_data["bulkfile"], app_data["app_vars"]["sf"]
+
+        def show_read(position):
+            if position is None:
                 input_error(app_data["wdg_dict"]["position"], "add")
                 return
-        else:
-            input_error(app_data["wdg_dict"]["position"], "add")
-            return
-        app_data["wdg_dict"]["position"].value = "{ch}:{start}-{end}".format(
-            ch=channel_num, start=start_time, end=end_time
+            file_name, channel_num, start_time, end_time = position
+            if file_name != app_data["wdg_dict"]["file_list"].value:
+                # The read is in another bulk file, open it first
+                app_data["wdg_dict"]["file_list"].value = file_name
+            app_data["wdg_dict"]["position"].value = "{ch}:{start}-{end}".format(
+                ch=channel_num, start=start_time, end=end_time
+            )
+
+        # index lookups read from disk, so run in the worker pool
+        jobs.submit(
+            "position",
+            lambda: find_read_position(read_id, new, paths, bulkfile, sf),
+            show_read,
         )
+        return
     elif re.match(r"^([0-9]{1,4}:[0-9]{1,9}-[0-9]{1,9})\Z", new):
         # https://regex101.com/r/zkN1j2/2
         input_error(app_data["wdg_dict"]["position"], "remove")
@@ -409,7 +365,8 @@ def parse_position(attr, old, new):
         return
 
     if int(end_time) > app_data["app_vars"]["len_ds"]:
-        end_time = app_data["app_vars"]["len_ds"]
+        # rounded up so the last part second, and a live end, are kept
+        end_time = math.ceil(app_data["app_vars"]["len_ds"])
     app_data["app_vars"]["channel_str"] = channel_str
     app_data["app_vars"]["channel_num"] = int(channel_num)
     app_data["app_vars"]["start_time"] = int(start_time)
@@ -424,61 +381,102 @@ def parse_position(attr, old, new):
     update()
 
 
-def update_data(bulkfile, app_vars):
+def find_read_position(read_id, header, paths, bulkfile, sf):
+    """Return (file name, channel, start, end) in seconds for a read, or None
+
+    The read id indexes of paths, the open file first, are searched first.
+    Without an index the read is looked up in the channel given by 'ch=' in
+    a FASTQ header, in the open file, bulkfile with sample rate sf. This
+    runs in the worker pool.
+    """
+    hit = find_read(read_id, paths)
+    if hit is not None:
+        bulk_path, channel_num, start, end = hit
+        metadata = bulk_dir.metadata(bulk_path.name)
+        if metadata is None:
+            # not in the manifest yet, or it failed validation there
+            try:
+                with file_pool.borrow(bulk_path) as bulkfile:
+                    metadata = read_metadata(bulkfile)
+            except (OSError, KeyError, ValueError) as e:
+                LOGGER.warning(f"Could not read {bulk_path}: {e}")
+                return None
+        sf = metadata[0]
+    else:
+        channel_match = re.search(r"\sch=([0-9]{1,4})(\s|\Z)", header)
+        if channel_match is None:
+            return None
+        bulk_path = paths[0]
+        channel_num = int(channel_match.group(1))
+        try:
+            annotations = annotation_store.get(
+                bulkfile, "Channel_{num}".format(num=channel_num)
+            )
+        except KeyError:
+            return None
+        read_times = annotations.times[annotations.read_ids == read_id]
+        if len(read_times) == 0:
+            return None
+        start, end = read_times.min(), read_times.max()
+    start_time = math.floor(start / sf)
+    end_time = max(math.ceil(end / sf), start_time + 1)
+    return bulk_path.name, channel_num, start_time, end_time
+
+
+def load_window(bulkfile, pyramid, app_vars, plot_width):
+    """Read everything needed to draw the current window
+
+    This runs in the worker pool, so app_data is left alone; show_window
+    applies the returned entries to it.
+    Returns
+    -------
+    dict
+        app_vars, envelope, y_data, annotations and label_dt
+    """
+    app_vars = dict(app_vars)
     app_vars["duration"] = app_vars["end_time"] - app_vars["start_time"]
     # get times and squiggles
     app_vars["start_squiggle"] = math.floor(app_vars["start_time"] * app_vars["sf"])
     app_vars["end_squiggle"] = math.floor(app_vars["end_time"] * app_vars["sf"])
-    # get data in numpy arrays
-    step = 1 / app_vars["sf"]
-    app_data["x_data"] = np.arange(app_vars["start_time"], app_vars["end_time"], step)
-    app_data["y_data"] = bulkfile["Raw"][app_vars["channel_str"]]["Signal"][()]
-    app_vars["len_ds"] = len(app_data["y_data"]) / app_vars["sf"]
-    app_data["y_data"] = app_data["y_data"][
-        app_vars["start_squiggle"] : app_vars["end_squiggle"]
-    ]
-    # get annotations
-    path = bulkfile["IntermediateData"][app_vars["channel_str"]]["Reads"]
-    fields = ["read_id", "read_start", "modal_classification"]
-    app_data["label_df"], app_data["label_dt"] = get_annotations(
-        path, fields, "modal_classification"
-    )
-    app_data["label_df"] = app_data["label_df"].drop_duplicates(
-        subset=["read_id", "modal_classification"], keep="first"
+    app_vars["len_ds"] = (
+        refresh_length(bulkfile, app_vars["channel_str"]) / app_vars["sf"]
     )
-    app_data["label_df"].read_start = app_data["label_df"].read_start / app_vars["sf"]
-    app_data["label_df"].read_id = app_data["label_df"].read_id.str.decode("utf8")
-
-    path = bulkfile["StateData"][app_vars["channel_str"]]["States"]
-    fields = ["acquisition_raw_index", "summary_state"]
-    state_label_df, state_label_dtypes = get_annotations(path, fields, "summary_state")
-    state_label_df.acquisition_raw_index = (
-        state_label_df.acquisition_raw_index / app_vars["sf"]
+    app_vars["calibration"] = channel_calibration(bulkfile, app_vars["channel_str"])
+    # zoomed out windows are drawn from the pyramid, if there is one, otherwise
+    # only the visible window of raw signal is read from disk
+    window = {"app_vars": app_vars, "y_data": None}
+    window["envelope"] = read_envelope(
+        pyramid,
+        app_vars["channel_str"],
+        app_vars["start_squiggle"],
+        app_vars["end_squiggle"],
+        plot_width,
     )
-    state_label_df = state_label_df.rename(
-        columns={
-            "acquisition_raw_index": "read_start",
-            "summary_state": "modal_classification",
-        }
+    if window["envelope"] is None:
+        window["y_data"] = load_raw_window(bulkfile, app_vars)
+    # get annotations, indexed once per channel and shared between sessions
+    window["annotations"] = annotation_store.get(bulkfile, app_vars["channel_str"])
+    window["label_dt"] = OrderedDict(window["annotations"].labels)
+    return window
+
+
+def load_raw_window(bulkfile, app_vars):
+    """Return the raw signal for the current window, time points are implicit"""
+    return read_signal(
+        bulkfile,
+        app_vars["channel_str"],
+        app_vars["start_squiggle"],
+        app_vars["end_squiggle"],
+        cache=signal_cache,
     )
-    app_data["label_df"] = app_data["label_df"].append(
-        state_label_df, ignore_index=True
-    )
-    app_data["label_df"].sort_values(by="read_start", ascending=True, inplace=True)
-    app_data["label_dt"].update(state_label_dtypes)
 
 
-def get_annotations(path, fields, enum_field):
-    data_labels = {}
-    for field in fields:
-        data_labels[field] = path[field]
-    data_dtypes = {}
-    if h5py.check_dtype(enum=path.dtype[enum_field]):
-        dataset_dtype = h5py.check_dtype(enum=path.dtype[enum_field])
-        # data_dtype may lose some dataset dtypes there are duplicates of 'v'
-        data_dtypes = {v: k for k, v in dataset_dtype.items()}
-    labels_df = pd.DataFrame(data=data_labels)
-    return labels_df, data_dtypes
+def get_plot_width():
+    """Return the plot width from the widgets, falling back to the config"""
+    try:
+        return int(app_data["wdg_dict"]["po_width"].value)
+    except (KeyError, TypeError, ValueError):
+        return int(cfg_po["plot_width"])
 
 
 def build_widgets():
@@ -590,6 +588,8 @@ def build_widgets():
     #             """,
     #     css_classes=['adjust-help-drop']
     # )
+    # y axis defaults depend on the units the signal starts in
+    opts = cfg_pa if cfg_po["units"] == "pA" else cfg_po
     wdg["po_width"] = TextInput(
         title="Plot Width (px)", value=cfg_po["plot_width"], css_classes=["adjust-drop"]
     )
@@ -600,17 +600,17 @@ def build_widgets():
     )
     wdg["label_height"] = TextInput(
         title="Annotation height (y-axis)",
-        value=cfg_po["label_height"],
+        value=opts["label_height"],
         css_classes=["adjust-drop"],
     )
     wdg["po_y_max"] = TextInput(
         title="y max",
-        value=cfg_po["y_max"],
+        value=opts["y_max"],
         css_classes=["adjust-drop", "toggle_y_target"],
     )
     wdg["po_y_min"] = TextInput(
         title="y min",
-        value=cfg_po["y_min"],
+        value=opts["y_min"],
         css_classes=["adjust-drop", "toggle_y_target"],
     )
     wdg["toggle_y_axis"] = Toggle(
@@ -625,6 +625,18 @@ def build_widgets():
         css_classes=["toggle_button_g_r", "adjust-drop"],
         active=True,
     )
+    wdg["toggle_live"] = Toggle(
+        label="Live tail",
+        button_type="danger",
+        css_classes=["toggle_button_g_r", "adjust-drop"],
+        active=False,
+    )
+    wdg["toggle_pa"] = Toggle(
+        label="Current (pA)",
+        button_type="danger",
+        css_classes=["toggle_button_g_r", "adjust-drop"],
+        active=cfg_po["units"] == "pA",
+    )
 
     wdg["label_filter"].on_change("active", update_checkboxes)
     wdg["filter_toggle_group"].on_change("active", update_toggle)
@@ -632,294 +644,500 @@ def build_widgets():
     wdg["jump_prev"].on_click(prev_update)
     wdg["save_read_file"].on_click(export_data)
 
-    for name in toggle_inputs:
-        wdg[name].on_click(toggle_button)
+    wdg["toggle_annotations"].on_click(toggle_visibility)
+    wdg["toggle_mappings"].on_click(toggle_visibility)
+    wdg["toggle_y_axis"].on_click(toggle_y_axis)
+    wdg["toggle_smoothing"].on_click(toggle_smoothing)
+    wdg["toggle_pa"].on_click(toggle_units)
+    wdg["toggle_live"].on_click(toggle_live)
     for name in int_inputs:
         wdg[name].on_change("value", is_input_int)
     return wdg
 
 
-def create_figure(x_data, y_data, wdg, app_vars):
-    def vline(x_coords, y_upper, y_lower):
-        # Return a dataset that can plot vertical lines
-        x_values = np.vstack((x_coords, x_coords)).T
-        y_upper_list = np.full((1, len(x_values)), y_upper)
-        y_lower_list = np.full((1, len(x_values)), y_lower)
-        y_values = np.vstack((y_lower_list, y_upper_list)).T
-        return x_values.tolist(), y_values.tolist()
-
-    def hlines(y_coords, x_lower, x_upper):
-        """
-
-        Parameters
-        ----------
-        y_coords: (int, float) height to plot lines at
-        x_lower: (int, float) lower x coord
-        x_upper: (int, float) upper x coord
-
-        Returns
-        -------
-
-        """
-        x_values = np.vstack((x_lower, x_upper)).T
-        y_values_list = np.full((1, len(x_values)), y_coords)
-        y_values = np.vstack((y_values_list, y_values_list)).T
-        return x_values.tolist(), y_values.tolist()
-
-    if wdg["toggle_smoothing"].active:
-        w_range = app_vars["duration"]
-        divisor = math.e ** 2.5
-        thin_factor = math.ceil(w_range / divisor)
-    else:
-        thin_factor = 1
-    if thin_factor == 0:
-        thin_factor = 1
+@timed(callback_seconds, callback="create_figure")
+@profiled("create_figure", profile_tags)
+def create_figure(wdg, app_vars):
+    """Build the plot once per file, the data is filled in by update_figure
 
-    greater_delete_index = np.argwhere(y_data > int(cfg_po["upper_cut_off"]))
-    x_data = np.delete(x_data, greater_delete_index)
-    y_data = np.delete(y_data, greater_delete_index)
+    Every glyph draws from a ColumnDataSource kept in app_data["sources"], so
+    navigating only sends new data to the browser and toggles only change the
+    visibility of renderers in app_data["renderers"].
+    """
+    plot = squiggle_figure(
+        int(wdg["po_width"].value),
+        int(wdg["po_height"].value),
+        output_backend=cfg_po["output_backend"],
+    )
+    app_data.update(plot)
+    plot["figure"].x_range.on_change("start", zoom_changed)
+    plot["figure"].x_range.on_change("end", zoom_changed)
+    return column(plot["figure"], css_classes=["plot_div"])
 
-    lesser_delete_index = np.argwhere(y_data < int(cfg_po["lower_cut_off"]))
-    x_data = np.delete(x_data, lesser_delete_index)
-    y_data = np.delete(y_data, lesser_delete_index)
 
-    x_data = x_data[::thin_factor]
-    y_data = y_data[::thin_factor]
+def plot_panel():
+    """Return the channel overview and statistics above the squiggle plot, if they exist"""
+    plots = [app_data.get(k) for k in ["overview_plt", "stats_plt", "pore_plt"]]
+    return column([p for p in plots if p is not None])
 
-    data = {
-        "x": x_data,
-        "y": y_data,
-    }
 
-    source = ColumnDataSource(data=data)
+def create_overview(overview, sf):
+    """Plot the dominant state of every channel over the run as a heatmap
+
+    Clicking a cell shows that channel and time in the squiggle plot.
+    """
+    codes = list(overview.labels)
+    if len(codes) <= 10:
+        palette = list(Category10[10][: max(len(codes), 3)])
+    else:
+        palette = [Category20[20][i % 20] for i in range(len(codes))]
+    palette = palette[: len(codes)] + ["#ffffff"]
+    # states are drawn as palette indices, the last colour for no data
+    lookup = np.full(NO_DATA + 1, len(codes), dtype=np.uint8)
+    lookup[codes] = np.arange(len(codes))
+    image = lookup[overview.states]
+    bin_seconds = overview.bin_size / sf
+    n_channels = len(overview.channels)
 
     p = figure(
-        plot_height=int(wdg["po_height"].value),
-        plot_width=int(wdg["po_width"].value),
+        plot_height=min(max(n_channels, 150), 400),
+        plot_width=int(cfg_po["plot_width"]),
         toolbar_location="right",
-        tools=["xbox_zoom", "xpan", "undo", "reset", "save"],
-        active_drag="xbox_zoom",
+        tools=["box_zoom", "pan", "reset"],
+        x_range=Range1d(0, overview.n_bins * bin_seconds),
+        y_range=Range1d(0, n_channels),
+        title="Channel activity, click to view a channel",
     )
-    if cfg_po["output_backend"] not in output_backend:
-        p.output_backend = "canvas"
-    else:
-        p.output_backend = cfg_po["output_backend"]
-    # Add step/% points plotted: Step: {sp} ({pt:.3f}) -> sp=thin_factor, pt=1/thin_factor
-    p.add_layout(
-        Title(
-            text="Channel: {ch} Start: {st} End: {ed} Sample rate: {sf}".format(
-                ch=app_vars["channel_num"],
-                st=app_vars["start_time"],
-                ed=app_vars["end_time"],
-                sf=app_vars["sf"],
-            )
+    p.toolbar.logo = None
+    p.xaxis.axis_label = "Time (seconds)"
+    p.yaxis.axis_label = "Channel"
+    p.yaxis.formatter = FuncTickFormatter(
+        args={"channels": overview.channels.tolist()},
+        code="return channels[Math.floor(tick)] || '';",
+    )
+    p.image(
+        image=[image],
+        x=0,
+        y=0,
+        dw=overview.n_bins * bin_seconds,
+        dh=n_channels,
+        color_mapper=LinearColorMapper(
+            palette=palette, low=-0.5, high=len(codes) + 0.5
         ),
-        "above",
     )
-    p.add_layout(
-        Title(
-            text="bulk FAST5 file: {s}".format(
-                s=app_data["wdg_dict"]["file_list"].value
+
+    @profiled("select_cell", profile_tags)
+    def select_cell(event):
+        if event.x is None or event.y is None:
+            return
+        cell = overview.cell(int(event.y), int(event.x // bin_seconds))
+        if cell is None or "position" not in app_data["wdg_dict"]:
+            return
+        channel, start, end = cell
+        app_data["wdg_dict"]["position"].value = "{ch}:{start}-{end}".format(
+            ch=channel,
+            start=math.floor(start / sf),
+            end=max(math.ceil(end / sf), math.floor(start / sf) + 1),
+        )
+
+    p.on_event(Tap, select_cell)
+    legend = Div(
+        text=" ".join(
+            '<span style="background-color:{c};padding:0 6px">&nbsp;</span> {n}'.format(
+                c=c, n=overview.labels.get(code, code)
             )
+            for code, c in zip(codes, palette)
         ),
-        "above",
+        css_classes=["overview-legend"],
     )
+    return column(p, legend, css_classes=["plot_div"])
 
-    p.toolbar.logo = None
-    p.yaxis.axis_label = "Raw signal"
-    p.yaxis.major_label_orientation = "horizontal"
-    p.xaxis.axis_label = "Time (seconds)"
-    p.line(source=source, x="x", y="y", line_width=1)
-    p.xaxis.major_label_orientation = math.radians(45)
-    p.x_range.range_padding = 0.01
-
-    # set padding manually
-    y_min = np.amin(data["y"])
-    y_max = np.amax(data["y"])
-    pad = (y_max - y_min) * 0.1 / 2
-    p.y_range = Range1d(y_min - pad, y_max + pad)
-    try:
-        app_data["bmf"]
-    except NameError:
-        bmf_set = False
-    except KeyError:
-        bmf_set = False
-    else:
-        bmf_set = True
-    if bmf_set and wdg["toggle_mappings"].active:
-        LOGGER.info("Plotting mappings")
-        # set padding manually
-        # lower_pad = (y_max - y_min) * 0.1 / 2
-        # upper_pad = (y_max - y_min) / 2
-        # p.y_range = Range1d(y_min - lower_pad, y_max + upper_pad)
-        # set mapping track midpoints
-        # upper_mapping = upper_pad / 4 * 3 + y_max
-        # lower_mapping = upper_pad / 4 + y_max
-        lower_mapping = int(wdg["label_height"].value) + 750
-        # Select only this channel
-        slim_bmf = app_data["bmf"][
-            app_data["bmf"]["channel"] == app_vars["channel_num"]
-        ]
-        # Select the current viewed range
-        slim_bmf = slim_bmf[
-            (
-                (slim_bmf["start_time"] > app_vars["start_time"])
-                & (slim_bmf["end_time"] < app_vars["end_time"])
-            )
-            | (
-                (slim_bmf["start_time"] < app_vars["start_time"])
-                & (slim_bmf["end_time"] < app_vars["end_time"])
-                & (slim_bmf["end_time"] > app_vars["start_time"])
-            )
-            | (
-                (slim_bmf["start_time"] > app_vars["start_time"])
-                & (slim_bmf["end_time"] > app_vars["end_time"])
-                & (slim_bmf["start_time"] < app_vars["end_time"])
-            )
-        ]
-        slim_bmf["start_time"] = slim_bmf["start_time"].where(
-            slim_bmf["start_time"] > app_vars["start_time"], app_vars["start_time"]
-        )
-        slim_bmf["end_time"] = slim_bmf["end_time"].where(
-            slim_bmf["end_time"] < app_vars["end_time"], app_vars["end_time"]
-        )
 
-        slim_bmf["height"] = lower_mapping
-        slim_bmf["offset"] = (
-            np.ones(len(slim_bmf)) * 5
-            + slim_bmf.groupby(["start_time", "end_time"]).cumcount() * 15
-        )
-        # Convert slim_bmf to ColDataSrc
-        mapping_source = ColumnDataSource(data=slim_bmf.to_dict(orient="list"))
-        # Add labels to LabelSet
-        mapping_labels = LabelSet(
-            x="start_time",
-            y="height",
-            text="label",
-            level="glyph",
-            x_offset=5,
-            y_offset="offset",
-            source=mapping_source,
-            render_mode="canvas",
-        )
-        p.add_layout(mapping_labels)
-        # Add some colour here
-        # Forward Vertical lines => blue
-        p_x, p_y = vline(
-            np.concatenate(
-                [
-                    slim_bmf["start_time"]
-                    .where(slim_bmf["strand"] == "+")
-                    .dropna()
-                    .values,
-                    slim_bmf["end_time"]
-                    .where(slim_bmf["strand"] == "+")
-                    .dropna()
-                    .values,
-                ]
-            ),
-            lower_mapping + 20,
-            lower_mapping - 20,
+def show_overview(overview):
+    """Draw the channel overview of the current file above the squiggle plot"""
+    if overview is None or not len(overview.channels):
+        return
+    app_data["overview"] = overview
+    app_data["overview_plt"] = create_overview(overview, app_data["app_vars"]["sf"])
+    layout.children[1] = plot_panel()
+
+
+def create_stats_table(stats):
+    """Tabulate the signal statistics of every channel, sortable by column
+
+    Selecting a row shows that channel in the squiggle plot, at the current
+    window if there is one.
+    """
+    df = stats.to_frame()
+    # calibrated values compare better between channels, if there are any
+    units = "_pa" if df["median_pa"].notna().any() else ""
+    columns = [
+        TableColumn(field="channel", title="Channel"),
+        TableColumn(
+            field="median" + units,
+            title="Median" + (" (pA)" if units else ""),
+            formatter=NumberFormatter(format="0.0"),
+        ),
+        TableColumn(
+            field="mad" + units, title="MAD", formatter=NumberFormatter(format="0.00")
+        ),
+        TableColumn(
+            field="std" + units, title="SD", formatter=NumberFormatter(format="0.00")
+        ),
+        TableColumn(field="saturated", title="Saturated"),
+    ] + [
+        TableColumn(field=name, title=name, formatter=NumberFormatter(format="0.0%"))
+        for name in stats.labels.values()
+    ]
+    source = ColumnDataSource(df)
+    table = DataTable(
+        source=source,
+        columns=columns,
+        width=int(cfg_po["plot_width"]),
+        height=min(max(len(df), 5), 10) * 25 + 30,
+        index_position=None,
+    )
+
+    @profiled("select_channel", profile_tags)
+    def select_channel(attr, old, new):
+        if not new or "position" not in app_data["wdg_dict"]:
+            return
+        app_vars = app_data["app_vars"]
+        start = app_vars.get("start_time") or 0
+        end = app_vars.get("end_time") or min(
+            start + 10, max(math.ceil(app_vars["len_ds"]), 1)
         )
-        p.multi_line(p_x, p_y, line_dash="solid", color="blue", line_width=1)
-        # Reverse Vertical lines => red
-        p_x, p_y = vline(
-            np.concatenate(
-                [
-                    slim_bmf["start_time"]
-                    .where(slim_bmf["strand"] == "-")
-                    .dropna()
-                    .values,
-                    slim_bmf["end_time"]
-                    .where(slim_bmf["strand"] == "-")
-                    .dropna()
-                    .values,
-                ]
-            ),
-            lower_mapping + 20,
-            lower_mapping - 20,
+        app_data["wdg_dict"]["position"].value = "{ch}:{start}-{end}".format(
+            ch=int(df["channel"].iloc[new[0]]), start=start, end=end
         )
-        p.multi_line(p_x, p_y, line_dash="solid", color="red", line_width=1)
-        # Horizontal lines
-        p_x, p_y = hlines(
-            lower_mapping,
-            slim_bmf["start_time"].where(slim_bmf["strand"] == "+").dropna(),
-            slim_bmf["end_time"].where(slim_bmf["strand"] == "+").dropna(),
+
+    source.selected.on_change("indices", select_channel)
+    title = Div(text="<b>Channel statistics</b>, click a column to sort")
+    return column(title, table, css_classes=["plot_div"])
+
+
+def show_stats(stats):
+    """Show the channel statistics of the current file, if it has a stats sidecar"""
+    if stats is None or not len(stats.table):
+        return
+    app_data["stats"] = stats
+    app_data["stats_plt"] = create_stats_table(stats)
+    layout.children[1] = plot_panel()
+
+
+def update_figure(wdg, app_vars, data=None):
+    """Send the data for the current window to the persistent plot
+
+    data is the output of figure_data, if it was prepared in the worker pool.
+    """
+    p = app_data["figure"]
+    p.plot_height = int(wdg["po_height"].value)
+    p.plot_width = int(wdg["po_width"].value)
+    app_data["titles"]["position"].text = (
+        "Channel: {ch} Start: {st} End: {ed} Sample rate: {sf}".format(
+            ch=app_vars["channel_num"],
+            st=app_vars["start_time"],
+            ed=app_vars["end_time"],
+            sf=app_vars["sf"],
         )
-        p.multi_line(p_x, p_y, line_dash="solid", color="blue", line_width=1)
-        # Horizontal lines
-        p_x, p_y = hlines(
-            lower_mapping,
-            slim_bmf["start_time"].where(slim_bmf["strand"] == "-").dropna(),
-            slim_bmf["end_time"].where(slim_bmf["strand"] == "-").dropna(),
+    )
+    app_data["titles"]["file"].text = "bulk FAST5 file: {s}".format(
+        s=app_data["wdg_dict"]["file_list"].value
+    )
+    if data is None:
+        data = figure_data(
+            plot_settings(wdg),
+            app_vars,
+            app_data,
+            wdg["toggle_smoothing"].active,
+            app_data.get("bmf"),
+            app_data["label_mp"],
         )
-        p.multi_line(p_x, p_y, line_dash="solid", color="red", line_width=1)
+    set_sources(data)
+    # the window was culled to its full range, the plot may show less of it
+    app_data["culled"] = (
+        app_vars["start_squiggle"] / app_vars["sf"],
+        app_vars["end_squiggle"] / app_vars["sf"],
+    )
+    zoom_changed(None, None, None)
+    if signal_calibration(plot_settings(wdg), app_vars) is None:
+        p.yaxis.axis_label = "Raw signal"
+    else:
+        p.yaxis.axis_label = "Current (pA)"
+    app_data["smoothed"] = wdg["toggle_smoothing"].active
+    update_visibility(wdg)
+
+
+def plot_settings(wdg):
+    """Return the widget values the *_data functions use, as a plain dict
+
+    Jobs are given these rather than the widgets, which belong to the
+    session's document and are only read on its event loop.
+    """
+    return {
+        "po_width": int(wdg["po_width"].value),
+        "label_height": int(wdg["label_height"].value),
+        "label_filter": list(wdg["label_filter"].active),
+        "toggle_pa": wdg["toggle_pa"].active,
+        "toggle_live": wdg["toggle_live"].active,
+    }
+
+
+def figure_data(settings, app_vars, window, smoothing, bmf, label_mp):
+    """Return the data for every source of the plot, by source name"""
+    data = signal_data(settings, app_vars, window, smoothing)
+    data.update(mapping_data(settings, app_vars, bmf))
+    data.update(annotation_data(settings, app_vars, window["annotations"], label_mp))
+    return data
+
+
+def set_sources(data):
+    """Send data, from the *_data functions, to the plot's sources"""
+    # the time axis must be updated before the signal it applies to
+    if "signal_x" in data:
+        set_signal_x(app_data, **data["signal_x"])
+    for name, values in data.items():
+        if name != "signal_x":
+            app_data["sources"][name].data = values
+            count_points(name, values)
+    if "signal" in data:
+        update_y_range(app_data["wdg_dict"])
+
+
+def count_points(name, values):
+    """Count the rows of data sent to a source, for the server metrics"""
+    points_sent.inc(len(next(iter(values.values()), ())), source=name)
+
+
+def signal_data(settings, app_vars, window, smoothing):
+    """Return the signal source data, downsampled for the current window
+
+    The signal is sent as typed arrays: y as int16 raw samples or float32
+    pyramid bins and x as int32 sample offsets from the start of the window,
+    which the browser converts to seconds. When every raw sample is drawn x
+    is left out altogether. window must hold the raw signal if it is drawn,
+    see toggle_smoothing.
+    """
+    start = app_vars["start_squiggle"]
+    if smoothing and window["envelope"] is not None:
+        # min/max bins from the pyramid are already about one per pixel
+        offsets = window["envelope"][0] - start
+        y_data = window["envelope"][1]
+    else:
+        offsets, y_data = None, window["y_data"]
+
+    # with smoothing off every sample is drawn
+    keep_index, y_data = downsample_signal(
+        settings, app_vars, y_data, settings["po_width"] if smoothing else None
+    )
+    signal = {"y": y_data}
+    # live windows grow at the end, so x is always sent, see show_live
+    implicit = (
+        offsets is None
+        and len(keep_index) == len(window["y_data"])
+        and not settings["toggle_live"]
+    )
+    if not implicit:
+        if offsets is not None:
+            keep_index = offsets[keep_index]
+        signal["x"] = keep_index.astype(np.int32)
+    return {
+        "signal": signal,
+        "signal_x": {"start": start, "sf": app_vars["sf"], "implicit": implicit},
+    }
+
+
+def downsample_signal(settings, app_vars, y_data, n_bins):
+    """Return the indices and values of the points of a signal to draw
+
+    The min and max of each of n_bins bins are kept, dropping values outside
+    the cut-offs in the same pass, and converted to pA if that is selected.
+    """
+    calibration = signal_calibration(settings, app_vars)
+    opts = cfg_po if calibration is None else cfg_pa
+    lower, upper = int(opts["lower_cut_off"]), int(opts["upper_cut_off"])
+    if calibration is not None:
+        # cut-offs are applied to the raw signal, before it is converted
+        lower, upper = calibration.to_raw(lower), calibration.to_raw(upper)
+    keep_index, y_data = minmax_downsample(
+        y_data, n_bins=n_bins, lower=lower, upper=upper
+    )
+    if calibration is not None:
+        # only the points that are drawn are converted
+        y_data = calibration.to_pa(y_data)
+    return keep_index, y_data
 
+
+def signal_calibration(settings, app_vars):
+    """Return the Calibration to draw the signal in pA with, None for raw"""
+    if not settings["toggle_pa"]:
+        return None
+    return app_vars.get("calibration")
+
+
+def update_y_range(wdg):
+    """Fit the y axis to the signal, or to the fixed range if it is set"""
+    y_range = app_data["figure"].y_range
     if wdg["toggle_y_axis"].active:
-        p.y_range = Range1d(int(wdg["po_y_min"].value), int(wdg["po_y_max"].value))
-    if wdg["toggle_annotations"].active:
-        # Map modal_classifications onto df
-        app_data["label_df"]["mc_active_map"] = app_data["label_df"][
-            "modal_classification"
-        ].map(app_data["label_mp"])
-        app_data["label_df"]["mc_label_map"] = app_data["label_df"][
-            "modal_classification"
-        ].map(app_data["label_dt"])
-        # Here labels are thinned out
-        slim_label_df = app_data["label_df"][
-            (app_data["label_df"]["read_start"] >= app_vars["start_time"])
-            & (app_data["label_df"]["read_start"] <= app_vars["end_time"])
-        ]
-        # Use pd.isin to remove unwanted annotations from the slimmed df
-        slim_label_df = slim_label_df[
-            slim_label_df["mc_active_map"].isin(wdg["label_filter"].active) == True
-        ]
-        # get coordinates and vstack them to produce [[x, x], [x, x]...]
-        line_x_values = np.vstack(
-            (slim_label_df["read_start"].values, slim_label_df["read_start"].values)
-        ).T
-        tmp_list = np.full((1, len(line_x_values)), -10000)
-        line_y_values = np.vstack((tmp_list, tmp_list * -1)).T
-        # Add all vertical lines as multi_line
-        p.multi_line(
-            line_x_values.tolist(),
-            line_y_values.tolist(),
-            line_dash="dashed",
-            color="green",
-            line_width=1,
-        )
-        # combine series to form label
-        slim_label_df["label"] = (
-            slim_label_df["mc_label_map"]
-            + " - "
-            + slim_label_df["read_id"].astype("str")
-        )
-        # Create ColumnDataSource combining labels and coordinates
-        label_source = ColumnDataSource(
-            data=dict(
-                x=slim_label_df["read_start"].values,
-                y=np.full((len(slim_label_df), 1), int(wdg["label_height"].value)),
-                t=slim_label_df["label"].values,
-            )
+        y_range.update(start=int(wdg["po_y_min"].value), end=int(wdg["po_y_max"].value))
+        return
+    fit_y_range(y_range, app_data["sources"]["signal"].data["y"])
+
+
+def mapping_data(settings, app_vars, bmf):
+    """Return the mapping source data, bmf mappings overlapping the window
+
+    Like annotations, mappings are culled to the width of the plot: lines
+    less than a pixel apart are drawn once and mappings starting within
+    LABEL_PIXELS of each other share one counted label.
+    """
+    sources = {}
+    if bmf is None:
+        for name in ["forward_v", "reverse_v", "forward_h", "reverse_h"]:
+            sources[name] = vline([], 0, 0)
+        sources["mapping_labels"] = dict(start_time=[], height=[], label=[], offset=[])
+        return sources
+    # set mapping track midpoints, the offsets are in raw units
+    calibration = signal_calibration(settings, app_vars)
+    scale = 1 if calibration is None else calibration.scale
+    lower_mapping = settings["label_height"] + 750 * scale
+    # Select mappings on this channel overlapping the current viewed range
+    slim_bmf = bmf.overlapping(
+        app_vars["channel_num"], app_vars["start_time"], app_vars["end_time"]
+    ).copy()
+    slim_bmf["start_time"] = slim_bmf["start_time"].where(
+        slim_bmf["start_time"] > app_vars["start_time"], app_vars["start_time"]
+    )
+    slim_bmf["end_time"] = slim_bmf["end_time"].where(
+        slim_bmf["end_time"] < app_vars["end_time"], app_vars["end_time"]
+    )
+
+    x_range = (app_vars["start_time"], app_vars["end_time"])
+    plot_width = settings["po_width"]
+    starts = slim_bmf["start_time"].to_numpy(dtype=np.float64)
+    first, counts = cull(starts, x_range, max(plot_width // LABEL_PIXELS, 1))
+    labels = slim_bmf["label"].to_numpy()[first]
+    sources["mapping_labels"] = dict(
+        start_time=starts[first],
+        height=np.full(len(first), lower_mapping, dtype=np.float64),
+        label=[
+            label if n == 1 else "{n} mappings".format(n=n)
+            for label, n in zip(labels, counts)
+        ],
+        offset=np.full(len(first), 5, dtype=np.float64),
+    )
+    for name, strand in [("forward", "+"), ("reverse", "-")]:
+        strand_bmf = slim_bmf[slim_bmf["strand"] == strand]
+        x_start = strand_bmf["start_time"].to_numpy(dtype=np.float64)
+        x_end = strand_bmf["end_time"].to_numpy(dtype=np.float64)
+        # Vertical lines at the start and end of each mapping
+        x_v = np.concatenate([x_start, x_end])
+        keep = cull_segments(x_v, x_v, x_range, plot_width)
+        sources[name + "_v"] = vline(
+            x_v[keep], lower_mapping + 20 * scale, lower_mapping - 20 * scale
         )
-        # Add all labels as a label set
-        labels = LabelSet(
-            x="x",
-            y="y",
-            text="t",
-            level="glyph",
-            x_offset=0,
-            y_offset=0,
-            source=label_source,
-            render_mode="canvas",
-            angle=-270,
-            angle_units="deg",
+        # Horizontal lines
+        keep = cull_segments(x_start, x_end, x_range, plot_width)
+        sources[name + "_h"] = hlines(lower_mapping, x_start[keep], x_end[keep])
+    return sources
+
+
+def annotation_data(settings, app_vars, annotations, label_mp):
+    """Return the annotation source data, checked event types in the window"""
+    # Select the events in this window whose type is checked in the filter
+    active_codes = [
+        code for code, k in label_mp.items() if k in settings["label_filter"]
+    ]
+    label_index = annotations.window(
+        app_vars["start_squiggle"], app_vars["end_squiggle"], codes=active_codes
+    )
+    sf = app_vars["sf"]
+    return annotation_source_data(
+        annotations,
+        label_index,
+        sf,
+        settings["label_height"],
+        (app_vars["start_squiggle"] / sf, app_vars["end_squiggle"] / sf),
+        settings["po_width"],
+    )
+
+
+def zoom_changed(attr, old, new):
+    """Cull the annotations and mappings again once the plot stops moving"""
+    cancel_recull()
+    app_data["recull"] = curdoc().add_timeout_callback(recull, RECULL_DELAY)
+
+
+def cancel_recull():
+    if app_data.get("recull") is not None:
+        try:
+            curdoc().remove_timeout_callback(app_data["recull"])
+        except ValueError:
+            pass
+        app_data["recull"] = None
+
+
+def visible_vars(app_vars):
+    """Return app_vars for the part of the window the plot shows
+
+    Annotations and mappings drawn for these are culled to the pixels they
+    take up at the current zoom. The whole window is returned while the plot
+    follows a live file, or before the browser has reported its range.
+    """
+    x_range = app_data["figure"].x_range
+    if (
+        app_data["wdg_dict"]["toggle_live"].active
+        or x_range.start is None
+        or x_range.end is None
+    ):
+        return app_vars
+    sf = app_vars["sf"]
+    start = max(x_range.start, app_vars["start_squiggle"] / sf)
+    end = min(x_range.end, app_vars["end_squiggle"] / sf)
+    if end <= start:
+        return app_vars
+    return dict(
+        app_vars,
+        start_time=start,
+        end_time=end,
+        start_squiggle=math.floor(start * sf),
+        end_squiggle=math.ceil(end * sf),
+    )
+
+
+@profiled("recull", profile_tags)
+def recull():
+    """Send the annotations and mappings culled for the visible range"""
+    app_data["recull"] = None
+    wdg = app_data["wdg_dict"]
+    if wdg["toggle_live"].active:
+        # streamed annotations would be lost, a live plot moves on anyway
+        return
+    visible = visible_vars(app_data["app_vars"])
+    sf = visible["sf"]
+    culled = (visible["start_squiggle"] / sf, visible["end_squiggle"] / sf)
+    if culled == app_data.get("culled"):
+        return
+    app_data["culled"] = culled
+    settings = plot_settings(wdg)
+    data = mapping_data(settings, visible, app_data.get("bmf"))
+    data.update(
+        annotation_data(
+            settings, visible, app_data["annotations"], app_data["label_mp"]
         )
-        p.add_layout(labels)
+    )
+    set_sources(data)
 
-    return column(p, css_classes=["plot_div"])
 
+def update_visibility(wdg):
+    """Show or hide the annotation and mapping renderers"""
+    for renderer in app_data["renderers"]["annotations"]:
+        renderer.visible = wdg["toggle_annotations"].active
+    for renderer in app_data["renderers"]["mappings"]:
+        renderer.visible = wdg["toggle_mappings"].active
 
+
+@profiled("is_input_int", profile_tags)
 def is_input_int(attr, old, new):
     try:
         int(new)
@@ -935,16 +1153,78 @@ def is_input_int(attr, old, new):
                 return
 
     new = new.lstrip("0")
-    update()
+    if not app_data["batch_inputs"]:
+        update()
+
+
+@profiled("toggle_visibility", profile_tags)
+def toggle_visibility(state):
+    update_visibility(app_data["wdg_dict"])
+
 
+@profiled("toggle_y_axis", profile_tags)
+def toggle_y_axis(state):
+    update_y_range(app_data["wdg_dict"])
 
-def toggle_button(state):
-    layout.children[1] = create_figure(
-        app_data["x_data"],
-        app_data["y_data"],
-        app_data["wdg_dict"],
-        app_data["app_vars"],
+
+@profiled("toggle_smoothing", profile_tags)
+def toggle_smoothing(state):
+    if state == app_data["smoothed"]:
+        return
+    wdg, app_vars = app_data["wdg_dict"], app_data["app_vars"]
+    live = wdg["toggle_live"].active
+    if live:
+        # a live window has moved on since it was loaded, so is read again
+        stop_live()
+        app_data["y_data"] = app_data["envelope"] = None
+
+    # the job works on a copy, the raw window it reads is kept in show_signal
+    bulkfile, app_vars = app_data["bulkfile"], dict(app_vars)
+    settings = plot_settings(wdg)
+    window = {k: app_data[k] for k in ["envelope", "y_data"]}
+
+    def work():
+        # without smoothing the raw window may need to be read
+        if (not state or window["envelope"] is None) and window["y_data"] is None:
+            window["y_data"] = load_raw_window(bulkfile, app_vars)
+        return window["y_data"], signal_data(settings, app_vars, window, state)
+
+    def show_signal(result):
+        app_data["y_data"], data = result
+        set_sources(data)
+        app_data["smoothed"] = state
+        if live:
+            start_live()
+
+    jobs.submit("signal", work, show_signal, replaces=["live"] if live else ())
+
+
+@profiled("toggle_units", profile_tags)
+def toggle_units(state):
+    """Switch the signal between raw values and pA, with the unit's defaults"""
+    set_unit_defaults(
+        signal_calibration(plot_settings(app_data["wdg_dict"]), app_data["app_vars"])
     )
+    update()
+
+
+def set_unit_defaults(calibration):
+    """Set the y range and label height inputs for the units the signal is drawn in
+
+    calibration is from signal_calibration, None for raw values.
+    """
+    opts = cfg_po if calibration is None else cfg_pa
+    wdg = app_data["wdg_dict"]
+    app_data["batch_inputs"] = True
+    try:
+        for name, key in [
+            ("po_y_min", "y_min"),
+            ("po_y_max", "y_max"),
+            ("label_height", "label_height"),
+        ]:
+            wdg[name].value = opts[key]
+    finally:
+        app_data["batch_inputs"] = False
 
 
 def input_error(widget, mode):
@@ -958,98 +1238,355 @@ def input_error(widget, mode):
         print("mode not recognised")
 
 
+@profiled("update", profile_tags)
 def update():
-    update_data(app_data["bulkfile"], app_data["app_vars"])
+    """Load the current window in the worker pool, then draw it"""
+    bulkfile, pyramid = app_data["bulkfile"], app_data["pyramid"]
+    app_vars = dict(app_data["app_vars"])
+    plot_width = get_plot_width()
+    init = app_data["INIT"]
+    # the first window of a file is drawn before its widgets are built
+    settings = None if init else plot_settings(app_data["wdg_dict"])
+    bmf, label_mp = app_data.get("bmf"), app_data.get("label_mp")
+    # the file may grow before the window is loaded, a live plot keeps
+    # following a window that reached the end when it was asked for
+    at_end = app_vars["end_time"] >= app_vars["len_ds"]
+
+    def work():
+        window = load_window(bulkfile, pyramid, app_vars, plot_width)
+        window["at_end"] = at_end
+        # the plot is always drawn smoothed after moving, see show_window
+        if not init:
+            window["sources"] = figure_data(
+                settings, window["app_vars"], window, True, bmf, label_mp
+            )
+        return window
+
+    jobs.submit("window", work, show_window, replaces=["signal", "live"])
+
+
+# loading the window is timed as job_seconds{kind="window"}
+@timed(callback_seconds, callback="show_window")
+@profiled("show_window", profile_tags)
+def show_window(window):
+    """Apply a window from load_window to app_data and draw it"""
+    data = window.pop("sources", None)
+    at_end = window.pop("at_end")
+    app_data.update(window)
     if app_data["INIT"]:
         build_widgets()
         layout.children[0] = column(
             list(app_data["wdg_dict"].values()), width=int(cfg_po["wdg_width"])
         )
+        app_data["pore_plt"] = create_figure(app_data["wdg_dict"], app_data["app_vars"])
+        layout.children[1] = plot_panel()
         app_data["INIT"] = False
     app_data["wdg_dict"]["duration"].text = "Duration: {d} seconds".format(
         d=app_data["app_vars"]["duration"]
     )
-    app_data["wdg_dict"]["toggle_smoothing"].active = True
-    layout.children[1] = create_figure(
-        app_data["x_data"],
-        app_data["y_data"],
-        app_data["wdg_dict"],
-        app_data["app_vars"],
+    # a channel without a calibration can only be drawn in raw units
+    toggle_pa = app_data["wdg_dict"]["toggle_pa"]
+    calibrated = app_data["app_vars"]["calibration"] is not None
+    if toggle_pa.disabled == calibrated:
+        toggle_pa.disabled = not calibrated
+        if toggle_pa.active:
+            set_unit_defaults(app_data["app_vars"]["calibration"])
+            # labels are placed at the label height, so are drawn again
+            data = None
+    if not app_data["wdg_dict"]["toggle_smoothing"].active:
+        # the signal is redrawn below, toggle_smoothing need not load it
+        app_data["smoothed"] = True
+        app_data["wdg_dict"]["toggle_smoothing"].active = True
+    update_figure(app_data["wdg_dict"], app_data["app_vars"], data)
+    schedule_prefetch(app_data["app_vars"])
+    if app_data["wdg_dict"]["toggle_live"].active:
+        if not at_end:
+            # the user has moved away from the end of the channel
+            app_data["wdg_dict"]["toggle_live"].active = False
+        else:
+            start_live()
+
+
+def schedule_prefetch(app_vars):
+    """Read the windows around the current one into the cache in the background
+
+    Only raw windows are prefetched, windows drawn from the pyramid are cheap.
+    """
+    if app_data["envelope"] is not None:
+        return
+    sf = app_vars["sf"]
+    events = []
+    for _, code in app_data["wdg_dict"]["jump_next"].menu:
+        events.append(
+            app_data["annotations"].next_event(
+                int(code), (app_vars["start_time"] + 1) * sf
+            )
+        )
+        events.append(
+            app_data["annotations"].previous_event(
+                int(code), app_vars["start_time"] * sf
+            )
+        )
+    # a jump moves the window to the start of the second holding the event
+    events = [math.floor(e / sf) * sf for e in events if e is not None]
+    prefetcher.schedule(
+        curdoc(),
+        app_data["file_src"],
+        neighbour_windows(
+            app_vars["channel_str"],
+            app_vars["start_squiggle"],
+            app_vars["end_squiggle"],
+            events,
+        ),
+    )
+
+
+@profiled("toggle_live", profile_tags)
+def toggle_live(state):
+    """Follow the end of the current channel as the file grows"""
+    if not state:
+        stop_live()
+        return
+    # annotations indexed before the file grew are rebuilt
+    annotation_store.discard_file(app_data["file_src"])
+    app_vars = app_data["app_vars"]
+    length = refresh_length(app_data["bulkfile"], app_vars["channel_str"])
+    end_time = max(math.ceil(length / app_vars["sf"]), app_vars["duration"])
+    position = "{ch}:{start}-{end}".format(
+        ch=app_vars["channel_num"], start=end_time - app_vars["duration"], end=end_time
+    )
+    app_vars["len_ds"] = length / app_vars["sf"]
+    if app_data["wdg_dict"]["position"].value == position:
+        update()
+    else:
+        app_data["wdg_dict"]["position"].value = position
+
+
+def start_live():
+    """Start polling for new signal, states and reads after the window just drawn"""
+    stop_live()
+    generation = app_data["live"]["generation"] + 1 if app_data.get("live") else 0
+    app_vars = app_data["app_vars"]
+    smoothing = app_data["wdg_dict"]["toggle_smoothing"].active
+    samples = app_vars["end_squiggle"] - app_vars["start_squiggle"]
+    plot_width = get_plot_width()
+    app_data["live"] = {
+        # samples and StateData rows already drawn
+        "length": min(
+            app_vars["end_squiggle"], int(app_vars["len_ds"] * app_vars["sf"])
+        ),
+        "states": app_data["annotations"].n_states,
+        "reads": app_data["annotations"].n_reads,
+        # new samples are binned like the window, keeping its width in points
+        "bin_size": samples / plot_width if smoothing else None,
+        "points": 2 * plot_width if smoothing else samples,
+        "origin": app_data["x_transform"].args["start"],
+        "delay": float(cfg_dr["live_interval"]),
+        "callback": None,
+        # polls made before the window was last redrawn are ignored
+        "generation": generation,
+    }
+    schedule_live()
+
+
+def schedule_live():
+    live = app_data["live"]
+    live["callback"] = curdoc().add_timeout_callback(
+        poll_live, int(live["delay"] * 1000)
     )
 
 
+def stop_live():
+    live = app_data.get("live")
+    if live and live["callback"] is not None:
+        try:
+            curdoc().remove_timeout_callback(live["callback"])
+        except ValueError:
+            pass
+        live["callback"] = None
+
+
+@profiled("poll_live", profile_tags)
+def poll_live():
+    """Read whatever was appended to the channel since the last poll"""
+    live = app_data["live"]
+    live["callback"] = None
+    if not app_data["wdg_dict"]["toggle_live"].active:
+        return
+    bulkfile, app_vars = app_data["bulkfile"], dict(app_data["app_vars"])
+    length, n_states, n_reads = live["length"], live["states"], live["reads"]
+    generation = live["generation"]
+
+    def work():
+        channel_str = app_vars["channel_str"]
+        new = {"length": refresh_length(bulkfile, channel_str)}
+        new["y"] = read_signal(
+            bulkfile, channel_str, length, new["length"], cache=signal_cache
+        )
+        states = bulkfile["StateData"][channel_str]["States"]
+        reads = bulkfile["IntermediateData"][channel_str]["Reads"]
+        if bulkfile.swmr_mode:
+            states.refresh()
+            reads.refresh()
+        new["states"], new["reads"] = len(states), len(reads)
+        # states and reads recorded since the last poll, as in ChannelAnnotations
+        times, codes, read_ids = [], [], []
+        if len(states) > n_states:
+            rows = states[n_states:]
+            times.append(rows["acquisition_raw_index"])
+            codes.append(rows["summary_state"])
+            read_ids.append(np.full(len(rows), "", dtype=object))
+        if len(reads) > n_reads:
+            rows = read_events(reads[n_reads:])
+            times.append(rows["read_start"].to_numpy())
+            codes.append(rows["modal_classification"].to_numpy())
+            read_ids.append(rows["read_id"].str.decode("utf8").to_numpy(dtype=object))
+        new["events"] = None
+        if times:
+            new["events"] = tuple(map(np.concatenate, [times, codes, read_ids]))
+        new["generation"] = generation
+        return new
+
+    jobs.submit("live", work, show_live, failed=lambda e: schedule_live())
+
+
+@profiled("show_live", profile_tags)
+def show_live(new):
+    """Append newly recorded signal, states and reads to the plot
+
+    Sources are appended to with stream, so only the new points are sent to
+    the browser. The poll interval doubles while nothing changes, up to
+    live_max_interval, and goes back to live_interval once something does.
+    """
+    live, wdg = app_data["live"], app_data["wdg_dict"]
+    if new["generation"] != live["generation"]:
+        return
+    app_vars, sf = app_data["app_vars"], app_data["app_vars"]["sf"]
+    grew = len(new["y"]) > 0 or new["events"] is not None
+    if len(new["y"]):
+        first = live["length"]
+        n_bins = None
+        if live["bin_size"]:
+            n_bins = max(math.ceil(len(new["y"]) / live["bin_size"]), 1)
+        keep_index, y_data = downsample_signal(
+            plot_settings(wdg), app_vars, new["y"], n_bins
+        )
+        app_data["sources"]["signal"].stream(
+            {
+                "x": (keep_index + first - live["origin"]).astype(np.int32),
+                "y": y_data,
+            },
+            rollover=live["points"],
+        )
+        count_points("signal", {"y": y_data})
+        live["length"] = new["length"]
+        # the window slides along with the end of the signal
+        samples = app_vars["end_squiggle"] - app_vars["start_squiggle"]
+        app_vars["end_squiggle"] = new["length"]
+        app_vars["start_squiggle"] = max(new["length"] - samples, 0)
+        # as asked for by toggle_live, so reloading the window stays live
+        app_vars["end_time"] = math.ceil(new["length"] / sf)
+        app_vars["start_time"] = app_vars["end_time"] - app_vars["duration"]
+        app_vars["len_ds"] = new["length"] / sf
+        app_data["titles"]["position"].text = (
+            "Channel: {ch} Start: {st} End: {ed} Sample rate: {sf}".format(
+                ch=app_vars["channel_num"],
+                st=app_vars["start_time"],
+                ed=app_vars["end_time"],
+                sf=sf,
+            )
+        )
+    live["states"], live["reads"] = new["states"], new["reads"]
+    if new["events"] is not None:
+        active_codes = [
+            code
+            for code, k in app_data["label_mp"].items()
+            if k in wdg["label_filter"].active
+        ]
+        events = ChannelAnnotations(*new["events"], labels=app_data["label_dt"])
+        keep = np.flatnonzero(np.isin(events.codes, active_codes))
+        label_x = events.times[keep] / sf
+        app_data["sources"]["annotation_lines"].stream(
+            vline(label_x, LINE_EXTENT, -LINE_EXTENT), rollover=LIVE_ANNOTATIONS
+        )
+        app_data["sources"]["annotation_labels"].stream(
+            dict(
+                x=label_x,
+                y=np.full(len(label_x), int(wdg["label_height"].value)),
+                t=events.label_text(keep),
+            ),
+            rollover=LIVE_ANNOTATIONS,
+        )
+        count_points("annotation_labels", {"x": label_x})
+    if grew:
+        live["delay"] = float(cfg_dr["live_interval"])
+    else:
+        live["delay"] = min(live["delay"] * 2, float(cfg_dr["live_max_interval"]))
+    schedule_live()
+
+
 def update_other(attr, old, new):
     update()
 
 
+@profiled("update_toggle", profile_tags)
 def update_toggle(attr, old, new):
+    # label_filter's callback redraws the annotations
     if new == 0:
         app_data["wdg_dict"]["label_filter"].active = list(
             np.arange(0, len(app_data["wdg_dict"]["label_filter"].labels), 1)
         )
     elif new == 1:
         app_data["wdg_dict"]["label_filter"].active = []
-    update()
 
 
+@profiled("update_checkboxes", profile_tags)
 def update_checkboxes(attr, old, new):
     if len(new) != len(app_data["wdg_dict"]["label_filter"].labels) and len(new) != 0:
         app_data["wdg_dict"]["filter_toggle_group"].active = None
-    update()
+    set_sources(
+        annotation_data(
+            plot_settings(app_data["wdg_dict"]),
+            visible_vars(app_data["app_vars"]),
+            app_data["annotations"],
+            app_data["label_mp"],
+        )
+    )
 
 
+@profiled("next_update", profile_tags)
 def next_update(value):
     value = int(value.item)
-    jump_start = app_data["label_df"][
-        (app_data["label_df"]["read_start"] > app_data["app_vars"]["start_time"] + 1)
-        & (app_data["label_df"]["modal_classification"] == value)
-    ]
-    try:
-        app_data["app_vars"]["start_time"] = int(
-            math.floor(jump_start["read_start"].iloc[0])
-        )
-    except IndexError:
+    jump_start = app_data["annotations"].next_event(
+        value, (app_data["app_vars"]["start_time"] + 1) * app_data["app_vars"]["sf"]
+    )
+    if jump_start is None:
         app_data["wdg_dict"]["duration"].text += "\n{ev} event not found".format(
             ev=app_data["label_dt"][value]
         )
         return
-    except Exception as e:
-        print(type(e))
-        print(e)
-    app_data["app_vars"]["end_time"] = (
-        app_data["app_vars"]["start_time"] + app_data["app_vars"]["duration"]
-    )
-    app_data["wdg_dict"]["position"].value = "{ch}:{start}-{end}".format(
-        ch=app_data["app_vars"]["channel_num"],
-        start=app_data["app_vars"]["start_time"],
-        end=app_data["app_vars"]["end_time"],
-    )
-    layout.children[1] = create_figure(
-        app_data["x_data"],
-        app_data["y_data"],
-        app_data["wdg_dict"],
-        app_data["app_vars"],
-    )
+    jump_to(jump_start)
 
 
+@profiled("prev_update", profile_tags)
 def prev_update(value):
     value = int(value.item)
-    jump_start = app_data["label_df"][
-        (app_data["label_df"]["read_start"] < app_data["app_vars"]["start_time"])
-        & (app_data["label_df"]["modal_classification"] == value)
-    ]
-    try:
-        app_data["app_vars"]["start_time"] = int(
-            math.floor(jump_start["read_start"].iloc[-1])
-        )
-    except IndexError:
+    jump_start = app_data["annotations"].previous_event(
+        value, app_data["app_vars"]["start_time"] * app_data["app_vars"]["sf"]
+    )
+    if jump_start is None:
         app_data["wdg_dict"]["duration"].text += "\n{ev} event not found".format(
             ev=app_data["label_dt"][value]
         )
         return
-    except Exception as e:
-        print(type(e))
-        print(e)
+    jump_to(jump_start)
+
+
+def jump_to(sample):
+    """Move the current window, keeping its duration, to start at a sample"""
+    app_data["app_vars"]["start_time"] = int(
+        math.floor(sample / app_data["app_vars"]["sf"])
+    )
     app_data["app_vars"]["end_time"] = (
         app_data["app_vars"]["start_time"] + app_data["app_vars"]["duration"]
     )
@@ -1058,14 +1595,9 @@ def prev_update(value):
         start=app_data["app_vars"]["start_time"],
         end=app_data["app_vars"]["end_time"],
     )
-    layout.children[1] = create_figure(
-        app_data["x_data"],
-        app_data["y_data"],
-        app_data["wdg_dict"],
-        app_data["app_vars"],
-    )
 
 
+@profiled("export_data", profile_tags)
 def export_data():
     try:
         start_val = math.floor(
@@ -1075,87 +1607,93 @@ def export_data():
     except KeyError:
         start_val = app_data["app_vars"]["start_squiggle"]
         end_val = app_data["app_vars"]["end_squiggle"]
-    if (
-        export_read_file(
-            app_data["app_vars"]["channel_num"],
-            start_val,
-            end_val,
-            app_data["bulkfile"],
-            cfg_dr["out"],
-        )
-        == 0
-    ):
-        app_data["wdg_dict"]["duration"].text += "\nread file created"
-    else:
-        app_data["wdg_dict"]["duration"].text += "\nError: read file not created"
-
-
-app_data = {
-    "file_src": None,  # bulkfile path (string)
-    "bulkfile": None,  # bulkfile object
-    "bmf": None,  # bmf dataframe
-    "x_data": None,  # numpy ndarray time points
-    "y_data": None,  # numpy ndarray signal data
-    "label_df": None,  # pandas df of signal labels
-    "label_dt": None,  # dict of signal enumeration
-    "label_mp": None,  # dict matching labels to widget filter
-    "app_vars": {  # dict of variables used in plots and widgets
-        "len_ds": None,  # length of signal dataset
-        "start_time": None,  # squiggle start time in seconds
-        "end_time": None,  # squiggle end time in seconds
-        "duration": None,  # squiggle duration in seconds
-        "start_squiggle": None,  # squiggle start position (samples)
-        "end_squiggle": None,  # squiggle end position (samples)
-        "channel_str": None,  # 'Channel_NNN' (string)
-        "channel_num": None,  # Channel number (int)
-        "sf": None,  # sample frequency (int)
-        "attributes": None,  # OrderedDict of bulkfile attr info
-    },
-    "wdg_dict": None,  # dictionary of widgets
-    "controls": None,  # widgets added to widgetbox
-    "pore_plt": None,  # the squiggle plot
-    "INIT": True,  # Initial plot with bulkfile (bool)
-}
+    file_src, channel_num = app_data["file_src"], app_data["app_vars"]["channel_num"]
+
+    def work():
+        with file_pool.borrow(file_src) as bulkfile:
+            return export_read_file(
+                channel_num,
+                start_val,
+                end_val,
+                bulkfile,
+                cfg_dr["out"],
+                compression=cfg_dr["compression"],
+                chunk_size=cfg_dr.getint("chunk_size"),
+            )
+
+    def show_status(status):
+        if status == 0:
+            app_data["wdg_dict"]["duration"].text += "\nread file created"
+        else:
+            app_data["wdg_dict"]["duration"].text += "\nError: read file not created"
+
+    jobs.submit("export", work, show_status, failed=lambda e: show_status(1))
+
+
+def session_data():
+    """Return the initial state of a session, also used when a file is opened"""
+    return {
+        "file_src": None,  # bulkfile path (string)
+        "bulkfile": None,  # bulkfile object
+        "bmf": None,  # bmf MappingIndex
+        "pyramid": None,  # pyramid sidecar file object
+        "envelope": None,  # (x, y) min/max envelope from the pyramid
+        "y_data": None,  # numpy ndarray raw signal of the window
+        "annotations": None,  # ChannelAnnotations of the current channel
+        "label_dt": None,  # dict of signal enumeration
+        "label_mp": None,  # dict matching labels to widget filter
+        "smoothed": None,  # whether the signal source is drawn smoothed (bool)
+        "live": None,  # state of the live tail, see start_live
+        "app_vars": {  # dict of variables used in plots and widgets
+            "len_ds": None,  # length of signal dataset
+            "start_time": None,  # squiggle start time in seconds
+            "end_time": None,  # squiggle end time in seconds
+            "duration": None,  # squiggle duration in seconds
+            "start_squiggle": None,  # squiggle start position (samples)
+            "end_squiggle": None,  # squiggle end position (samples)
+            "channel_str": None,  # 'Channel_NNN' (string)
+            "channel_num": None,  # Channel number (int)
+            "sf": None,  # sample frequency (int)
+            "calibration": None,  # Calibration of the channel to pA, or None
+            "attributes": None,  # OrderedDict of bulkfile attr info
+        },
+        "wdg_dict": None,  # dictionary of widgets
+        "controls": None,  # widgets added to widgetbox
+        "pore_plt": None,  # the squiggle plot
+        "overview": None,  # Overview of channel states in the current file
+        "overview_plt": None,  # the channel overview plot
+        "stats": None,  # ChannelStats of the current file
+        "stats_plt": None,  # the channel statistics table
+        "figure": None,  # the persistent bokeh figure for the current file
+        "sources": None,  # dict of ColumnDataSources feeding the figure
+        "x_transform": None,  # CustomJSTransform from sample offsets to seconds
+        "culled": None,  # (start, end) seconds annotations and mappings are culled to
+        "recull": None,  # pending timeout callback of zoom_changed
+        "renderers": None,  # dict of renderers, for toggling visibility
+        "titles": None,  # dict of figure titles
+        "INIT": True,  # Initial plot with bulkfile (bool)
+        "batch_inputs": False,  # inputs are being set together, update once after
+    }
+
+
+app_data = session_data()
 
 int_inputs = ["po_width", "po_height", "po_y_min", "po_y_max", "label_height"]
-toggle_inputs = ["toggle_y_axis", "toggle_annotations", "toggle_smoothing"]
 
-app_data["app_vars"]["files"] = []
-p = Path(cfg_dr["dir"])
-app_data["app_vars"]["files"] = [
-    (x.name, x.name) for x in p.iterdir() if x.suffix == ".fast5"
-]
+# Bulk files are validated once per process, with the results kept in a
+# manifest, and new files are picked up by polling the directory
+bulk_dir = get_bulk_directory(cfg_dr["dir"])
+bulk_dir.start_watching(int(cfg_dr["poll_interval"]))
+app_data["app_vars"]["files"] = [(x, x) for x in bulk_dir.files()]
+app_data["app_vars"]["files"].insert(0, ("", "--"))
 m = Path(cfg_dr["map"])
 app_data["app_vars"]["map_files"] = [
     (x.name, x.name) for x in m.iterdir() if x.suffix == ".bmf"
 ]
 app_data["app_vars"]["map_files"].insert(0, ("", "--"))
-# check files are useable by h5py
-for index, file in enumerate(app_data["app_vars"]["files"]):
-    file = file[0]
-    try:
-        bulk_file = h5py.File(Path(Path(cfg_dr["dir"]) / file), "r")
-    except OSError:
-        app_data["app_vars"]["files"][index] = None
-        continue
-    try:
-        try_path = bulk_file["Raw"]
-    except KeyError:
-        app_data["app_vars"]["files"][index] = None
-        continue
-    for i, channel in enumerate(try_path):
-        if i == 0:
-            try:
-                try_path[channel]["Signal"][0]
-            except KeyError:
-                app_data["app_vars"]["files"][index] = None
-        break
-    bulk_file.flush()
-    bulk_file.close()
-app_data["app_vars"]["files"] = list(
-    filter((None).__ne__, app_data["app_vars"]["files"])
-)
-app_data["app_vars"]["files"].insert(0, ("", "--"))
+
+# Slow work for this session runs in the shared worker pool, one job at a time
+jobs = SessionJobs(curdoc(), on_busy=show_loading, profile_tags=profile_tags)
 
 app_data["wdg_dict"] = init_wdg_dict()
 app_data["controls"] = column(
@@ -1176,3 +1714,23 @@ layout = row(app_data["controls"], app_data["pore_plt"])
 
 curdoc().add_root(layout)
 curdoc().title = "bulkvis"
+curdoc().add_periodic_callback(refresh_file_list, int(cfg_dr["poll_interval"]) * 1000)
+
+
+def close_session(session_context, doc=curdoc()):
+    """Stop prefetching for a closed session and give back its file handles"""
+    sessions.dec()
+    prefetcher.cancel(doc)
+    jobs.reset()
+    stop_live()
+    file_pool.release(app_data["bulkfile"])
+    app_data["bulkfile"] = None
+    if app_data.get("pyramid"):
+        app_data["pyramid"].close()
+        app_data["pyramid"] = None
+
+
+curdoc().on_session_destroyed(close_session)
+sessions.inc()
+# with several server processes, each shares its metrics for /metrics
+start_sharing()
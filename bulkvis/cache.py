@@ -0,0 +1,176 @@
+"""cache.py
+
+Process wide, thread-safe cache of raw signal chunks. Bokeh runs every
+session of the viewer in the same process, so sessions browsing the same
+bulk file share chunks instead of each reading them from disk. Derived data
+that is worth sharing between processes is kept in the cache directory.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import threading
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from bulkvis.metrics import CallbackMetric
+
+# Number of samples in each cached chunk, about a minute of signal at 4 kHz
+CHUNK_SIZE = 1 << 18
+# Memory budget for cached signal, can be set with BULKVIS_CACHE_MB
+DEFAULT_CACHE_MB = 512
+
+
+class ChunkCache:
+    """A least recently used cache of numpy arrays with a memory budget
+
+    Keys are (file, channel, chunk index) tuples. When adding a chunk takes
+    the cache over its budget the least recently used chunks are evicted.
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget in bytes, 0 disables caching
+    chunk_size : int
+        Number of samples in each chunk
+    """
+
+    def __init__(self, max_bytes, chunk_size=CHUNK_SIZE):
+        self.max_bytes = int(max_bytes)
+        self.chunk_size = int(chunk_size)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._chunks
+
+    def get(self, key):
+        """Return a cached chunk, or None if it is not cached"""
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                self.misses += 1
+                return None
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+    def put(self, key, chunk):
+        """Add a chunk to the cache, evicting old chunks to stay in budget
+
+        Cached arrays are made read-only as they are shared between sessions.
+        """
+        if chunk.nbytes > self.max_bytes:
+            return
+        chunk.flags.writeable = False
+        with self._lock:
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._chunks[key] = chunk
+            self.nbytes += chunk.nbytes
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used chunks until the cache is within budget"""
+        while self.nbytes > self.max_bytes and self._chunks:
+            _, chunk = self._chunks.popitem(last=False)
+            self.nbytes -= chunk.nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Change the memory budget, evicting chunks if it has shrunk"""
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def discard_file(self, filename):
+        """Remove every chunk belonging to a file"""
+        with self._lock:
+            for key in [k for k in self._chunks if k[0] == filename]:
+                self.nbytes -= self._chunks.pop(key).nbytes
+
+    def clear(self):
+        """Remove every chunk and reset the counters"""
+        with self._lock:
+            self._chunks.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dictionary of cache counters"""
+        with self._lock:
+            return {
+                "chunks": len(self._chunks),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _budget_from_env():
+    """Return the cache budget, in bytes, from BULKVIS_CACHE_MB"""
+    try:
+        mb = float(os.environ.get("BULKVIS_CACHE_MB", DEFAULT_CACHE_MB))
+    except ValueError:
+        mb = DEFAULT_CACHE_MB
+    return int(max(mb, 0) * 1024 * 1024)
+
+
+signal_cache = ChunkCache(_budget_from_env())
+for _name, _type, _key, _description in [
+    ("hits_total", "counter", "hits", "Signal chunks found in the cache"),
+    ("misses_total", "counter", "misses", "Signal chunks not found in the cache"),
+    ("evictions_total", "counter", "evictions", "Signal chunks evicted"),
+    ("bytes", "gauge", "bytes", "Bytes of signal held in the cache"),
+]:
+    CallbackMetric(
+        "bulkvis_signal_cache_" + _name,
+        _description,
+        _type,
+        lambda key=_key: signal_cache.stats()[key],
+    )
+
+
+def cache_dir():
+    """Return the directory for bulkvis' derived data, set with BULKVIS_CACHE_DIR"""
+    return Path(
+        os.environ.get("BULKVIS_CACHE_DIR", Path.home() / ".cache" / "bulkvis")
+    ).expanduser()
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a file, shared by every process using it
+
+    Used so that only one server process builds a piece of derived data while
+    the others wait and then read what it wrote. Where file locks are not
+    available, or the lock file cannot be created, this does not lock.
+    """
+    path = Path(path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fh = path.open("a")
+    except OSError:
+        yield
+        return
+    with fh:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh, fcntl.LOCK_UN)
@@ -0,0 +1,93 @@
+"""downsample.py
+
+Envelope preserving downsampling of signal for display
+"""
+import numpy as np
+
+
+def _fill_values(dtype):
+    """Return (high, low) sentinels for a dtype, these never win a min or max"""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return info.max, info.min
+    return np.inf, -np.inf
+
+
+def cut_off_mask(y, lower=None, upper=None):
+    """Return a boolean mask of values within [lower, upper], or None if unbounded"""
+    if lower is None and upper is None:
+        return None
+    if lower is None:
+        return y <= upper
+    if upper is None:
+        return y >= lower
+    return (y >= lower) & (y <= upper)
+
+
+def minmax_downsample(y, n_bins=None, lower=None, upper=None):
+    """Downsample a signal to the minimum and maximum of each bin
+
+    The signal is split into `n_bins` equal bins, about one per pixel, and
+    the minimum and maximum of each bin are kept in the order they occur.
+    Short excursions, like blockages, survive at any zoom level and the
+    output never has more than 2 * n_bins points. Values outside of
+    [lower, upper] are dropped in the same pass.
+    Parameters
+    ----------
+    y : numpy.ndarray
+        Evenly spaced signal values
+    n_bins : int or None
+        Number of bins, usually the plot width in pixels. If None, or the
+        signal is already short enough, only the cut-offs are applied
+    lower : int, float or None
+        Drop values less than this
+    upper : int, float or None
+        Drop values greater than this
+    Returns
+    -------
+    idx : numpy.ndarray
+        Indices into `y` of the points that were kept, ascending
+    values : numpy.ndarray
+        The signal values at `idx`
+    """
+    y = np.asarray(y)
+    n = len(y)
+    valid = cut_off_mask(y, lower, upper)
+    if n_bins is None or n <= 2 * n_bins:
+        idx = np.arange(n) if valid is None else np.flatnonzero(valid)
+        return idx, y[idx]
+
+    bin_len = -(-n // int(n_bins))
+    n_rows = -(-n // bin_len)
+    fill_hi, fill_lo = _fill_values(y.dtype)
+    lo = np.full(n_rows * bin_len, fill_hi, dtype=y.dtype)
+    hi = np.full(n_rows * bin_len, fill_lo, dtype=y.dtype)
+    if valid is None:
+        lo[:n] = y
+        hi[:n] = y
+    else:
+        np.copyto(lo[:n], y, where=valid)
+        np.copyto(hi[:n], y, where=valid)
+    lo = lo.reshape(n_rows, bin_len)
+    hi = hi.reshape(n_rows, bin_len)
+
+    rows = np.arange(n_rows)
+    i_min = lo.argmin(axis=1)
+    i_max = hi.argmax(axis=1)
+    v_min = lo[rows, i_min]
+    v_max = hi[rows, i_max]
+    # bins where every value was cut off have no valid min or max
+    keep = v_min <= v_max
+
+    min_first = i_min <= i_max
+    offset = rows * bin_len
+    idx = np.column_stack(
+        (
+            offset + np.where(min_first, i_min, i_max),
+            offset + np.where(min_first, i_max, i_min),
+        )
+    )[keep].ravel()
+    values = np.column_stack(
+        (np.where(min_first, v_min, v_max), np.where(min_first, v_max, v_min))
+    )[keep].ravel()
+    return idx, values
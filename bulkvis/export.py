@@ -0,0 +1,586 @@
+"""export.py
+
+Export many reads or regions from bulk FAST5 files as multi-read FAST5 files,
+for example to basecall the reads found by `bulkvis fuse`. Requests are
+sorted by channel and position and split into output files; each output file
+is written by a separate process that reads its channels' signal in order,
+in a few large hyperslabs, rather than once per read.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import logging
+import math
+import multiprocessing
+import os
+from pathlib import Path
+import re
+
+import h5py
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from bulkvis.handles import open_bulk
+from bulkvis.index import lookup, read_index
+from bulkvis.manifest import read_metadata
+from bulkvis.metrics import record_read
+from bulkvis.raw import CALIBRATION_ATTRIBUTES, clamp_window, signal_dataset
+
+LOGGER = logging.getLogger(__name__)
+MULTI_READ_VERSION = "2.0"
+SINGLE_READ_VERSION = 0.6
+# Requests closer than this many samples are read in one hyperslab
+SPAN_GAP = 1 << 20
+# Largest hyperslab read at once, in samples
+MAX_SPAN = 1 << 25
+# Samples copied at a time when streaming a read into an output file
+COPY_BLOCK = 1 << 20
+
+
+def parse_compression(spec):
+    """Return h5py create_dataset arguments for a compression option
+    Parameters
+    ----------
+    spec : str
+        'none', 'lzf', 'gzip' or 'gzip:LEVEL' where LEVEL is 0-9
+    Returns
+    -------
+    dict
+        compression and compression_opts
+    Raises
+    ------
+    argparse.ArgumentTypeError
+        If spec is not recognised
+    """
+    name, _, level = str(spec).lower().partition(":")
+    if name == "none" and not level:
+        return {"compression": None, "compression_opts": None}
+    if name == "lzf" and not level:
+        return {"compression": "lzf", "compression_opts": None}
+    if name == "gzip" and (not level or level.isdigit() and int(level) <= 9):
+        return {"compression": "gzip", "compression_opts": int(level or 4)}
+    raise argparse.ArgumentTypeError(
+        "compression must be none, lzf, gzip or gzip:LEVEL, not {s!r}".format(s=spec)
+    )
+
+
+def compression_option(spec):
+    """argparse type for compression options, returns spec once it is validated"""
+    parse_compression(spec)
+    return spec
+
+
+_help = "Export reads or regions from bulk FAST5 files to multi-read FAST5 files"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to export from", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "-c",
+        "--coords",
+        dict(
+            help="Files of regions to export, either a bulkvis fuse output with a "
+            "'coords' column or one 'channel:start-end' (seconds) per line",
+            nargs="+",
+            default=[],
+            metavar="FILE",
+        ),
+    ),
+    (
+        "-r",
+        "--read-ids",
+        dict(
+            help="Files of read ids to export, one per line or a tab separated file "
+            "with a 'read_id' column. Reads are found with the read id index if "
+            "there is one (see 'bulkvis index')",
+            nargs="+",
+            default=[],
+            metavar="FILE",
+        ),
+    ),
+    (
+        "-o",
+        "--output",
+        dict(help="Output directory", required=True, metavar="DIR"),
+    ),
+    (
+        "-n",
+        "--batch-size",
+        dict(
+            help="Number of reads in each output file (default: 4000)",
+            type=int,
+            default=4000,
+            metavar="N",
+        ),
+    ),
+    (
+        "--compression",
+        dict(
+            help="Signal compression: none, lzf, gzip or gzip:LEVEL (default: gzip:1)",
+            type=compression_option,
+            default="gzip:1",
+            metavar="SPEC",
+        ),
+    ),
+    (
+        "--chunk-size",
+        dict(
+            help="Samples in each HDF5 chunk of the signal, 0 lets h5py choose "
+            "(default: 0)",
+            type=int,
+            default=0,
+            metavar="N",
+        ),
+    ),
+    (
+        "-t",
+        "--threads",
+        dict(
+            help="Number of worker processes (default: number of CPUs)",
+            type=int,
+            default=os.cpu_count(),
+            metavar="N",
+        ),
+    ),
+)
+
+_COORDS = re.compile(r"^([0-9]{1,4}):([0-9.]+)-([0-9.]+)$")
+
+
+def signal_layout(n_samples, compression="gzip:1", chunk_size=0):
+    """Return h5py create_dataset arguments for a signal dataset
+    Parameters
+    ----------
+    n_samples : int
+        Length of the dataset
+    compression : str
+        See parse_compression
+    chunk_size : int
+        Samples in each chunk, 0 lets h5py choose
+    Returns
+    -------
+    dict
+        chunks, compression and compression_opts
+    """
+    layout = parse_compression(compression)
+    if chunk_size > 0:
+        layout["chunks"] = (max(min(chunk_size, n_samples), 1),)
+    else:
+        layout["chunks"] = True
+    return layout
+
+
+def median_before(bulkfile, channel_str, start):
+    """Return median_before of the first classification after a sample
+
+    Classifications are in time order, so they are binary searched on disk
+    rather than read in full.
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    start : int
+        Sample index
+    Returns
+    -------
+    float
+        NaN if there are no classifications after start
+    """
+    reads = bulkfile["IntermediateData"][channel_str]["Reads"]
+    lo, hi = 0, len(reads)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if reads[mid]["read_start"] > start:
+            hi = mid
+        else:
+            lo = mid + 1
+    return float(reads[lo]["median_before"]) if lo < len(reads) else math.nan
+
+
+def copy_signal(dataset, start, end, out, block=COPY_BLOCK):
+    """Copy dataset[start:end] into out[0:end - start], a block at a time"""
+    buffer = np.empty(min(block, end - start), dtype=dataset.dtype)
+    for first in range(start, end, block):
+        last = min(first + block, end)
+        n = last - first
+        dataset.read_direct(buffer, np.s_[first:last], np.s_[0:n])
+        record_read(n, buffer.itemsize)
+        out.write_direct(buffer, np.s_[0:n], np.s_[first - start : last - start])
+
+
+def export_read_file(
+    channel,
+    start_index,
+    end_index,
+    bulkfile,
+    output_dir,
+    compression="gzip:1",
+    chunk_size=0,
+):
+    """
+    Export a read file generated from index coordinates and
+    :param channel: int, channel number
+    :param start_index: int, start index for read
+    :param end_index: int, end index for read
+    :param bulkfile: bulkfile object
+    :param output_dir: str, output directory, including trailing slash
+    :param compression: str, signal compression, see parse_compression
+    :param chunk_size: int, samples in each chunk of the signal, 0 for automatic
+    :return: 0 for success
+    """
+    ch_str = "Channel_{ch}".format(ch=channel)
+    source = signal_dataset(bulkfile, ch_str)
+    start_index, end_index = clamp_window(start_index, end_index, int(source.shape[0]))
+    out_filename = Path(bulkfile.filename).stem
+    output_arg = "{dir}/{fn}_bulkvis-read_{start}-{end}_ch_{ch}.fast5".format(
+        dir=output_dir,
+        fn=out_filename,
+        start=start_index,
+        end=end_index,
+        ch=channel,
+    )
+
+    LOGGER.info(f"Exporting to {output_arg}")
+
+    read_id_str = "{ch}-{start}-{end}".format(
+        ch=channel, start=start_index, end=end_index
+    )
+    read_number = 0
+    read_path = "Raw/Reads/Read_{n}".format(n=read_number)
+    with h5py.File(output_arg, "w") as readfile:
+        ugk = readfile.create_group("UniqueGlobalKey")
+        bulkfile.copy("UniqueGlobalKey/context_tags", ugk)
+        bulkfile.copy("UniqueGlobalKey/tracking_id", ugk)
+        bulkfile.copy("IntermediateData/{ch}/Meta".format(ch=ch_str), ugk, "channel_id")
+        channel_id = ugk["channel_id"].attrs
+        channel_id.create("sampling_rate", channel_id["sample_rate"], dtype="float64")
+        channel_id.create("channel_number", channel, dtype="<S4")
+        remove_attrs = [
+            "description",
+            "elimit",
+            "scaling_used",
+            "smallest_event",
+            "threshold",
+            "window",
+            "sample_rate",
+        ]
+        for attr in remove_attrs:
+            if attr in channel_id:
+                del channel_id[attr]
+        # the calibration to pA is kept in Raw/<channel>/Meta in bulk files
+        expected = _channel_id(bulkfile, ch_str, channel, channel_id["sampling_rate"])
+        for name in CALIBRATION_ATTRIBUTES:
+            if name in expected and name not in channel_id:
+                channel_id.create(name, expected[name], dtype="float64")
+
+        readfile.attrs.create("file_version", SINGLE_READ_VERSION, dtype="float64")
+        read = readfile.create_group(read_path)
+        attrs = {
+            "duration": (end_index - start_index, "uint32"),
+            "median_before": (median_before(bulkfile, ch_str, start_index), "float64"),
+            "read_id": (read_id_str, "<S38"),
+            "read_number": (read_number, "uint16"),
+            "start_time": (start_index, "uint64"),
+        }
+        for k, (value, dtype) in attrs.items():
+            read.attrs.create(k, value, dtype=dtype)
+
+        # the signal is streamed from the bulk file into the read file so the
+        # export runs in constant memory
+        n_samples = end_index - start_index
+        signal = read.create_dataset(
+            "Signal",
+            shape=(n_samples,),
+            maxshape=(None,),
+            dtype="int16",
+            **signal_layout(n_samples, compression, chunk_size),
+        )
+        if n_samples:
+            copy_signal(source, start_index, end_index, signal)
+    return 0
+
+
+def _first_line(path):
+    """Return the first line of a text file, compressed files are supported"""
+    return pd.read_csv(path, sep="\t", header=None, nrows=1, dtype=str).iloc[0, 0]
+
+
+def read_coords(paths):
+    """Read regions from fuse outputs or files of 'channel:start-end' lines
+    Parameters
+    ----------
+    paths : list
+        Files to read
+    Returns
+    -------
+    pandas.DataFrame
+        With columns run_id (None when not given), channel, start_time and
+        end_time, times in seconds
+    """
+    frames = []
+    for path in paths:
+        if _first_line(path) == "coords":
+            df = pd.read_csv(path, sep="\t", dtype={"coords": str})
+            coords = df["coords"]
+            run_ids = df["run_id"] if "run_id" in df else None
+        else:
+            coords = pd.read_csv(path, sep="\t", header=None, dtype=str)[0]
+            run_ids = None
+        parts = coords.str.strip().str.extract(_COORDS)
+        if parts.isna().any(axis=None):
+            raise ValueError(
+                "{f} has regions that are not 'channel:start-end'".format(f=path)
+            )
+        frames.append(
+            pd.DataFrame(
+                {
+                    "run_id": None if run_ids is None else run_ids.to_numpy(),
+                    "channel": parts[0].astype(int).to_numpy(),
+                    "start_time": parts[1].astype(float).to_numpy(),
+                    "end_time": parts[2].astype(float).to_numpy(),
+                }
+            )
+        )
+    if not frames:
+        return pd.DataFrame(columns=["run_id", "channel", "start_time", "end_time"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_read_ids(paths):
+    """Read read ids, one per line or from a 'read_id' column
+    Parameters
+    ----------
+    paths : list
+        Files to read
+    Returns
+    -------
+    list
+        Unique read ids, in the order they were first seen
+    """
+    read_ids = []
+    for path in paths:
+        if _first_line(path) == "read_id":
+            column = pd.read_csv(path, sep="\t", usecols=["read_id"], dtype=str)
+        else:
+            column = pd.read_csv(path, sep="\t", header=None, usecols=[0], dtype=str)
+        values = column.iloc[:, 0].dropna().str.strip()
+        # allow FASTQ headers, '@<read_id> ...'
+        read_ids.extend(values.str.lstrip("@").str.split().str[0])
+    return list(dict.fromkeys(read_ids))
+
+
+def plan_requests(bulk_path, coords_df, read_ids):
+    """Return the sample windows to export from one bulk file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Bulk FAST5 file
+    coords_df : pandas.DataFrame
+        Regions from read_coords, those from other runs are skipped
+    read_ids : list
+        Read ids, those not in this file are skipped
+    Returns
+    -------
+    pandas.DataFrame
+        With columns read_id, channel, start and end (samples), sorted by
+        channel and start
+    found : set
+        The read ids that were found in this file
+    """
+    with open_bulk(bulk_path) as bulkfile:
+        sf, values = read_metadata(bulkfile)
+    run_id = values["Run ID"]
+
+    regions = coords_df[coords_df["run_id"].isna() | (coords_df["run_id"] == run_id)]
+    starts = np.floor(regions["start_time"].to_numpy() * sf).astype(np.int64)
+    ends = np.ceil(regions["end_time"].to_numpy() * sf).astype(np.int64)
+    channels = regions["channel"].to_numpy()
+    rows = [
+        ("{ch}-{start}-{end}".format(ch=ch, start=st, end=ed), ch, st, ed)
+        for ch, st, ed in zip(channels, starts, ends)
+    ]
+
+    found = set()
+    if read_ids:
+        records = read_index(bulk_path)
+        for read_id in read_ids:
+            hit = lookup(records, read_id)
+            if hit is not None:
+                rows.append((read_id,) + hit)
+                found.add(read_id)
+
+    df = pd.DataFrame(rows, columns=["read_id", "channel", "start", "end"])
+    df = df[df["end"] > df["start"]].drop_duplicates(subset=["read_id"])
+    return df.sort_values(["channel", "start"], kind="mergesort"), found
+
+
+def _spans(starts, ends):
+    """Group sorted windows into hyperslabs to read in one go
+    Returns
+    -------
+    list
+        (span start, span end, [window indices]) tuples
+    """
+    spans = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if spans:
+            span_start, span_end, members = spans[-1]
+            merged_end = max(span_end, end)
+            if start - span_end <= SPAN_GAP and merged_end - span_start <= MAX_SPAN:
+                members.append(i)
+                spans[-1] = (span_start, merged_end, members)
+                continue
+        spans.append((start, end, [i]))
+    return spans
+
+
+def _channel_id(bulkfile, channel_str, channel, sf):
+    """Return the channel_id attributes of a read from a channel"""
+    attrs = {"channel_number": str(channel).encode(), "sampling_rate": float(sf)}
+    for group in ["IntermediateData", "Raw"]:
+        try:
+            meta = bulkfile[group][channel_str]["Meta"].attrs
+        except KeyError:
+            continue
+        for name in CALIBRATION_ATTRIBUTES:
+            if name in meta and name not in attrs:
+                attrs[name] = float(meta[name])
+    return attrs
+
+
+def write_batch(bulk_path, out_path, batch, compression="gzip:1", chunk_size=0):
+    """Write windows of a bulk file to one multi-read FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Bulk FAST5 file
+    out_path : str or pathlib.Path
+        Multi-read FAST5 file to write
+    batch : pandas.DataFrame
+        Windows from plan_requests
+    compression : str
+        Signal compression, see parse_compression
+    chunk_size : int
+        Samples in each chunk of the signal, 0 lets h5py choose
+    Returns
+    -------
+    int
+        Number of reads written
+    """
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    written = 0
+    with open_bulk(bulk_path) as bulkfile, h5py.File(tmp_path, "w") as out:
+        sf, values = read_metadata(bulkfile)
+        run_id = values["Run ID"].encode()
+        out.attrs["file_version"] = np.bytes_(MULTI_READ_VERSION)
+        out.attrs["file_type"] = np.bytes_("multi-read")
+        # context_tags and tracking_id are the same for every read, they are
+        # written once and hard linked into the other reads
+        shared = None
+        for channel, reads in batch.groupby("channel", sort=False):
+            channel_str = "Channel_{ch}".format(ch=channel)
+            dataset = signal_dataset(bulkfile, channel_str)
+            length = int(dataset.shape[0])
+            channel_id = _channel_id(bulkfile, channel_str, channel, sf)
+            classifications = bulkfile["IntermediateData"][channel_str]["Reads"]
+            read_starts = classifications["read_start"]
+            medians = classifications["median_before"]
+            starts = reads["start"].to_numpy()
+            ends = reads["end"].to_numpy()
+            read_ids = reads["read_id"].to_numpy()
+            for span_start, span_end, members in _spans(starts, ends):
+                span_start, span_end = clamp_window(span_start, span_end, length)
+                signal = np.empty(span_end - span_start, dtype=dataset.dtype)
+                if span_end > span_start:
+                    dataset.read_direct(signal, np.s_[span_start:span_end])
+                for i in members:
+                    start, end = clamp_window(starts[i], ends[i], length)
+                    if end <= start:
+                        continue
+                    # median_before of the first classification after the start
+                    j = np.searchsorted(read_starts, start, side="right")
+                    median_before = float(medians[j]) if j < len(medians) else math.nan
+                    group = out.create_group("read_{r}".format(r=read_ids[i]))
+                    group.attrs["run_id"] = np.bytes_(run_id)
+                    raw = group.create_group("Raw")
+                    raw.create_dataset(
+                        "Signal",
+                        data=signal[start - span_start : end - span_start],
+                        dtype="int16",
+                        **signal_layout(end - start, compression, chunk_size),
+                    )
+                    raw.attrs["duration"] = np.uint32(end - start)
+                    raw.attrs["median_before"] = np.float64(median_before)
+                    raw.attrs["read_id"] = np.bytes_(read_ids[i])
+                    raw.attrs["read_number"] = np.uint32(written)
+                    raw.attrs["start_time"] = np.uint64(start)
+                    channel_group = group.create_group("channel_id")
+                    for k, v in channel_id.items():
+                        channel_group.attrs[k] = v
+                    if shared is None:
+                        for name in ["context_tags", "tracking_id"]:
+                            bulkfile.copy("UniqueGlobalKey/{n}".format(n=name), group)
+                        shared = group
+                    else:
+                        for name in ["context_tags", "tracking_id"]:
+                            group[name] = shared[name]
+                    written += 1
+    tmp_path.replace(out_path)
+    return written
+
+
+def run(parser, args):
+    if not args.coords and not args.read_ids:
+        parser.error("export needs regions (--coords) or read ids (--read-ids)")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    coords_df = read_coords(args.coords)
+    read_ids = read_read_ids(args.read_ids)
+    out_dir = Path(args.output)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    found = set()
+    for bulk_file in args.bulk_files:
+        try:
+            requests, in_file = plan_requests(bulk_file, coords_df, read_ids)
+        except (OSError, KeyError) as e:
+            print("Could not read {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        found |= in_file
+        stem = Path(bulk_file).stem
+        for n, first in enumerate(range(0, len(requests), args.batch_size)):
+            out_path = out_dir / "{s}_export_{n}.fast5".format(s=stem, n=n)
+            tasks.append(
+                (bulk_file, out_path, requests.iloc[first : first + args.batch_size])
+            )
+    missing = len(read_ids) - len(found)
+    if missing:
+        print("{n} read id(s) were not found in the bulk files".format(n=missing))
+    if not tasks:
+        print("Nothing to export")
+        return
+
+    total = 0
+    with ProcessPoolExecutor(
+        max_workers=max(args.threads, 1),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        futures = {
+            pool.submit(write_batch, *task, args.compression, args.chunk_size): task[1]
+            for task in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Exporting"):
+            try:
+                total += future.result()
+            except (OSError, KeyError) as e:
+                print("Could not write {f}: {e}".format(f=futures[future], e=e))
+    print(
+        "Exported {n} read(s) to {c} file(s) in {d}".format(
+            n=total, c=len(tasks), d=out_dir
+        )
+    )
@@ -0,0 +1,322 @@
+"""figure.py
+
+The squiggle plot, shared by the viewer and `bulkvis plot`. Every glyph
+draws from a ColumnDataSource, so showing another window only means giving
+the sources new data. Signal is drawn from sample offsets that the browser
+converts to seconds, see SAMPLES_TO_SECONDS.
+
+Lines are drawn as segments, so their coordinates are sent as flat typed
+arrays. Annotations are culled to the plot's width: at most one line per
+pixel and one label per LABEL_PIXELS, with events closer together than
+that drawn as a single counted marker.
+"""
+import math
+
+import numpy as np
+from bokeh.models import ColumnDataSource, CustomJSTransform, LabelSet, Range1d, Title
+from bokeh.plotting import figure
+from bokeh.transform import transform
+
+OUTPUT_BACKENDS = {"canvas", "svg", "webgl"}
+# Converts sample offsets, or positions if implicit, to seconds in the browser
+SAMPLES_TO_SECONDS = """
+const out = new Float64Array(xs.length)
+for (let i = 0; i < xs.length; i++) {
+    out[i] = (start + (implicit ? i : xs[i])) / sf
+}
+return out
+"""
+# Annotation lines span the whole y range of any plot
+LINE_EXTENT = 10000
+# Pixels between labels, about the height of a line of label text
+LABEL_PIXELS = 16
+
+
+def squiggle_figure(
+    plot_width,
+    plot_height,
+    output_backend="canvas",
+    tools=("xbox_zoom", "xpan", "undo", "reset", "save"),
+    active_drag="xbox_zoom",
+    toolbar_location="right",
+):
+    """Build an empty squiggle plot
+    Parameters
+    ----------
+    plot_width : int
+    plot_height : int
+    output_backend : str
+        'canvas', 'svg' or 'webgl', anything else is drawn with canvas
+    tools : sequence
+        Bokeh tools for the toolbar
+    active_drag : str
+    toolbar_location : str or None
+    Returns
+    -------
+    dict
+        figure, sources (ColumnDataSources by name), renderers (for toggling
+        visibility), titles and x_transform
+    """
+    empty_lines = dict(x0=[], y0=[], x1=[], y1=[])
+    sources = {
+        "signal": ColumnDataSource(data=dict(x=[], y=[])),
+        "annotation_lines": ColumnDataSource(data=empty_lines),
+        "annotation_labels": ColumnDataSource(data=dict(x=[], y=[], t=[])),
+        "annotation_clusters": ColumnDataSource(data=dict(x=[], y=[], t=[])),
+        "mapping_labels": ColumnDataSource(
+            data=dict(start_time=[], height=[], label=[], offset=[])
+        ),
+    }
+    for name in ["forward_v", "reverse_v", "forward_h", "reverse_h"]:
+        sources[name] = ColumnDataSource(data=empty_lines)
+
+    p = figure(
+        plot_height=plot_height,
+        plot_width=plot_width,
+        toolbar_location=toolbar_location,
+        tools=list(tools),
+        active_drag=active_drag,
+    )
+    if output_backend not in OUTPUT_BACKENDS:
+        p.output_backend = "canvas"
+    else:
+        p.output_backend = output_backend
+    titles = {"position": Title(text=""), "file": Title(text="")}
+    p.add_layout(titles["position"], "above")
+    p.add_layout(titles["file"], "above")
+
+    p.toolbar.logo = None
+    p.yaxis.axis_label = "Raw signal"
+    p.yaxis.major_label_orientation = "horizontal"
+    p.xaxis.axis_label = "Time (seconds)"
+    p.xaxis.major_label_orientation = math.radians(45)
+    p.x_range.range_padding = 0.01
+    p.y_range = Range1d(0, 1)
+
+    # x is sent as sample offsets from the window start, see set_signal_x
+    x_transform = CustomJSTransform(
+        args=dict(start=0, sf=1, implicit=False), v_func=SAMPLES_TO_SECONDS
+    )
+    renderers = {
+        "signal": p.line(
+            source=sources["signal"],
+            x=transform("x", x_transform),
+            y="y",
+            line_width=1,
+        )
+    }
+    # Mappings: forward strand => blue, reverse strand => red
+    renderers["mappings"] = [
+        p.segment(
+            x0="x0",
+            y0="y0",
+            x1="x1",
+            y1="y1",
+            source=sources[name],
+            line_dash="solid",
+            color=color,
+            line_width=1,
+        )
+        for name, color in [
+            ("forward_v", "blue"),
+            ("reverse_v", "red"),
+            ("forward_h", "blue"),
+            ("reverse_h", "red"),
+        ]
+    ]
+    mapping_labels = LabelSet(
+        x="start_time",
+        y="height",
+        text="label",
+        level="glyph",
+        x_offset=5,
+        y_offset="offset",
+        source=sources["mapping_labels"],
+        render_mode="canvas",
+    )
+    p.add_layout(mapping_labels)
+    renderers["mappings"].append(mapping_labels)
+
+    annotation_labels = LabelSet(
+        x="x",
+        y="y",
+        text="t",
+        level="glyph",
+        x_offset=0,
+        y_offset=0,
+        source=sources["annotation_labels"],
+        render_mode="canvas",
+        angle=-270,
+        angle_units="deg",
+    )
+    p.add_layout(annotation_labels)
+    # events too close together to label are counted
+    annotation_clusters = LabelSet(
+        x="x",
+        y="y",
+        text="t",
+        level="glyph",
+        x_offset=0,
+        y_offset=8,
+        source=sources["annotation_clusters"],
+        render_mode="canvas",
+        angle=-270,
+        angle_units="deg",
+        text_color="green",
+        text_font_style="bold",
+    )
+    p.add_layout(annotation_clusters)
+    renderers["annotations"] = [
+        p.segment(
+            x0="x0",
+            y0="y0",
+            x1="x1",
+            y1="y1",
+            source=sources["annotation_lines"],
+            line_dash="dashed",
+            color="green",
+            line_width=1,
+        ),
+        annotation_labels,
+        p.inverted_triangle(
+            x="x", y="y", size=8, color="green", source=sources["annotation_clusters"]
+        ),
+        annotation_clusters,
+    ]
+    return {
+        "figure": p,
+        "sources": sources,
+        "renderers": renderers,
+        "titles": titles,
+        "x_transform": x_transform,
+    }
+
+
+def set_signal_x(plot, start, sf, implicit):
+    """Set how the browser turns the signal source into time points
+
+    Time points are (start + offset) / sf, where offset is the x column or,
+    if implicit, the position in the y column.
+    Parameters
+    ----------
+    plot : dict
+        From squiggle_figure
+    """
+    plot["x_transform"].args = dict(start=int(start), sf=sf, implicit=implicit)
+    plot["renderers"]["signal"].glyph.x = transform(
+        "y" if implicit else "x", plot["x_transform"]
+    )
+
+
+def fit_y_range(y_range, y_data):
+    """Fit a Range1d to signal values, with 5% padding above and below"""
+    if len(y_data) == 0:
+        return
+    y_min = np.amin(y_data)
+    y_max = np.amax(y_data)
+    pad = (y_max - y_min) * 0.1 / 2
+    y_range.update(start=y_min - pad, end=y_max + pad)
+
+
+def vline(x_coords, y_upper, y_lower):
+    """Return segment source data for vertical lines at x_coords"""
+    x = np.asarray(x_coords, dtype=np.float64)
+    return dict(
+        x0=x,
+        y0=np.full(len(x), y_lower, dtype=np.float64),
+        x1=x,
+        y1=np.full(len(x), y_upper, dtype=np.float64),
+    )
+
+
+def hlines(y_coords, x_lower, x_upper):
+    """Return segment source data for horizontal lines at height y_coords"""
+    x_lower = np.asarray(x_lower, dtype=np.float64)
+    y = np.full(len(x_lower), y_coords, dtype=np.float64)
+    return dict(x0=x_lower, y0=y, x1=np.asarray(x_upper, dtype=np.float64), y1=y)
+
+
+def pixel_columns(x, x_range, n_columns):
+    """Return which of n_columns equal columns across x_range each x is in"""
+    start, end = x_range
+    scale = n_columns / max(end - start, 1e-9)
+    columns = np.floor((np.asarray(x, dtype=np.float64) - start) * scale)
+    return np.clip(columns, 0, n_columns - 1).astype(np.int64)
+
+
+def cull(x, x_range, n_columns):
+    """Group x by the column of x_range it is in
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Ascending positions
+    x_range : tuple
+        (start, end) of the plot
+    n_columns : int
+        Number of equal columns across x_range
+    Returns
+    -------
+    tuple
+        (first, counts), index of the first x in each occupied column and
+        the number of x in that column
+    """
+    _, first, counts = np.unique(
+        pixel_columns(x, x_range, n_columns), return_index=True, return_counts=True
+    )
+    return first, counts
+
+
+def cull_segments(x0, x1, x_range, plot_width):
+    """Return the indices of segments at least a pixel apart at one end or the other"""
+    columns = np.stack(
+        [
+            pixel_columns(x0, x_range, plot_width),
+            pixel_columns(x1, x_range, plot_width),
+        ],
+        axis=1,
+    )
+    _, first = np.unique(columns, axis=0, return_index=True)
+    return np.sort(first)
+
+
+def annotation_source_data(
+    annotations, label_index, sf, label_height, x_range, plot_width
+):
+    """Return the annotation source data, culled to the width of the plot
+    Parameters
+    ----------
+    annotations : bulkvis.annotations.ChannelAnnotations
+    label_index : numpy.ndarray
+        Indices of the events to draw
+    sf : int
+        Sample frequency
+    label_height : int or float
+        y position of the labels
+    x_range : tuple
+        (start, end) of the plot in seconds
+    plot_width : int
+        Width of the plot in pixels
+    Returns
+    -------
+    dict
+        Source data by source name, annotation_clusters has a counted marker
+        wherever events are too close together to label
+    """
+    label_x = annotations.times[label_index] / sf
+    lines, _ = cull(label_x, x_range, plot_width)
+    first, counts = cull(label_x, x_range, max(plot_width // LABEL_PIXELS, 1))
+    single = counts == 1
+    labelled, clusters = first[single], first[~single]
+    return {
+        "annotation_lines": vline(label_x[lines], LINE_EXTENT, -LINE_EXTENT),
+        "annotation_labels": dict(
+            x=label_x[labelled],
+            y=np.full(len(labelled), label_height, dtype=np.float64),
+            t=annotations.label_text(label_index[labelled]),
+        ),
+        "annotation_clusters": dict(
+            x=label_x[clusters],
+            y=np.full(len(clusters), label_height, dtype=np.float64),
+            t=["{n} events".format(n=n) for n in counts[~single]],
+        ),
+    }
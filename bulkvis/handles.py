@@ -0,0 +1,149 @@
+"""handles.py
+
+A process wide pool of read-only h5py file handles. Every viewer session,
+the prefetch thread and read file exports borrow handles from the pool, so a
+bulk file is opened once per process however many sessions are viewing it.
+Handles nobody is using are closed after an idle timeout. Files are opened
+for SWMR reading where possible, so files MinKNOW is still writing can be
+followed as they grow.
+"""
+import atexit
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+import h5py
+
+from bulkvis.metrics import CallbackMetric
+
+LOGGER = logging.getLogger(__name__)
+# HDF5 chunk cache for each handle, raw signal is mostly read once per window
+# and kept in bulkvis.cache so this only needs to hold the chunks being read
+RDCC_NBYTES = 16 * 1024 * 1024
+RDCC_NSLOTS = 10007
+# Seconds an unused handle is kept open
+IDLE_TIMEOUT = 300
+
+
+def open_bulk(path, **kwargs):
+    """Open a bulk file read-only, for SWMR reading if possible
+
+    A file MinKNOW is still writing can only be opened for SWMR reading, and
+    once a process has a file open for SWMR reading it can open it again
+    either way. Keyword arguments are passed to h5py.File.
+    """
+    try:
+        return h5py.File(path, "r", libver="latest", swmr=True, **kwargs)
+    except (OSError, ValueError) as e:
+        # older file formats, or the file is already open without SWMR
+        LOGGER.debug(f"Opening {path} without SWMR: {e}")
+        return h5py.File(path, "r", **kwargs)
+
+
+class HandlePool:
+    """Reference counted, read-only h5py.File handles keyed by path
+    Parameters
+    ----------
+    idle_timeout : int or float
+        Seconds a handle with no borrowers is kept open
+    rdcc_nbytes : int
+        Size of the HDF5 chunk cache of each handle
+    rdcc_nslots : int
+        Number of chunk slots in the hash table of each handle's chunk cache
+    """
+
+    def __init__(
+        self,
+        idle_timeout=IDLE_TIMEOUT,
+        rdcc_nbytes=RDCC_NBYTES,
+        rdcc_nslots=RDCC_NSLOTS,
+    ):
+        self.idle_timeout = idle_timeout
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        # path: [h5py.File, borrowers, time of last release]
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def acquire(self, path):
+        """Return an open handle for a bulk file, it must be given back with release"""
+        key = os.path.realpath(path)
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is None or not entry[0].id.valid:
+                entry = self._handles[key] = [self._open(key), 0, 0.0]
+            entry[1] += 1
+        self.reap()
+        return entry[0]
+
+    def _open(self, path):
+        # w0=1 evicts chunks that have been read in full first
+        return open_bulk(
+            path,
+            rdcc_nbytes=self.rdcc_nbytes,
+            rdcc_nslots=self.rdcc_nslots,
+            rdcc_w0=1.0,
+        )
+
+    def release(self, bulkfile):
+        """Give back a handle from acquire, the handle is left open for reuse"""
+        if bulkfile is None:
+            return
+        key = os.path.realpath(bulkfile.filename)
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[0] is bulkfile and entry[1] > 0:
+                entry[1] -= 1
+                entry[2] = time.monotonic()
+        self.reap()
+
+    @contextmanager
+    def borrow(self, path):
+        """Context manager that acquires a handle and releases it on exit"""
+        bulkfile = self.acquire(path)
+        try:
+            yield bulkfile
+        finally:
+            self.release(bulkfile)
+
+    def reap(self, idle_timeout=None):
+        """Close handles that have had no borrowers for longer than the timeout"""
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                k
+                for k, (_, borrowers, released) in self._handles.items()
+                if borrowers == 0 and now - released >= idle_timeout
+            ]
+            for key in idle:
+                self._handles.pop(key)[0].close()
+
+    def close_all(self):
+        """Close every handle, whether or not it is borrowed"""
+        with self._lock:
+            while self._handles:
+                self._handles.popitem()[1][0].close()
+
+    def stats(self):
+        """Return a dictionary of pool counters"""
+        with self._lock:
+            return {
+                "open": len(self._handles),
+                "borrowed": sum(1 for e in self._handles.values() if e[1] > 0),
+            }
+
+
+file_pool = HandlePool()
+atexit.register(file_pool.close_all)
+CallbackMetric(
+    "bulkvis_open_file_handles",
+    "Bulk files held open for sessions",
+    "gauge",
+    lambda: len(file_pool),
+)
@@ -0,0 +1,281 @@
+"""index.py
+
+Build and query read id indexes for bulk FAST5 files. Each index maps read
+UUIDs to the channel and sample range of the read, it is written as a sorted,
+memory-mappable .npy file next to the bulk file so a read can be found with a
+binary search without opening the bulk file.
+"""
+import os
+from pathlib import Path
+import threading
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from bulkvis.core import concat_files_to_df
+from bulkvis.manifest import read_metadata
+from bulkvis.raw import signal_length
+
+SIDECAR_SUFFIX = ".readidx.npy"
+INDEX_DTYPE = np.dtype(
+    [("key", "S16"), ("channel", "<u4"), ("start", "<u8"), ("end", "<u8")]
+)
+
+_help = "Build a read id index for bulk FAST5 files, used to find reads by id"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to index", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "-s",
+        "--summary",
+        dict(
+            help="Sequencing summary file(s), reads from the same run as a bulk file "
+            "are added to its index using their start_time and duration",
+            nargs="+",
+            default=[],
+            metavar="",
+        ),
+    ),
+)
+
+# ASCII to nibble value, 255 for characters that are not hexadecimal
+_HEX = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate(b"0123456789abcdef"):
+    _HEX[_c] = _i
+for _i, _c in enumerate(b"ABCDEF"):
+    _HEX[_c] = _i + 10
+_UUID_COLUMNS = [i for i in range(36) if i not in (8, 13, 18, 23)]
+
+
+def sidecar_path(bulk_path):
+    """Return the path of the read id index for a bulk FAST5 file"""
+    bulk_path = Path(bulk_path)
+    return bulk_path.with_name(bulk_path.name + SIDECAR_SUFFIX)
+
+
+def uuid_keys(read_ids):
+    """Convert UUID strings to 16 byte keys
+    Parameters
+    ----------
+    read_ids : array_like
+        Read ids as str or bytes, in the 8-4-4-4-12 UUID format
+    Returns
+    -------
+    keys : numpy.ndarray
+        'S16' array of keys
+    valid : numpy.ndarray
+        Boolean mask, False where a read id is not a UUID
+    """
+    read_ids = np.asarray(read_ids)
+    if read_ids.dtype.kind == "U":
+        read_ids = np.char.encode(read_ids, "ascii")
+    chars = np.frombuffer(read_ids.astype("S36").tobytes(), dtype=np.uint8)
+    chars = chars.reshape(len(read_ids), 36)
+    nibbles = _HEX[chars[:, _UUID_COLUMNS]]
+    hyphens = chars[:, [8, 13, 18, 23]] == ord("-")
+    valid = (nibbles != 255).all(axis=1) & hyphens.all(axis=1)
+    packed = np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+    return packed.view("S16").ravel(), valid
+
+
+def _channel_records(bulkfile, channel_str):
+    """Return index records for the reads in a channel's IntermediateData"""
+    reads = bulkfile["IntermediateData"][channel_str]["Reads"]
+    read_ids = reads["read_id"]
+    if len(read_ids) == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    keys, valid = uuid_keys(read_ids)
+    starts = reads["read_start"][valid]
+    keys = keys[valid]
+    order = np.argsort(keys, kind="stable")
+    keys, starts = keys[order], starts[order]
+    bounds = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    records = np.zeros(len(bounds), dtype=INDEX_DTYPE)
+    records["key"] = keys[bounds]
+    records["channel"] = int(channel_str.split("_")[-1])
+    records["start"] = np.minimum.reduceat(starts, bounds)
+    # A read runs from its first classification until the next read starts,
+    # the last read in a channel runs to the end of the signal
+    last = np.maximum.reduceat(starts, bounds)
+    firsts = np.sort(records["start"])
+    following = np.searchsorted(firsts, last, side="right")
+    length = signal_length(bulkfile, channel_str)
+    records["end"] = np.append(firsts, max(length, int(last.max())))[following]
+    return records
+
+
+def _summary_records(summary_df, run_id, sf):
+    """Return index records for the reads in a sequencing summary from one run"""
+    df = summary_df[summary_df["run_id"] == run_id]
+    keys, valid = uuid_keys(df["read_id"].to_numpy(dtype=str))
+    df = df[valid]
+    records = np.zeros(len(df), dtype=INDEX_DTYPE)
+    records["key"] = keys[valid]
+    records["channel"] = df["channel"].to_numpy()
+    records["start"] = np.floor(df["start_time"].to_numpy() * sf)
+    records["end"] = np.ceil((df["start_time"] + df["duration"]).to_numpy() * sf)
+    return records
+
+
+def index_records(bulk_path, summary_df=None, progress=True):
+    """Return the sorted read id index records for a bulk FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    summary_df : pandas.DataFrame or None
+        Sequencing summary rows, with the columns read_id, run_id, channel,
+        start_time and duration. Where a read is in both, the summary is used
+    progress : bool
+        Show a progress bar
+    Returns
+    -------
+    numpy.ndarray
+        Records with INDEX_DTYPE, sorted by key
+    """
+    parts = []
+    with h5py.File(bulk_path, "r") as bulkfile:
+        sf, values = read_metadata(bulkfile)
+        if summary_df is not None:
+            parts.append(_summary_records(summary_df, values["Run ID"], sf))
+        channels = list(bulkfile["IntermediateData"])
+        for channel_str in tqdm(
+            channels, desc=Path(bulk_path).name, disable=not progress
+        ):
+            parts.append(_channel_records(bulkfile, channel_str))
+    records = np.concatenate(parts) if parts else np.zeros(0, dtype=INDEX_DTYPE)
+    # stable sort then unique keeps the first record, from the summary if present
+    records = records[np.argsort(records["key"], kind="stable")]
+    _, first = np.unique(records["key"], return_index=True)
+    return records[first]
+
+
+def build_index(bulk_path, summary_df=None, progress=True):
+    """Write the read id index for a bulk FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    summary_df : pandas.DataFrame or None
+        Sequencing summary rows, see index_records
+    progress : bool
+        Show a progress bar
+    Returns
+    -------
+    pathlib.Path
+        Path to the index file
+    """
+    records = index_records(bulk_path, summary_df=summary_df, progress=progress)
+    out_path = sidecar_path(bulk_path)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with tmp_path.open("wb") as fh:
+        np.save(fh, records)
+    tmp_path.replace(out_path)
+    return out_path
+
+
+def is_current(bulk_path):
+    """Return True if a bulk file has an index at least as new as the file"""
+    path = sidecar_path(bulk_path)
+    try:
+        return path.stat().st_mtime >= Path(bulk_path).stat().st_mtime
+    except OSError:
+        return False
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(bulk_path):
+    """Return the memory-mapped read id index for a bulk file, or None
+
+    Open indexes are shared in the process until the index file changes.
+    """
+    path = sidecar_path(bulk_path)
+    if not is_current(bulk_path):
+        return None
+    key = os.path.realpath(path)
+    mtime = path.stat().st_mtime
+    with _indexes_lock:
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    records = np.load(path, mmap_mode="r")
+    with _indexes_lock:
+        _indexes[key] = (mtime, records)
+    return records
+
+
+def read_index(bulk_path):
+    """Return the read id index for a bulk file, built in memory if it has none"""
+    records = open_index(bulk_path)
+    if records is None:
+        records = index_records(bulk_path, progress=False)
+    return records
+
+
+def lookup(records, read_id):
+    """Find a read in an index
+    Parameters
+    ----------
+    records : numpy.ndarray
+        An index from open_index
+    read_id : str
+        Read UUID
+    Returns
+    -------
+    tuple or None
+        (channel, start sample, end sample), None if the read is not indexed
+    """
+    keys, valid = uuid_keys([read_id])
+    if not valid[0] or records is None or len(records) == 0:
+        return None
+    i = int(np.searchsorted(records["key"], keys[0]))
+    if i < len(records) and records["key"][i] == keys[0]:
+        return (
+            int(records["channel"][i]),
+            int(records["start"][i]),
+            int(records["end"][i]),
+        )
+    return None
+
+
+def find_read(read_id, bulk_paths):
+    """Find a read in the indexes of several bulk files
+    Parameters
+    ----------
+    read_id : str
+        Read UUID
+    bulk_paths : list
+        Bulk FAST5 files to search, in order
+    Returns
+    -------
+    tuple or None
+        (bulk path, channel, start sample, end sample) of the first match
+    """
+    for bulk_path in bulk_paths:
+        hit = lookup(open_index(bulk_path), read_id)
+        if hit is not None:
+            return (bulk_path,) + hit
+    return None
+
+
+def run(parser, args):
+    summary_df = None
+    if args.summary:
+        summary_df = concat_files_to_df(
+            file_list=args.summary,
+            sep="\t",
+            usecols=["read_id", "run_id", "channel", "start_time", "duration"],
+        )
+    for bulk_file in args.bulk_files:
+        try:
+            out = build_index(bulk_file, summary_df=summary_df)
+        except (OSError, KeyError) as e:
+            print("Could not index {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        print("Read index written to {f}".format(f=out))
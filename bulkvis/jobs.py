@@ -0,0 +1,165 @@
+"""jobs.py
+
+Run the slow parts of viewer callbacks, reading HDF5 and preparing plot data,
+in a thread pool shared by every session. Results are applied to a session's
+document on its next tick, so one session loading a long window does not
+block the Tornado event loop for the others.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import os
+
+from bulkvis.metrics import job_seconds, timed
+from bulkvis.profiling import profile_dir, profiled
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _workers_from_env():
+    """Return the number of worker threads, can be set with BULKVIS_WORKERS"""
+    default = min(32, (os.cpu_count() or 1) + 4)
+    try:
+        workers = int(os.environ.get("BULKVIS_WORKERS", default))
+    except ValueError:
+        return default
+    return workers if workers > 0 else default
+
+
+executor = ThreadPoolExecutor(
+    max_workers=_workers_from_env(), thread_name_prefix="bulkvis-worker"
+)
+# Long running work sessions do not wait for, such as building overviews, is
+# kept out of the worker pool so it never holds up loading windows
+background_executor = ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="bulkvis-background"
+)
+
+
+class SessionJobs:
+    """Background jobs for one session, run one at a time
+
+    Jobs are queued by kind; a job replaces a queued job of the same kind, so
+    only the latest request of each kind runs. Only one job per session runs
+    at a time, which keeps results in order and stops one session from taking
+    every worker. All methods must be called from the session's event loop.
+    Parameters
+    ----------
+    doc : bokeh.document.Document
+        The session's document, results are applied in its next tick callbacks
+    on_busy : callable or None
+        Called with True when the session starts working and False once its
+        queue is empty
+    pool : concurrent.futures.Executor
+        Where jobs run
+    profile_tags : callable or None
+        Describes what the session is working on, for the names of the
+        profiles of slow jobs, see bulkvis.profiling
+    """
+
+    def __init__(self, doc, on_busy=None, pool=executor, profile_tags=None):
+        self.doc = doc
+        self.on_busy = on_busy
+        self.pool = pool
+        self.profile_tags = profile_tags
+        self.epoch = 0
+        self._running = None
+        self._pending = OrderedDict()
+
+    @property
+    def busy(self):
+        return self._running is not None or bool(self._pending)
+
+    def submit(self, kind, work, done, replaces=(), failed=None):
+        """Queue work() to run in the pool and done(result) on the document
+        Parameters
+        ----------
+        kind : str
+            Queued jobs of the same kind are replaced by this one
+        work : callable
+            Called with no arguments in a worker thread
+        done : callable
+            Called with the result of work on the session's event loop
+        replaces : iterable
+            Other kinds of queued job made redundant by this one
+        failed : callable or None
+            Called with the exception on the session's event loop if work
+            raises, otherwise the exception is only logged
+        """
+        for k in (kind,) + tuple(replaces):
+            self._pending.pop(k, None)
+        work = self._profiled(kind, work)
+        self._pending[kind] = (self.epoch, work, done, failed)
+        self._start_next()
+
+    def detach(self, kind, work, done, pool=background_executor):
+        """Run work() in the background and done(result) on the document
+
+        Unlike submitted jobs, detached work runs alongside the session's
+        queue and does not make the session busy. Its result is dropped if
+        the session is reset before it finishes and failures are only logged.
+        """
+        epoch = self.epoch
+        future = pool.submit(timed(job_seconds, kind=kind)(self._profiled(kind, work)))
+
+        def finish(f):
+            if epoch != self.epoch:
+                return
+            try:
+                result = f.result()
+            except Exception:
+                LOGGER.exception("Background job failed")
+            else:
+                done(result)
+
+        future.add_done_callback(
+            lambda f: self.doc.add_next_tick_callback(partial(finish, f))
+        )
+
+    def _profiled(self, kind, work):
+        """Profile work if profiling is on, tagged with what the session shows now"""
+        if self.profile_tags is None or profile_dir() is None:
+            return work
+        tags = self.profile_tags()
+        return profiled(kind + "_job", lambda: tags)(work)
+
+    def reset(self):
+        """Drop queued jobs and ignore the result of the running job"""
+        self.epoch += 1
+        self._pending.clear()
+
+    def _set_busy(self, busy):
+        if self.on_busy is not None:
+            self.on_busy(busy)
+
+    def _start_next(self):
+        if self._running is not None:
+            return
+        if not self._pending:
+            self._set_busy(False)
+            return
+        kind, job = self._pending.popitem(last=False)
+        self._running = job
+        self._set_busy(True)
+        future = self.pool.submit(timed(job_seconds, kind=kind)(job[1]))
+        # add_next_tick_callback is the thread safe way back into a document
+        future.add_done_callback(
+            lambda f: self.doc.add_next_tick_callback(partial(self._finish, job, f))
+        )
+
+    def _finish(self, job, future):
+        self._running = None
+        epoch, _, done, failed = job
+        try:
+            result = future.result()
+        except Exception as e:
+            LOGGER.exception("Background job failed")
+            if failed is not None and epoch == self.epoch:
+                failed(e)
+        else:
+            # results for a file the session has since left are dropped
+            if epoch == self.epoch:
+                done(result)
+        finally:
+            self._start_next()
@@ -0,0 +1,284 @@
+"""manifest.py
+
+Discover and validate the bulk FAST5 files in a directory. The result of
+validating each file, with the metadata the viewer shows, is kept in a
+manifest keyed by path, size and modification time so files are only opened
+again when they change. The manifest is shared by every session in the
+process and persisted in the bulkvis cache directory, where it is shared with
+other server processes and kept between restarts.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+from dateutil import parser
+
+from bulkvis.cache import cache_dir, file_lock
+from bulkvis.handles import open_bulk
+
+LOGGER = logging.getLogger(__name__)
+MANIFEST_VERSION = 1
+
+# (group in UniqueGlobalKey, [(display name, attribute), ...])
+ATTRIBUTES = OrderedDict(
+    [
+        (
+            "tracking_id",
+            [
+                ("Experiment", "sample_id"),
+                ("Flowcell ID", "flow_cell_id"),
+                ("MinKNOW version", "version"),
+                ("Protocols version", "protocols_version"),
+                ("MinION ID", "device_id"),
+                ("Hostname", "hostname"),
+                ("Run ID", "run_id"),
+                ("ASIC ID", "asic_id"),
+                ("Experiment start", "exp_start_time"),
+            ],
+        ),
+        (
+            "context_tags",
+            [
+                ("Sequencing kit", "sequencing_kit"),
+                ("Flowcell type", "flowcell_type"),
+            ],
+        ),
+    ]
+)
+
+
+def _decode(value):
+    """Return an HDF5 attribute as str"""
+    return value.decode("utf8") if isinstance(value, bytes) else str(value)
+
+
+def read_metadata(bulkfile):
+    """Return the sample frequency and display attributes of an open bulk file
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    Returns
+    -------
+    sf : int
+        Sample frequency, how many data points are collected each second
+    values : OrderedDict
+        Display name to value, 'N/A' where the attribute is missing
+    """
+    sf = int(
+        _decode(bulkfile["UniqueGlobalKey"]["context_tags"].attrs["sample_frequency"])
+    )
+    values = OrderedDict()
+    for k, v in ATTRIBUTES.items():
+        for name, attribute in v:
+            try:
+                values[name] = _decode(bulkfile["UniqueGlobalKey"][k].attrs[attribute])
+                if attribute == "exp_start_time":
+                    values[name] = parser.parse(values[name]).strftime(
+                        "%d-%b-%Y %H:%M:%S"
+                    )
+            except KeyError:
+                values[name] = "N/A"
+    return sf, values
+
+
+def validate_bulkfile(path):
+    """Open a file and check it looks like a bulk FAST5 file
+    Parameters
+    ----------
+    path : str or pathlib.Path
+    Returns
+    -------
+    dict
+        {'valid': bool} and, for valid files, 'sf' and 'values' from read_metadata
+    """
+    try:
+        with open_bulk(path) as bulkfile:
+            raw = bulkfile["Raw"]
+            first = next(iter(raw), None)
+            if first is None:
+                return {"valid": False}
+            raw[first]["Signal"][0]
+            sf, values = read_metadata(bulkfile)
+    except (OSError, KeyError, ValueError, IndexError):
+        return {"valid": False}
+    return {"valid": True, "sf": sf, "values": values}
+
+
+def _stamp(path):
+    """Return (size, mtime) for a path"""
+    stat = path.stat()
+    return stat.st_size, int(stat.st_mtime)
+
+
+class BulkDirectory:
+    """Bulk FAST5 files in a directory and their cached metadata
+    Parameters
+    ----------
+    directory : str or pathlib.Path
+        Directory to search for .fast5 files
+    manifest_path : str, pathlib.Path or None
+        Where to persist the manifest, defaults to a file in the cache directory
+    workers : int
+        Number of threads used to validate new or changed files
+    """
+
+    def __init__(self, directory, manifest_path=None, workers=8):
+        self.directory = Path(directory).expanduser().resolve()
+        if manifest_path is None:
+            digest = hashlib.sha1(str(self.directory).encode()).hexdigest()[:16]
+            manifest_path = cache_dir() / "manifest-{d}.json".format(d=digest)
+        self.manifest_path = Path(manifest_path)
+        self.workers = workers
+        self._entries = self._load()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def _load(self):
+        """Return manifest entries from disk, empty if missing or unreadable"""
+        try:
+            with self.manifest_path.open() as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        if manifest.get("directory") != str(self.directory):
+            return {}
+        return manifest.get("files", {})
+
+    def _save(self):
+        """Atomically write the manifest to disk, failures are only logged"""
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "directory": str(self.directory),
+            "files": self._entries,
+        }
+        tmp = self.manifest_path.with_name(
+            "{n}.{pid}.tmp".format(n=self.manifest_path.name, pid=os.getpid())
+        )
+        try:
+            self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp.open("w") as fh:
+                json.dump(manifest, fh)
+            tmp.replace(self.manifest_path)
+        except OSError as e:
+            LOGGER.warning(f"Could not write manifest {self.manifest_path}: {e}")
+
+    def _validate(self, path, stamp):
+        entry = validate_bulkfile(path)
+        entry["size"], entry["mtime"] = stamp
+        return path.name, entry
+
+    def refresh(self):
+        """Validate new or changed files and forget removed ones
+
+        Other processes serving the same directory share the manifest file.
+        Only one of them validates files at a time, the others then pick up
+        its results from disk instead of opening the files again.
+        Returns
+        -------
+        bool
+            True if the set of files or any of their metadata changed
+        """
+        lock_path = self.manifest_path.with_name(self.manifest_path.name + ".lock")
+        with self._refresh_lock, file_lock(lock_path):
+            changed = self._merge_saved()
+            stamps = {}
+            for path in self.directory.iterdir():
+                if path.suffix != ".fast5":
+                    continue
+                try:
+                    stamps[path] = _stamp(path)
+                except OSError:
+                    continue
+            with self._lock:
+                entries = dict(self._entries)
+            todo = []
+            for path, stamp in stamps.items():
+                entry = entries.get(path.name, {})
+                if (entry.get("size"), entry.get("mtime")) != stamp:
+                    todo.append((path, stamp))
+            names = {path.name for path in stamps}
+            removed = [name for name in entries if name not in names]
+            if not todo and not removed:
+                return changed
+            # Files are validated without holding the lock, so sessions can
+            # still list the files that are already known
+            if todo:
+                LOGGER.info(f"Validating {len(todo)} bulk FAST5 file(s)")
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    validated = list(pool.map(lambda a: self._validate(*a), todo))
+            else:
+                validated = []
+            with self._lock:
+                for name in removed:
+                    self._entries.pop(name, None)
+                self._entries.update(validated)
+                self._save()
+            return True
+
+    def _merge_saved(self):
+        """Add entries validated by other processes, True if any were new"""
+        saved = self._load()
+        with self._lock:
+            new = {k: v for k, v in saved.items() if self._entries.get(k) != v}
+            self._entries.update(new)
+        return bool(new)
+
+    def files(self):
+        """Return the names of valid bulk files, sorted"""
+        with self._lock:
+            return sorted(k for k, v in self._entries.items() if v.get("valid"))
+
+    def metadata(self, name):
+        """Return (sf, values) for a file from the manifest, or None if unknown"""
+        with self._lock:
+            entry = self._entries.get(name)
+        if not entry or not entry.get("valid"):
+            return None
+        return entry["sf"], OrderedDict(entry["values"])
+
+    def start_watching(self, interval=10):
+        """Poll the directory for new or changed files in a daemon thread"""
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._stop.clear()
+            self._watcher = threading.Thread(
+                target=self._watch, args=(interval,), daemon=True
+            )
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def _watch(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except OSError as e:
+                LOGGER.warning(f"Could not scan {self.directory}: {e}")
+
+
+_directories = {}
+_directories_lock = threading.Lock()
+
+
+def get_bulk_directory(directory):
+    """Return the shared BulkDirectory for a directory, scanning it the first time"""
+    key = str(Path(directory).expanduser().resolve())
+    with _directories_lock:
+        bulk_dir = _directories.get(key)
+        if bulk_dir is None:
+            bulk_dir = BulkDirectory(key)
+            bulk_dir.refresh()
+            _directories[key] = bulk_dir
+    return bulk_dir
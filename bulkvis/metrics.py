@@ -0,0 +1,378 @@
+"""metrics.py
+
+Counters, gauges and latency histograms describing what the viewer server is
+doing, served in the Prometheus text format at /metrics. When the server runs
+several worker processes each one periodically writes its values to a shared
+directory and a scrape, whichever worker answers it, adds them all up.
+
+Slow work is done in background jobs, so most callbacks only queue a job:
+the time to load a window is bulkvis_job_duration_seconds{kind="window"} and
+the time to draw it bulkvis_callback_duration_seconds{callback="show_window"}.
+"""
+import atexit
+from bisect import bisect_left
+from functools import wraps
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import threading
+import time
+
+from tornado.web import RequestHandler
+
+LOGGER = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Directory shared by the worker processes of one server, set by bulkvis serve
+SHARED_DIR_ENV = "BULKVIS_METRICS_DIR"
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(
+            "Expected labels {e}, got {g}".format(e=labelnames, g=tuple(labels))
+        )
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+class _Metric:
+    """A metric family, with one value per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, description, labelnames=(), registry=None):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def samples(self):
+        """Return (sample name, labels, value) for each value"""
+        with self._lock:
+            return [
+                (self.name, dict(zip(self.labelnames, k)), v)
+                for k, v in self._values.items()
+            ]
+
+
+class Counter(_Metric):
+    """A value that only goes up, e.g. bytes read"""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, e.g. open sessions"""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Counts of observations, e.g. latencies, in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(
+        self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS, **kwargs
+    ):
+        super().__init__(name, description, labelnames, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for key, counts in values.items():
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                samples.append(
+                    (self.name + "_bucket", dict(labels, le=_format(bound)), total)
+                )
+            samples.append((self.name + "_count", labels, total))
+            samples.append((self.name + "_sum", labels, counts[-1]))
+        return samples
+
+
+class CallbackMetric(_Metric):
+    """A metric whose value is read from a function when it is collected
+    Parameters
+    ----------
+    type : str
+        'counter' or 'gauge'
+    fn : callable
+        Returns the current value
+    """
+
+    def __init__(self, name, description, type, fn, **kwargs):
+        super().__init__(name, description, **kwargs)
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, {}, self.fn())]
+
+
+class Registry:
+    """The metrics of a process"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Duplicate metric {n}".format(n=metric.name))
+            self._metrics[metric.name] = metric
+
+    def collect(self):
+        """Return a JSON serialisable snapshot of every metric"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [
+            {
+                "name": m.name,
+                "type": m.type,
+                "help": m.description,
+                "samples": [list(s) for s in m.samples()],
+            }
+            for m in metrics
+        ]
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram, **labels):
+    """Decorate a function to observe how long each call takes"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def merge(snapshots):
+    """Add up snapshots from several processes, summing identical samples"""
+    families = {}
+    for snapshot in snapshots:
+        for family in snapshot:
+            merged = families.setdefault(family["name"], dict(family, samples={}))
+            for name, labels, value in family["samples"]:
+                key = (name, tuple(sorted(labels.items())))
+                merged["samples"][key] = merged["samples"].get(key, 0) + value
+    for family in families.values():
+        family["samples"] = [
+            [name, dict(labels), value]
+            for (name, labels), value in family["samples"].items()
+        ]
+    return list(families.values())
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def exposition(snapshot):
+    """Return a snapshot in the Prometheus text format"""
+    lines = []
+    for family in snapshot:
+        lines.append("# HELP {n} {h}".format(n=family["name"], h=family["help"]))
+        lines.append("# TYPE {n} {t}".format(n=family["name"], t=family["type"]))
+        for name, labels, value in family["samples"]:
+            if labels:
+                name += "{{{l}}}".format(
+                    l=",".join(
+                        '{k}="{v}"'.format(k=k, v=_escape(str(v)))
+                        for k, v in labels.items()
+                    )
+                )
+            lines.append("{n} {v}".format(n=name, v=_format(value)))
+    return "\n".join(lines) + "\n"
+
+
+def create_shared_dir():
+    """Create the directory worker processes share metrics through
+
+    Called by bulkvis serve before it forks; the workers find the directory
+    in the environment and it is removed when the parent exits.
+    """
+    path = tempfile.mkdtemp(prefix="bulkvis-metrics-")
+    os.environ[SHARED_DIR_ENV] = path
+    parent = os.getpid()
+    # forked workers inherit this handler, only the parent removes the directory
+    atexit.register(
+        lambda: os.getpid() == parent and shutil.rmtree(path, ignore_errors=True)
+    )
+    return path
+
+
+def _shared_dir():
+    path = os.environ.get(SHARED_DIR_ENV)
+    return Path(path) if path else None
+
+
+def write_snapshot(directory, registry=REGISTRY):
+    """Atomically write this process' metrics to <directory>/<pid>.json"""
+    path = Path(directory) / "{pid}.json".format(pid=os.getpid())
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as fh:
+        json.dump(registry.collect(), fh)
+    tmp_path.replace(path)
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_snapshots(directory):
+    """Return the snapshots of the running processes sharing a directory"""
+    snapshots = []
+    for path in Path(directory).glob("*.json"):
+        try:
+            if not _is_running(int(path.stem)):
+                path.unlink()
+                continue
+            with path.open() as fh:
+                snapshots.append(json.load(fh))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+_sharing = None
+_sharing_lock = threading.Lock()
+
+
+def start_sharing(interval=5):
+    """Write this process' metrics to the shared directory every interval
+
+    Does nothing when the server runs a single process.
+    """
+    global _sharing
+    directory = _shared_dir()
+    if directory is None:
+        return
+    with _sharing_lock:
+        if _sharing is not None:
+            return
+
+        def share():
+            while True:
+                try:
+                    write_snapshot(directory)
+                except OSError as e:
+                    LOGGER.warning(f"Could not write metrics to {directory}: {e}")
+                time.sleep(interval)
+
+        _sharing = threading.Thread(target=share, name="bulkvis-metrics", daemon=True)
+        _sharing.start()
+
+
+def collect_all():
+    """Return the metrics of this process, added to the other workers' if any"""
+    directory = _shared_dir()
+    if directory is None:
+        return REGISTRY.collect()
+    try:
+        write_snapshot(directory)
+    except OSError as e:
+        LOGGER.warning(f"Could not write metrics to {directory}: {e}")
+        return REGISTRY.collect()
+    return merge(read_snapshots(directory))
+
+
+class MetricsHandler(RequestHandler):
+    """Serve the metrics of every worker in the Prometheus text format"""
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(exposition(collect_all()))
+
+
+callback_seconds = Histogram(
+    "bulkvis_callback_duration_seconds",
+    "Time spent in viewer callbacks on the server event loop",
+    ["callback"],
+)
+job_seconds = Histogram(
+    "bulkvis_job_duration_seconds",
+    "Time spent running background jobs in the worker pool",
+    ["kind"],
+)
+bytes_read = Counter(
+    "bulkvis_hdf5_read_bytes_total", "Bytes of raw signal read from bulk files"
+)
+samples_read = Counter(
+    "bulkvis_hdf5_read_samples_total", "Samples of raw signal read from bulk files"
+)
+points_sent = Counter(
+    "bulkvis_points_sent_total",
+    "Rows of plot data sent to browsers, by data source",
+    ["source"],
+)
+sessions = Gauge("bulkvis_sessions", "Open viewer sessions")
+
+
+def record_read(n_samples, itemsize):
+    """Count a read of raw signal from a bulk file"""
+    samples_read.inc(n_samples)
+    bytes_read.inc(n_samples * itemsize)
@@ -0,0 +1,381 @@
+"""overview.py
+
+A whole flowcell view of channel activity. Every channel's StateData is
+split into equal time bins and each bin is given the summary_state the
+channel spent longest in. The channels x bins grid is built once per bulk
+file, by `bulkvis overview` or by the first viewer session to need it, and
+stored in a sidecar file next to the bulk file.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+import time
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from bulkvis.annotations import enum_labels
+from bulkvis.cache import cache_dir, file_lock
+from bulkvis.handles import open_bulk
+from bulkvis.raw import signal_length
+
+LOGGER = logging.getLogger(__name__)
+SIDECAR_SUFFIX = ".overview.h5"
+OVERVIEW_VERSION = 1
+# Number of time bins per channel
+DEFAULT_BINS = 512
+# Value of bins with no state data
+NO_DATA = 255
+# A bulk file modified this many seconds ago or less is taken to be growing
+GROWING_SECONDS = 60
+
+_help = "Build a channel activity overview sidecar for bulk FAST5 files"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to summarise", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "-b",
+        "--bins",
+        dict(
+            help="Number of time bins per channel (default: {n})".format(
+                n=DEFAULT_BINS
+            ),
+            type=int,
+            default=DEFAULT_BINS,
+            metavar="",
+        ),
+    ),
+    (
+        "-t",
+        "--threads",
+        dict(
+            help="Number of processes used to bin channels (default: {n})".format(
+                n=os.cpu_count()
+            ),
+            type=int,
+            default=os.cpu_count(),
+            metavar="",
+        ),
+    ),
+    (
+        "-f",
+        "--force",
+        dict(
+            help="Rebuild sidecar files that are already up to date",
+            action="store_true",
+        ),
+    ),
+)
+
+
+def sidecar_path(bulk_path):
+    """Return the path of the overview sidecar for a bulk FAST5 file"""
+    bulk_path = Path(bulk_path)
+    return bulk_path.with_name(bulk_path.name + SIDECAR_SUFFIX)
+
+
+def _source_stamp(bulk_path):
+    """Return (size, mtime) of a bulk file, used to detect stale sidecar files"""
+    stat = Path(bulk_path).stat()
+    return int(stat.st_size), int(stat.st_mtime)
+
+
+def is_current(bulk_path):
+    """Return True if a bulk file has a sidecar built from its current contents"""
+    path = sidecar_path(bulk_path)
+    if not path.is_file():
+        return False
+    try:
+        with h5py.File(path, "r") as fh:
+            stamp = (int(fh.attrs["source_size"]), int(fh.attrs["source_mtime"]))
+            version = int(fh.attrs["version"])
+    except (OSError, KeyError):
+        return False
+    return version == OVERVIEW_VERSION and stamp == _source_stamp(bulk_path)
+
+
+def is_growing(bulk_path):
+    """Return True if a bulk file looks like it is still being written"""
+    return time.time() - Path(bulk_path).stat().st_mtime <= GROWING_SECONDS
+
+
+class Overview:
+    """Dominant summary_state of every channel in equal time bins
+    Parameters
+    ----------
+    channels : numpy.ndarray
+        Channel numbers, one per row of states, ascending
+    states : numpy.ndarray
+        (channels, bins) uint8 summary_state values, NO_DATA where a channel
+        has no state data
+    bin_size : int
+        Samples in each bin
+    labels : OrderedDict
+        summary_state value to name
+    """
+
+    def __init__(self, channels, states, bin_size, labels):
+        self.channels = np.asarray(channels)
+        self.states = np.asarray(states)
+        self.bin_size = int(bin_size)
+        self.labels = labels
+
+    @property
+    def n_bins(self):
+        return self.states.shape[1]
+
+    def cell(self, row, column):
+        """Return (channel, start sample, end sample) of a cell, None if outside"""
+        if not (0 <= row < len(self.channels) and 0 <= column < self.n_bins):
+            return None
+        start = column * self.bin_size
+        return int(self.channels[row]), start, start + self.bin_size
+
+    @classmethod
+    def from_sidecar(cls, path):
+        """Read an overview from a sidecar file"""
+        with h5py.File(path, "r") as fh:
+            labels = OrderedDict(zip(fh["codes"][()].tolist(), fh["names"].asstr()[()]))
+            return cls(
+                fh["channels"][()], fh["states"][()], fh.attrs["bin_size"], labels
+            )
+
+    def write(self, bulk_path):
+        """Write the overview to the sidecar of a bulk file
+        Returns
+        -------
+        pathlib.Path
+            Path to the sidecar file
+        """
+        out_path = sidecar_path(bulk_path)
+        tmp_path = out_path.with_name(
+            "{n}.{pid}.tmp".format(n=out_path.name, pid=os.getpid())
+        )
+        with h5py.File(tmp_path, "w") as out:
+            out.create_dataset("channels", data=self.channels, dtype="<u4")
+            out.create_dataset(
+                "states", data=self.states, dtype="u1", compression="gzip"
+            )
+            out.create_dataset("codes", data=list(self.labels), dtype="u1")
+            out.create_dataset(
+                "names", data=list(self.labels.values()), dtype=h5py.string_dtype()
+            )
+            out.attrs["version"] = OVERVIEW_VERSION
+            out.attrs["bin_size"] = self.bin_size
+            out.attrs["source"] = Path(bulk_path).name
+            size, mtime = _source_stamp(bulk_path)
+            out.attrs["source_size"] = size
+            out.attrs["source_mtime"] = mtime
+        tmp_path.replace(out_path)
+        return out_path
+
+
+def dominant_states(times, codes, edges):
+    """Return the state each bin spends longest in
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sample index of each state change, ascending
+    codes : numpy.ndarray
+        State entered at each change, a state lasts until the next change
+        or the last edge
+    edges : numpy.ndarray
+        Bin edges in samples, ascending
+    Returns
+    -------
+    numpy.ndarray
+        uint8 state of each bin, NO_DATA for bins before the first change
+    """
+    n_bins = len(edges) - 1
+    if len(times) == 0 or n_bins < 1:
+        return np.full(max(n_bins, 0), NO_DATA, dtype=np.uint8)
+    states = np.unique(codes)
+    onehot = codes[:, None] == states[None, :]
+    # time spent in each state up to each change; between changes only the
+    # state entered at the last change accumulates time
+    knots = np.append(times, max(int(edges[-1]), int(times[-1]))).astype(np.int64)
+    spent = np.zeros((len(knots), len(states)), dtype=np.int64)
+    np.cumsum(np.diff(knots)[:, None] * onehot, axis=0, out=spent[1:])
+    idx = np.searchsorted(knots, edges, side="right") - 1
+    inside = (idx >= 0) & (idx < len(times))
+    at_edges = np.zeros((len(edges), len(states)), dtype=np.int64)
+    at_edges[idx >= 0] = spent[idx[idx >= 0]]
+    at_edges[inside] += (edges[inside] - knots[idx[inside]])[:, None] * onehot[
+        idx[inside]
+    ]
+    durations = np.diff(at_edges, axis=0)
+    dominant = states[np.argmax(durations, axis=1)].astype(np.uint8)
+    dominant[durations.sum(axis=1) == 0] = NO_DATA
+    return dominant
+
+
+def _bin_channels(bulk_path, channel_strs, edges):
+    """Return the dominant state rows of some channels, run in a worker process"""
+    rows = np.full((len(channel_strs), len(edges) - 1), NO_DATA, dtype=np.uint8)
+    with open_bulk(bulk_path) as bulkfile:
+        for i, channel_str in enumerate(channel_strs):
+            states = bulkfile["StateData"][channel_str]["States"][()]
+            order = np.argsort(states["acquisition_raw_index"], kind="stable")
+            rows[i] = dominant_states(
+                states["acquisition_raw_index"][order].astype(np.int64),
+                states["summary_state"][order],
+                edges,
+            )
+    return rows
+
+
+def _channel_number(channel_str):
+    return int(channel_str.split("_")[-1])
+
+
+def compute_overview(bulk_path, n_bins=DEFAULT_BINS, workers=None, progress=False):
+    """Bin the StateData of every channel of a bulk FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    n_bins : int
+        Number of time bins per channel
+    workers : int or None
+        Number of processes, defaults to the number of CPUs
+    progress : bool
+        Show a progress bar
+    Returns
+    -------
+    Overview
+    """
+    bulk_path = os.path.realpath(bulk_path)
+    with open_bulk(bulk_path) as bulkfile:
+        channels = sorted(bulkfile["StateData"], key=_channel_number)
+        if not channels:
+            raise KeyError("{f} has no StateData".format(f=bulk_path))
+        labels = enum_labels(
+            bulkfile["StateData"][channels[0]]["States"], "summary_state"
+        )
+        n_samples = max(signal_length(bulkfile, c) for c in bulkfile["Raw"])
+    bin_size = max(math.ceil(n_samples / max(int(n_bins), 1)), 1)
+    edges = np.arange(math.ceil(n_samples / bin_size) + 1, dtype=np.int64) * bin_size
+    workers = workers or os.cpu_count() or 1
+    # a few batches per worker keeps them all busy to the end
+    n_batches = min(len(channels), workers * 4)
+    batches = [list(b) for b in np.array_split(channels, n_batches)]
+    # spawn, as the viewer calls this from a thread of a process using HDF5
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        rows = list(
+            tqdm(
+                pool.map(
+                    _bin_channels, [bulk_path] * n_batches, batches, [edges] * n_batches
+                ),
+                total=n_batches,
+                desc=Path(bulk_path).name,
+                disable=not progress,
+            )
+        )
+    return Overview(
+        [_channel_number(c) for c in channels], np.vstack(rows), bin_size, labels
+    )
+
+
+def build_overview(bulk_path, n_bins=DEFAULT_BINS, workers=None, progress=True):
+    """Write the overview sidecar for a bulk FAST5 file
+    Returns
+    -------
+    pathlib.Path
+        Path to the sidecar file
+    """
+    overview = compute_overview(
+        bulk_path, n_bins=n_bins, workers=workers, progress=progress
+    )
+    return overview.write(bulk_path)
+
+
+class OverviewStore:
+    """Process wide cache of Overviews, shared by every viewer session
+
+    An overview is read from its sidecar, or computed and written to it if
+    the sidecar is missing or stale. Sessions asking for the same file while
+    it is being computed wait for that computation rather than repeat it, as
+    do other server processes, which then read the sidecar it wrote. A file
+    that is still growing would be stale again by the next request, so it
+    is not built, a sidecar written earlier is used if there is one.
+    """
+
+    def __init__(self, n_bins=DEFAULT_BINS, workers=None):
+        self.n_bins = n_bins
+        self.workers = workers
+        self._overviews = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, bulk_path):
+        """Return the Overview of a bulk file, None for a growing file without one"""
+        key = os.path.realpath(bulk_path)
+        stamp = _source_stamp(key)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self._overviews.get(key)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            if is_current(key):
+                overview = Overview.from_sidecar(sidecar_path(key))
+            elif is_growing(key):
+                return self._read_stale(key)
+            else:
+                # other processes wait for this file's build and read its sidecar
+                with file_lock(self._lock_path(key)):
+                    overview = self._build(key)
+            self._overviews[key] = (stamp, overview)
+            return overview
+
+    @staticmethod
+    def _lock_path(key):
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return cache_dir() / "overview-{d}.lock".format(d=digest)
+
+    @staticmethod
+    def _read_stale(key):
+        """Return the overview in a sidecar even if it is stale, or None"""
+        try:
+            return Overview.from_sidecar(sidecar_path(key))
+        except (OSError, KeyError):
+            return None
+
+    def _build(self, key):
+        """Compute and write an overview, unless another process just did"""
+        if is_current(key):
+            return Overview.from_sidecar(sidecar_path(key))
+        LOGGER.info(f"Building channel overview for {key}")
+        overview = compute_overview(key, self.n_bins, self.workers)
+        try:
+            overview.write(key)
+        except OSError as e:
+            LOGGER.warning(f"Could not write overview for {key}: {e}")
+        return overview
+
+
+overview_store = OverviewStore()
+
+
+def run(parser, args):
+    for bulk_file in args.bulk_files:
+        if not args.force and is_current(bulk_file):
+            print("{f} is up to date".format(f=sidecar_path(bulk_file)))
+            continue
+        try:
+            out = build_overview(bulk_file, n_bins=args.bins, workers=args.threads)
+        except (OSError, KeyError) as e:
+            print("Could not summarise {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        print("Overview written to {f}".format(f=out))
@@ -0,0 +1,298 @@
+"""plot.py
+
+Render regions of bulk FAST5 files to PNG or SVG images without running the
+viewer. Each region is drawn with the viewer's squiggle plot, from
+bulkvis.figure, and exported with a headless browser that Bokeh drives
+through selenium. Regions are sorted by channel and split between worker
+processes; each worker keeps its bulk file and browser open for all of its
+regions.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib.util
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from bulkvis.annotations import annotation_store
+from bulkvis.downsample import minmax_downsample
+from bulkvis.export import plan_requests, read_coords, read_read_ids
+from bulkvis.figure import (
+    annotation_source_data,
+    fit_y_range,
+    set_signal_x,
+    squiggle_figure,
+)
+from bulkvis.handles import open_bulk
+from bulkvis.manifest import read_metadata
+from bulkvis.raw import channel_calibration, clamp_window, read_signal, signal_length
+
+FORMATS = ["png", "svg"]
+
+_help = "Render regions or reads from bulk FAST5 files to PNG or SVG images"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to plot from", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "-c",
+        "--coords",
+        dict(
+            help="Files of regions to plot, either a bulkvis fuse output with a "
+            "'coords' column or one 'channel:start-end' (seconds) per line",
+            nargs="+",
+            default=[],
+            metavar="FILE",
+        ),
+    ),
+    (
+        "-r",
+        "--read-ids",
+        dict(
+            help="Files of read ids to plot, one per line or a tab separated file "
+            "with a 'read_id' column. Reads are found with the read id index if "
+            "there is one (see 'bulkvis index')",
+            nargs="+",
+            default=[],
+            metavar="FILE",
+        ),
+    ),
+    (
+        "-o",
+        "--output",
+        dict(help="Output directory", required=True, metavar="DIR"),
+    ),
+    (
+        "-f",
+        "--format",
+        dict(
+            help="Image format (default: png)",
+            choices=FORMATS,
+            default="png",
+        ),
+    ),
+    (
+        "--width",
+        dict(
+            help="Plot width in pixels (default: 800)",
+            type=int,
+            default=800,
+            metavar="N",
+        ),
+    ),
+    (
+        "--height",
+        dict(
+            help="Plot height in pixels (default: 400)",
+            type=int,
+            default=400,
+            metavar="N",
+        ),
+    ),
+    (
+        "--pa",
+        dict(
+            help="Draw the signal in pA, calibrated from the channel metadata",
+            action="store_true",
+        ),
+    ),
+    (
+        "--no-annotations",
+        dict(
+            help="Leave out the MinKNOW read classification and state labels",
+            action="store_true",
+        ),
+    ),
+    (
+        "-t",
+        "--threads",
+        dict(
+            help="Number of worker processes (default: number of CPUs)",
+            type=int,
+            default=os.cpu_count(),
+            metavar="N",
+        ),
+    ),
+)
+
+
+def region_figure(bulkfile, sf, channel, start, end, opts):
+    """Draw one region of an open bulk file
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    sf : int
+        Sample frequency
+    channel : int
+        Channel number
+    start : int
+        First sample of the region
+    end : int
+        Sample after the last sample of the region
+    opts : dict
+        width, height, format, pa and annotations, from the command line
+    Returns
+    -------
+    bokeh.plotting.Figure or None
+        None if the region has no signal
+    """
+    channel_str = "Channel_{ch}".format(ch=channel)
+    start, end = clamp_window(start, end, signal_length(bulkfile, channel_str))
+    if end <= start:
+        return None
+    plot = squiggle_figure(
+        opts["width"],
+        opts["height"],
+        output_backend="svg" if opts["format"] == "svg" else "canvas",
+        tools=(),
+        active_drag="auto",
+        toolbar_location=None,
+    )
+    p = plot["figure"]
+    keep_index, y_data = minmax_downsample(
+        read_signal(bulkfile, channel_str, start, end), n_bins=opts["width"]
+    )
+    calibration = channel_calibration(bulkfile, channel_str) if opts["pa"] else None
+    if calibration is not None:
+        y_data = calibration.to_pa(y_data)
+        p.yaxis.axis_label = "Current (pA)"
+    set_signal_x(plot, start, sf, implicit=False)
+    plot["sources"]["signal"].data = {"x": keep_index.astype(np.int32), "y": y_data}
+    fit_y_range(p.y_range, y_data)
+
+    if opts["annotations"]:
+        annotations = annotation_store.get(bulkfile, channel_str)
+        label_index = annotations.window(start, end)
+        # labels are written upwards from the bottom of the plot
+        data = annotation_source_data(
+            annotations,
+            label_index,
+            sf,
+            p.y_range.start,
+            (start / sf, end / sf),
+            opts["width"],
+        )
+        for name, values in data.items():
+            plot["sources"][name].data = values
+
+    plot["titles"]["position"].text = (
+        "Channel: {ch} Start: {st} End: {ed} Sample rate: {sf}".format(
+            ch=channel,
+            st=math.floor(start / sf),
+            ed=math.ceil(end / sf),
+            sf=sf,
+        )
+    )
+    plot["titles"]["file"].text = "bulk FAST5 file: {s}".format(
+        s=Path(bulkfile.filename).name
+    )
+    return p
+
+
+def plot_batch(bulk_path, batch, out_dir, opts):
+    """Render a batch of regions from one bulk file, run in a worker process
+
+    The bulk file and the browser are opened once for the whole batch, and
+    regions are drawn in channel order so each channel's annotations are
+    indexed once.
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Bulk FAST5 file
+    batch : pandas.DataFrame
+        Regions from plan_requests
+    out_dir : pathlib.Path
+        Where images are written, as <bulk file stem>_<read id>.<format>
+    opts : dict
+        See region_figure
+    Returns
+    -------
+    int
+        Number of images written
+    """
+    from bokeh.io import export_png, export_svg
+    from bokeh.io.webdriver import webdriver_control
+
+    export = export_svg if opts["format"] == "svg" else export_png
+    stem = Path(bulk_path).stem
+    written = 0
+    try:
+        with open_bulk(bulk_path) as bulkfile:
+            sf, _ = read_metadata(bulkfile)
+            for read_id, channel, start, end in batch[
+                ["read_id", "channel", "start", "end"]
+            ].itertuples(index=False):
+                p = region_figure(bulkfile, sf, channel, start, end, opts)
+                if p is None:
+                    continue
+                out_path = out_dir / "{s}_{r}.{f}".format(
+                    s=stem, r=read_id, f=opts["format"]
+                )
+                # the browser is started by the first export and reused
+                export(p, filename=str(out_path))
+                written += 1
+    finally:
+        # worker processes exit without running atexit handlers
+        webdriver_control.cleanup()
+    return written
+
+
+def run(parser, args):
+    if not args.coords and not args.read_ids:
+        parser.error("plot needs regions (--coords) or read ids (--read-ids)")
+    if importlib.util.find_spec("selenium") is None:
+        parser.exit(
+            2,
+            "bulkvis plot needs selenium and a browser driver (chromedriver or "
+            "geckodriver) to render images, see the Bokeh documentation on "
+            "exporting plots\n",
+        )
+    opts = {
+        "width": args.width,
+        "height": args.height,
+        "format": args.format,
+        "pa": args.pa,
+        "annotations": not args.no_annotations,
+    }
+    coords_df = read_coords(args.coords)
+    read_ids = read_read_ids(args.read_ids)
+    out_dir = Path(args.output)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    workers = max(args.threads, 1)
+
+    tasks = []
+    found = set()
+    for bulk_file in args.bulk_files:
+        try:
+            requests, in_file = plan_requests(bulk_file, coords_df, read_ids)
+        except (OSError, KeyError) as e:
+            print("Could not read {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        found |= in_file
+        # requests are sorted by channel, each worker gets a run of channels
+        for batch in np.array_split(np.arange(len(requests)), workers):
+            if len(batch):
+                tasks.append((bulk_file, requests.iloc[batch]))
+    missing = len(read_ids) - len(found)
+    if missing:
+        print("{n} read id(s) were not found in the bulk files".format(n=missing))
+    if not tasks:
+        print("Nothing to plot")
+        return
+
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(plot_batch, bulk_file, batch, out_dir, opts): bulk_file
+            for bulk_file, batch in tasks
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Plotting"):
+            try:
+                total += future.result()
+            except (OSError, KeyError, RuntimeError) as e:
+                print("Could not plot from {f}: {e}".format(f=futures[future], e=e))
+    print("Wrote {n} image(s) to {d}".format(n=total, d=out_dir))
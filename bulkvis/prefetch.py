@@ -0,0 +1,190 @@
+"""prefetch.py
+
+Speculative loading of raw signal. After a window is drawn the viewer asks
+for the windows a user is likely to move to next (the neighbouring windows
+and the next/previous events) to be read into the shared chunk cache by a
+background thread, so the next step is served from memory.
+"""
+import atexit
+from collections import OrderedDict, deque
+import logging
+import os
+import threading
+
+from bulkvis.cache import signal_cache
+from bulkvis.handles import file_pool
+from bulkvis.metrics import record_read
+from bulkvis.raw import clamp_window, signal_dataset
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """A background thread that reads signal windows into a ChunkCache
+
+    Each owner (a viewer session) has its own bounded queue of windows.
+    Scheduling new windows replaces an owner's queue and cancels the window
+    being read for it, so only work for its latest position is done.
+    Parameters
+    ----------
+    cache : bulkvis.cache.ChunkCache
+        Cache to read chunks into
+    max_pending : int
+        Maximum number of queued windows per owner
+    pool : bulkvis.handles.HandlePool
+        Where bulk file handles are borrowed from
+    """
+
+    def __init__(self, cache, max_pending=8, pool=file_pool):
+        self.cache = cache
+        self.max_pending = max_pending
+        self.pool = pool
+        self._queues = OrderedDict()
+        self._generations = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def schedule(self, owner, bulk_path, windows):
+        """Replace the queued windows of an owner
+        Parameters
+        ----------
+        owner : hashable
+            Identifies the session the windows are for
+        bulk_path : str or pathlib.Path
+            Bulk FAST5 file to read
+        windows : list
+            (channel_str, start, end) sample windows, most likely first
+        """
+        if self.cache.max_bytes <= 0:
+            return
+        bulk_path = os.path.realpath(bulk_path)
+        with self._cond:
+            generation = self._generations.get(owner, 0) + 1
+            self._generations[owner] = generation
+            self._queues.pop(owner, None)
+            if not windows:
+                return
+            self._queues[owner] = deque(
+                (generation, bulk_path) + tuple(w) for w in windows[: self.max_pending]
+            )
+            self._start()
+            self._cond.notify()
+
+    def cancel(self, owner):
+        """Drop the queued windows of an owner and stop reading for it"""
+        with self._cond:
+            self._queues.pop(owner, None)
+            self._generations.pop(owner, None)
+
+    def stop(self, timeout=5):
+        """Stop the background thread
+
+        The thread has used HDF5, so it is stopped before the interpreter
+        exits rather than left to be killed as a daemon thread.
+        """
+        with self._cond:
+            self._stopping = True
+            self._queues.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _start(self):
+        if self._stopping:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name="bulkvis-prefetch", daemon=True
+            )
+            self._thread.start()
+
+    def _next_job(self):
+        """Wait for a window, taking owners in turn, None once stopped"""
+        with self._cond:
+            while not self._queues and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            owner, queue = self._queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                self._queues[owner] = queue
+            return owner, job
+
+    def _is_stale(self, owner, generation):
+        with self._cond:
+            return self._generations.get(owner) != generation
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            owner, (generation, bulk_path, channel_str, start, end) = job
+            try:
+                self._fetch(owner, generation, bulk_path, channel_str, start, end)
+            except (OSError, KeyError, ValueError) as e:
+                LOGGER.debug(f"Prefetch of {bulk_path} {channel_str} failed: {e}")
+
+    def _fetch(self, owner, generation, bulk_path, channel_str, start, end):
+        """Read the missing chunks of a window, a chunk at a time
+
+        Windows too large to share the cache with the others queued are
+        skipped, rather than evicting the window being viewed.
+        """
+        with self.pool.borrow(bulk_path) as bulkfile:
+            self._fetch_chunks(owner, generation, bulkfile, channel_str, start, end)
+
+    def _fetch_chunks(self, owner, generation, bulkfile, channel_str, start, end):
+        bulk_path = os.path.realpath(bulkfile.filename)
+        dataset = signal_dataset(bulkfile, channel_str)
+        length = int(dataset.shape[0])
+        start, end = clamp_window(start, end, length)
+        budget = self.cache.max_bytes // (2 * self.max_pending)
+        if (end - start) * dataset.dtype.itemsize > budget:
+            return
+        size = self.cache.chunk_size
+        for index in range(start // size, (end - 1) // size + 1):
+            if self._is_stale(owner, generation):
+                return
+            key = (bulk_path, channel_str, index)
+            chunk_start = index * size
+            chunk_end = chunk_start + size
+            # partial chunks at the end of a channel are never cached
+            if chunk_end > length or key in self.cache:
+                continue
+            self.cache.put(key, dataset[chunk_start:chunk_end])
+            record_read(size, dataset.dtype.itemsize)
+
+
+def neighbour_windows(channel_str, start, end, events=()):
+    """Return the windows a user is likely to move to from (start, end)
+    Parameters
+    ----------
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    start : int
+        First sample of the current window
+    end : int
+        Sample after the last sample of the current window
+    events : iterable
+        Samples of the next/previous events the user can jump to
+    Returns
+    -------
+    list
+        (channel_str, start, end) windows of the same duration: the next and
+        previous windows, then a window at each event
+    """
+    duration = end - start
+    windows = [(channel_str, end, end + duration)]
+    if start > 0:
+        windows.append((channel_str, max(start - duration, 0), start))
+    for event in events:
+        if event is not None:
+            windows.append((channel_str, int(event), int(event) + duration))
+    return windows
+
+
+prefetcher = Prefetcher(signal_cache)
+atexit.register(prefetcher.stop)
@@ -0,0 +1,105 @@
+"""profiling.py
+
+Opt-in profiling of slow viewer callbacks. When BULKVIS_PROFILE_DIR is set,
+by `bulkvis serve --profile-dir` or in the environment, callbacks run under
+cProfile and any call slower than the threshold has its profile written to
+that directory as a .pstats file, named after the callback and the file,
+channel and window size it was working on. When it is not set callbacks are
+left undecorated, so profiling costs nothing.
+"""
+import cProfile
+from functools import wraps
+import logging
+import os
+from pathlib import Path
+import re
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+PROFILE_DIR_ENV = "BULKVIS_PROFILE_DIR"
+PROFILE_THRESHOLD_ENV = "BULKVIS_PROFILE_THRESHOLD"
+# Seconds a call must take for its profile to be kept
+DEFAULT_THRESHOLD = 0.5
+
+# callbacks called from a profiled callback are part of its profile
+_active = threading.local()
+
+
+def profile_dir():
+    """Return the directory profiles are written to, None if profiling is off"""
+    path = os.environ.get(PROFILE_DIR_ENV)
+    return Path(path).expanduser() if path else None
+
+
+def profile_threshold():
+    """Return the threshold, in seconds, from BULKVIS_PROFILE_THRESHOLD"""
+    try:
+        return float(os.environ.get(PROFILE_THRESHOLD_ENV, DEFAULT_THRESHOLD))
+    except ValueError:
+        return DEFAULT_THRESHOLD
+
+
+def _tag(value):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value)).strip("_") or "none"
+
+
+def dump_profile(profile, directory, name, elapsed, tags):
+    """Write a profile to <directory>/<time>-<pid>-<name>-<tags>-<ms>ms.pstats"""
+    now = time.time()
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    stamp += ".{ms:03d}".format(ms=int(now % 1 * 1000))
+    parts = [stamp, "pid={p}".format(p=os.getpid()), name]
+    parts += ["{k}={v}".format(k=k, v=v) for k, v in tags.items()]
+    parts.append("{ms}ms".format(ms=int(elapsed * 1000)))
+    path = Path(directory) / ("-".join(_tag(p) for p in parts) + ".pstats")
+    directory.mkdir(parents=True, exist_ok=True)
+    profile.dump_stats(path)
+    return path
+
+
+def profiled(name, tags=None):
+    """Decorate a callback to keep the profiles of its slow calls
+    Parameters
+    ----------
+    name : str
+        Callback name, used in the file name of its profiles
+    tags : callable or None
+        Returns an ordered dict of values describing what the call worked
+        on, e.g. file, channel and window size, added to the file name
+    """
+
+    def decorator(func):
+        directory = profile_dir()
+        if directory is None:
+            return func
+        threshold = profile_threshold()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_active, "profiling", False):
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            _active.profiling = True
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                _active.profiling = False
+                elapsed = time.perf_counter() - start
+                if elapsed >= threshold:
+                    try:
+                        path = dump_profile(
+                            profile,
+                            directory,
+                            name,
+                            elapsed,
+                            tags() if tags is not None else {},
+                        )
+                        LOGGER.info(f"{name} took {elapsed:.3f}s, profile in {path}")
+                    except (OSError, KeyError, TypeError) as e:
+                        LOGGER.warning(f"Could not write profile of {name}: {e}")
+
+        return wrapper
+
+    return decorator
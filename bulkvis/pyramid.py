@@ -0,0 +1,277 @@
+"""pyramid.py
+
+Build and read multi-resolution (min, max, mean) summaries of the raw signal
+in a bulk FAST5 file. Summaries are stored in a sidecar file next to the bulk
+file so that zoomed out views can be drawn without reading the raw signal.
+"""
+from pathlib import Path
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from bulkvis.raw import clamp_window
+
+SIDECAR_SUFFIX = ".pyramid.h5"
+PYRAMID_VERSION = 1
+
+_help = "Build a min/max signal pyramid sidecar for bulk FAST5 files"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to summarise", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "--min-bin",
+        dict(
+            help="Number of samples in each bin at the finest level, rounded to a power "
+            "of two (default: 64)",
+            type=int,
+            default=64,
+            metavar="",
+        ),
+    ),
+    (
+        "--min-bins",
+        dict(
+            help="Stop adding coarser levels once a channel has fewer bins than this "
+            "(default: 256)",
+            type=int,
+            default=256,
+            metavar="",
+        ),
+    ),
+    (
+        "-f",
+        "--force",
+        dict(
+            help="Rebuild sidecar files that are already up to date",
+            action="store_true",
+        ),
+    ),
+)
+
+
+def sidecar_path(bulk_path):
+    """Return the path of the pyramid sidecar for a bulk FAST5 file"""
+    bulk_path = Path(bulk_path)
+    return bulk_path.with_name(bulk_path.name + SIDECAR_SUFFIX)
+
+
+def _source_stamp(bulk_path):
+    """Return (size, mtime) of a bulk file, used to detect stale sidecar files"""
+    stat = Path(bulk_path).stat()
+    return int(stat.st_size), int(stat.st_mtime)
+
+
+def is_current(bulk_path):
+    """Return True if a bulk file has a sidecar built from its current contents"""
+    path = sidecar_path(bulk_path)
+    if not path.is_file():
+        return False
+    try:
+        with h5py.File(path, "r") as fh:
+            stamp = (int(fh.attrs["source_size"]), int(fh.attrs["source_mtime"]))
+            version = int(fh.attrs["version"])
+    except (OSError, KeyError):
+        return False
+    return version == PYRAMID_VERSION and stamp == _source_stamp(bulk_path)
+
+
+def open_pyramid(bulk_path):
+    """Open the pyramid sidecar for a bulk file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    Returns
+    -------
+    h5py.File or None
+        The open sidecar file, or None if it is missing or out of date
+    """
+    if not is_current(bulk_path):
+        return None
+    return h5py.File(sidecar_path(bulk_path), "r")
+
+
+def _reduce_bins(mins, maxs, sums, counts):
+    """Merge neighbouring pairs of bins into one bin of the next level"""
+    idx = np.arange(0, len(mins), 2)
+    return (
+        np.minimum.reduceat(mins, idx),
+        np.maximum.reduceat(maxs, idx),
+        np.add.reduceat(sums, idx),
+        np.add.reduceat(counts, idx),
+    )
+
+
+def summarise(signal, bin_size, n_levels):
+    """Return (min, max, mean) summaries of a signal at power of two levels
+    Parameters
+    ----------
+    signal : numpy.ndarray
+        Raw signal, the length should be a multiple of the coarsest bin size
+        unless this is the end of the channel
+    bin_size : int
+        Number of samples per bin at the finest level
+    n_levels : int
+        Number of levels to return; each level halves the number of bins
+    Returns
+    -------
+    list
+        One (n_bins, 3) float32 array per level, columns are min, max and mean
+    """
+    idx = np.arange(0, len(signal), bin_size)
+    mins = np.minimum.reduceat(signal, idx)
+    maxs = np.maximum.reduceat(signal, idx)
+    sums = np.add.reduceat(signal, idx, dtype=np.float64)
+    counts = np.diff(np.append(idx, len(signal)))
+    levels = []
+    for level in range(n_levels):
+        if level:
+            mins, maxs, sums, counts = _reduce_bins(mins, maxs, sums, counts)
+        levels.append(
+            np.column_stack((mins, maxs, sums / counts)).astype(np.float32, copy=False)
+        )
+    return levels
+
+
+def _ceil_div(a, b):
+    """Integer division rounding towards positive infinity"""
+    return -(-a // b)
+
+
+def _level_sizes(length, min_bin, min_bins):
+    """Return bin sizes for every level of a channel of a given length"""
+    sizes = [min_bin]
+    while _ceil_div(length, sizes[-1] * 2) >= min_bins:
+        sizes.append(sizes[-1] * 2)
+    return sizes
+
+
+def build_pyramid(bulk_path, min_bin=64, min_bins=256, progress=True):
+    """Write the pyramid sidecar for a bulk FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    min_bin : int
+        Samples per bin at the finest level, rounded up to a power of two
+    min_bins : int
+        Coarser levels are added until a channel has fewer than this many bins
+    progress : bool
+        Show a progress bar per file
+    Returns
+    -------
+    pathlib.Path
+        Path to the sidecar file
+    """
+    min_bin = 1 << max(int(min_bin) - 1, 0).bit_length()
+    out_path = sidecar_path(bulk_path)
+    tmp_path = out_path.with_name(out_path.name + ".tmp")
+    with h5py.File(bulk_path, "r") as bulkfile, h5py.File(tmp_path, "w") as out:
+        channels = list(bulkfile["Raw"])
+        for channel_str in tqdm(
+            channels, desc=Path(bulk_path).name, disable=not progress
+        ):
+            dataset = bulkfile["Raw"][channel_str]["Signal"]
+            length = int(dataset.shape[0])
+            sizes = _level_sizes(length, min_bin, min_bins)
+            # Chunks align with the coarsest bins so no bin spans two chunks
+            step = sizes[-1] * max(1, (1 << 22) // sizes[-1])
+            group = out.create_group(channel_str)
+            group.attrs["length"] = length
+            for size in sizes:
+                group.create_dataset(
+                    str(size),
+                    shape=(0, 3),
+                    maxshape=(None, 3),
+                    dtype=np.float32,
+                    chunks=(min(4096, max(1, _ceil_div(length, size))), 3),
+                )
+            for start in range(0, length, step):
+                signal = dataset[start : start + step]
+                for size, level in zip(sizes, summarise(signal, min_bin, len(sizes))):
+                    ds = group[str(size)]
+                    n = ds.shape[0]
+                    ds.resize(n + len(level), axis=0)
+                    ds[n:] = level
+        out.attrs["version"] = PYRAMID_VERSION
+        out.attrs["min_bin"] = min_bin
+        out.attrs["source"] = Path(bulk_path).name
+        size, mtime = _source_stamp(bulk_path)
+        out.attrs["source_size"] = size
+        out.attrs["source_mtime"] = mtime
+    tmp_path.replace(out_path)
+    return out_path
+
+
+def level_sizes(pyramid, channel_str):
+    """Return the bin sizes stored for a channel, finest first"""
+    return sorted(int(k) for k in pyramid[channel_str].keys())
+
+
+def select_level(sizes, n_samples, plot_width):
+    """Return the coarsest bin size that still gives at least one bin per pixel
+    Parameters
+    ----------
+    sizes : list
+        Available bin sizes, in samples
+    n_samples : int
+        Number of samples in the window
+    plot_width : int
+        Width of the plot in pixels
+    Returns
+    -------
+    int or None
+        The bin size to use, None if the raw signal should be drawn instead
+    """
+    samples_per_px = n_samples / max(int(plot_width), 1)
+    usable = [s for s in sizes if s <= samples_per_px]
+    return max(usable) if usable else None
+
+
+def read_envelope(pyramid, channel_str, start, end, plot_width):
+    """Return the min/max envelope of a sample window from a pyramid
+    Parameters
+    ----------
+    pyramid : h5py.File or None
+        An open pyramid sidecar, see open_pyramid
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    start : int
+        First sample of the window
+    end : int
+        Sample after the last sample of the window
+    plot_width : int
+        Width of the plot in pixels
+    Returns
+    -------
+    tuple or None
+        (x, y) where x is the sample position and y alternates between the
+        bin minimum and maximum, or None if the window is better drawn from
+        the raw signal
+    """
+    if pyramid is None or channel_str not in pyramid:
+        return None
+    start, end = clamp_window(start, end, int(pyramid[channel_str].attrs["length"]))
+    size = select_level(level_sizes(pyramid, channel_str), end - start, plot_width)
+    if size is None:
+        return None
+    first, last = start // size, _ceil_div(end, size)
+    bins = pyramid[channel_str][str(size)][first:last]
+    x = np.repeat(np.arange(first, first + len(bins)) * size + size // 2, 2)
+    return x, bins[:, :2].ravel()
+
+
+def run(parser, args):
+    for bulk_file in args.bulk_files:
+        if not args.force and is_current(bulk_file):
+            print("{f} is up to date".format(f=sidecar_path(bulk_file)))
+            continue
+        try:
+            out = build_pyramid(bulk_file, min_bin=args.min_bin, min_bins=args.min_bins)
+        except (OSError, KeyError) as e:
+            print("Could not summarise {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        print("Pyramid written to {f}".format(f=out))
@@ -0,0 +1,221 @@
+"""raw.py
+
+Windowed access to the raw signal stored in bulk FAST5 files, and its
+calibration to picoamps
+"""
+from collections import namedtuple
+import os
+import threading
+
+import numpy as np
+
+from bulkvis.metrics import record_read
+
+# Meta attributes that calibrate a channel's raw signal
+CALIBRATION_ATTRIBUTES = ["digitisation", "offset", "range"]
+
+
+def signal_dataset(bulkfile, channel_str):
+    """Return the h5py.Dataset holding the raw signal for a channel
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    Returns
+    -------
+    h5py.Dataset
+    """
+    return bulkfile["Raw"][channel_str]["Signal"]
+
+
+def signal_length(bulkfile, channel_str):
+    """Return the number of samples recorded for a channel without reading any signal
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    Returns
+    -------
+    int
+    """
+    return int(signal_dataset(bulkfile, channel_str).shape[0])
+
+
+def refresh_length(bulkfile, channel_str):
+    """Return the number of samples recorded for a channel so far
+
+    If the file is open for SWMR reading the dataset's shape is refreshed
+    first, picking up samples appended since it was last checked.
+    """
+    dataset = signal_dataset(bulkfile, channel_str)
+    if bulkfile.swmr_mode:
+        dataset.refresh()
+    return int(dataset.shape[0])
+
+
+def clamp_window(start, end, length):
+    """Clamp a [start, end) sample window to the bounds of a dataset
+    Parameters
+    ----------
+    start : int or None
+        First sample of the window, None for the start of the dataset
+    end : int or None
+        Sample after the last sample of the window, None for the end of the dataset
+    length : int
+        Number of samples in the dataset
+    Returns
+    -------
+    tuple
+        (start, end) where 0 <= start <= end <= length
+    """
+    start = 0 if start is None else min(max(int(start), 0), length)
+    end = length if end is None else min(max(int(end), start), length)
+    return start, end
+
+
+def read_signal(bulkfile, channel_str, start=None, end=None, cache=None):
+    """Return raw signal for a sample window of a channel
+
+    Only the requested hyperslab is read from disk, the window is clamped to
+    the shape of the dataset so out of range requests return a shorter array.
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    start : int or None
+        First sample to read
+    end : int or None
+        Sample after the last sample to read
+    cache : bulkvis.cache.ChunkCache or None
+        If given, the window is assembled from cached chunks, reading and
+        caching any chunks that are missing
+    Returns
+    -------
+    numpy.ndarray
+    """
+    dataset = signal_dataset(bulkfile, channel_str)
+    length = int(dataset.shape[0])
+    start, end = clamp_window(start, end, length)
+    out = np.empty(end - start, dtype=dataset.dtype)
+    if end <= start:
+        return out
+    if cache is None or cache.max_bytes <= 0:
+        dataset.read_direct(out, np.s_[start:end])
+        record_read(len(out), out.itemsize)
+        return out
+
+    filename = os.path.realpath(bulkfile.filename)
+    size = cache.chunk_size
+    for index in range(start // size, (end - 1) // size + 1):
+        chunk_start = index * size
+        chunk_end = min(chunk_start + size, length)
+        key = (filename, channel_str, index)
+        chunk = cache.get(key)
+        if chunk is None:
+            chunk = np.empty(chunk_end - chunk_start, dtype=dataset.dtype)
+            dataset.read_direct(chunk, np.s_[chunk_start:chunk_end])
+            record_read(len(chunk), chunk.itemsize)
+            # A partial chunk at the end of a channel may still grow
+            if chunk_end - chunk_start == size:
+                cache.put(key, chunk)
+        lo, hi = max(start, chunk_start), min(end, chunk_end)
+        out[lo - start : hi - start] = chunk[lo - chunk_start : hi - chunk_start]
+    return out
+
+
+class Calibration(namedtuple("Calibration", ["offset", "scale"])):
+    """Conversion between raw ADC values and picoamps for one channel
+
+    pA = (raw + offset) * scale, where scale is range / digitisation
+    """
+
+    __slots__ = ()
+
+    def to_pa(self, raw, out=None):
+        """Return raw values in pA, as float32
+
+        The conversion is done in place in one float32 array, it is meant for
+        downsampled windows rather than whole channels.
+        Parameters
+        ----------
+        raw : numpy.ndarray
+            Raw signal, or min/max/mean summaries of it
+        out : numpy.ndarray or None
+            float32 array to write into, may be raw itself
+        Returns
+        -------
+        numpy.ndarray
+        """
+        out = np.add(raw, self.offset, out=out, dtype=np.float32, casting="unsafe")
+        return np.multiply(out, self.scale, out=out)
+
+    def to_raw(self, pa):
+        """Return the raw value of a current in pA"""
+        return pa / self.scale - self.offset
+
+
+def channel_meta(bulkfile, channel_str):
+    """Return the Meta attributes recording a channel's calibration
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    Returns
+    -------
+    h5py.AttributeManager or None
+        None if the file does not record a calibration for the channel
+    """
+    for group in ["Raw", "IntermediateData"]:
+        try:
+            meta = bulkfile[group][channel_str]["Meta"].attrs
+        except KeyError:
+            continue
+        if all(name in meta for name in CALIBRATION_ATTRIBUTES):
+            return meta
+    return None
+
+
+def read_calibration(bulkfile, channel_str):
+    """Return the Calibration of a channel from its Meta attributes
+    Parameters
+    ----------
+    bulkfile : h5py.File
+        An open bulk FAST5 file
+    channel_str : str
+        Channel group name, e.g. 'Channel_391'
+    Returns
+    -------
+    Calibration or None
+        None if the file does not record a calibration for the channel
+    """
+    meta = channel_meta(bulkfile, channel_str)
+    if meta is None:
+        return None
+    digitisation = float(meta["digitisation"])
+    if not digitisation:
+        return None
+    return Calibration(float(meta["offset"]), float(meta["range"]) / digitisation)
+
+
+_calibrations = {}
+_calibrations_lock = threading.Lock()
+
+
+def channel_calibration(bulkfile, channel_str):
+    """Return the Calibration of a channel, read once per process"""
+    key = (os.path.realpath(bulkfile.filename), channel_str)
+    with _calibrations_lock:
+        if key in _calibrations:
+            return _calibrations[key]
+    calibration = read_calibration(bulkfile, channel_str)
+    with _calibrations_lock:
+        _calibrations[key] = calibration
+    return calibration
@@ -1,40 +1,116 @@
+import argparse
+import os
 from pathlib import Path
-import shutil
-import subprocess
-import sys
 
 from bokeh.command.subcommands.serve import Serve
 
+from bulkvis.api import api_patterns
+from bulkvis.export import compression_option
+from bulkvis.metrics import MetricsHandler, create_shared_dir
+from bulkvis.profiling import DEFAULT_THRESHOLD, PROFILE_DIR_ENV, PROFILE_THRESHOLD_ENV
+
 
 _help = "Serve the bulk FAST5 file viewer web app"
 # Patch the incoming bokeh serve arguments
 # Remove `files` and `--args` as these are
-# used in the internal call to bokeh serve
+# set by run for the bulkvis server app
 # prepend `dir` which is the bulk file dir
+# and the options passed on to the app
 _cli = [
     (
         "dir",
         dict(
             help="bulk FAST5 directory (default: working directory)",
+            nargs="?",
             default=None,
             metavar="BULK_DIRECTORY",
         ),
     ),
+    (
+        "--compression",
+        dict(
+            help="Compression of exported read files: none, lzf, gzip or gzip:LEVEL "
+            "(default: gzip:1)",
+            type=compression_option,
+            default="gzip:1",
+            metavar="SPEC",
+        ),
+    ),
+    (
+        "--chunk-size",
+        dict(
+            help="HDF5 chunk size, in samples, of exported read signal "
+            "(default: chosen by h5py)",
+            type=int,
+            default=0,
+            metavar="N",
+        ),
+    ),
+    (
+        "--profile-dir",
+        dict(
+            help="Profile viewer callbacks, writing .pstats files for slow calls "
+            "to this directory (default: ${env} if set, otherwise off)".format(
+                env=PROFILE_DIR_ENV
+            ),
+            default=None,
+            metavar="DIR",
+        ),
+    ),
+    (
+        "--profile-threshold",
+        dict(
+            help="Seconds a callback must take for its profile to be kept "
+            "(default: {t})".format(t=DEFAULT_THRESHOLD),
+            type=float,
+            default=None,
+            metavar="SECONDS",
+        ),
+    ),
 ] + [arg for arg in Serve.args if arg[0] not in {"files", "--args"}]
 
 
-def run(parser, args):
-    bokeh = shutil.which("bokeh")
-    if not bokeh:
-        sys.exit("Unable to find bokeh. Is it installed?")
+class BulkvisServe(Serve):
+    """bokeh serve, with the bulkvis endpoints added to the server"""
 
-    server = str(Path(__file__).parent / "bulkvis_server")
+    def customize_kwargs(self, args, server_kwargs):
+        server_kwargs = super().customize_kwargs(args, server_kwargs)
+        patterns = server_kwargs.setdefault("extra_patterns", [])
+        patterns.append((r"/metrics", MetricsHandler))
+        # args.args starts with the bulk directory, see run
+        patterns.extend(api_patterns(args.args[0]))
+        return server_kwargs
 
-    flags = sys.argv[3:]
 
-    command = [bokeh, "serve", server] + flags + ["--args", args.dir]
+def run(parser, args):
+    """Run the Bokeh server in this process
 
+    With --num-procs the server forks into several worker processes sharing
+    the port. Nothing has opened an HDF5 file or started a thread by now, so
+    forking is safe; each worker then builds its own handles and caches, and
+    shares derived data (the file manifest, annotation indexes and overview
+    and pyramid sidecars) with the others on disk. Server metrics are served
+    at /metrics and bulk files can be read over HTTP under /api/v1, see
+    bulkvis.api. Profiling options are passed to the app, and its workers,
+    in the environment.
+    """
+    server = str(Path(__file__).parent / "bulkvis_server")
+    bulk_dir = args.dir if args.dir is not None else os.getcwd()
+    args.files = [server]
+    args.args = [
+        bulk_dir,
+        "--compression",
+        args.compression,
+        "--chunk-size",
+        str(args.chunk_size),
+    ]
+    if args.profile_dir is not None:
+        os.environ[PROFILE_DIR_ENV] = str(Path(args.profile_dir).resolve())
+    if args.profile_threshold is not None:
+        os.environ[PROFILE_THRESHOLD_ENV] = str(args.profile_threshold)
+    if args.num_procs != 1:
+        create_shared_dir()
     try:
-        subprocess.run(command)
+        BulkvisServe(argparse.ArgumentParser()).invoke(args)
     except KeyboardInterrupt:
         pass
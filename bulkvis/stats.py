@@ -0,0 +1,447 @@
+"""stats.py
+
+Per-channel summaries of a whole bulk FAST5 file: median current, noise
+(MAD and standard deviation), the fraction of time spent in each
+summary_state and the number of saturated samples. They are computed once per
+bulk file by `bulkvis stats` and stored in a sidecar file next to it, which
+the viewer reads to sort and filter channels before opening one.
+
+Each channel's signal is read in fixed size blocks and counted into a
+histogram over the range of its ADC values; median, MAD, standard deviation
+and saturation are then exact, and a worker's memory does not grow with the
+length of a channel.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from bulkvis.annotations import enum_labels
+from bulkvis.handles import open_bulk
+from bulkvis.metrics import record_read
+from bulkvis.raw import channel_meta, read_calibration, signal_dataset
+
+SIDECAR_SUFFIX = ".stats.h5"
+STATS_VERSION = 1
+# Samples read at a time by each worker, rounded up to whole HDF5 chunks
+DEFAULT_BLOCK_SIZE = 1 << 20
+# One row per channel, pA columns are NaN if a channel has no calibration
+STATS_DTYPE = np.dtype(
+    [
+        ("channel", "<u4"),
+        ("samples", "<u8"),
+        ("median", "<f4"),
+        ("mad", "<f4"),
+        ("std", "<f4"),
+        ("min", "<i4"),
+        ("max", "<i4"),
+        ("saturated", "<u8"),
+        ("median_pa", "<f4"),
+        ("mad_pa", "<f4"),
+        ("std_pa", "<f4"),
+    ]
+)
+
+_help = "Compute per-channel signal statistics for bulk FAST5 files"
+_cli = (
+    (
+        "bulk_files",
+        dict(help="bulk FAST5 file(s) to summarise", nargs="+", metavar="BULK_FILE"),
+    ),
+    (
+        "--block-size",
+        dict(
+            help="Samples read at a time by each process (default: {n})".format(
+                n=DEFAULT_BLOCK_SIZE
+            ),
+            type=int,
+            default=DEFAULT_BLOCK_SIZE,
+            metavar="",
+        ),
+    ),
+    (
+        "-t",
+        "--threads",
+        dict(
+            help="Number of processes used to read channels (default: {n})".format(
+                n=os.cpu_count()
+            ),
+            type=int,
+            default=os.cpu_count(),
+            metavar="",
+        ),
+    ),
+    (
+        "-f",
+        "--force",
+        dict(
+            help="Rebuild sidecar files that are already up to date",
+            action="store_true",
+        ),
+    ),
+)
+
+
+def sidecar_path(bulk_path):
+    """Return the path of the stats sidecar for a bulk FAST5 file"""
+    bulk_path = Path(bulk_path)
+    return bulk_path.with_name(bulk_path.name + SIDECAR_SUFFIX)
+
+
+def _source_stamp(bulk_path):
+    """Return (size, mtime) of a bulk file, used to detect stale sidecar files"""
+    stat = Path(bulk_path).stat()
+    return int(stat.st_size), int(stat.st_mtime)
+
+
+def is_current(bulk_path):
+    """Return True if a bulk file has a sidecar built from its current contents"""
+    path = sidecar_path(bulk_path)
+    if not path.is_file():
+        return False
+    try:
+        with h5py.File(path, "r") as fh:
+            stamp = (int(fh.attrs["source_size"]), int(fh.attrs["source_mtime"]))
+            version = int(fh.attrs["version"])
+    except (OSError, KeyError):
+        return False
+    return version == STATS_VERSION and stamp == _source_stamp(bulk_path)
+
+
+class ChannelStats:
+    """Signal statistics of every channel of a bulk file
+    Parameters
+    ----------
+    table : numpy.ndarray
+        One STATS_DTYPE row per channel, ascending channel number
+    fractions : numpy.ndarray
+        (channels, states) float32 fraction of each channel's samples spent
+        in each summary_state
+    labels : OrderedDict
+        summary_state value to name, in the order of the fractions columns
+    """
+
+    def __init__(self, table, fractions, labels):
+        self.table = np.asarray(table, dtype=STATS_DTYPE)
+        self.fractions = np.asarray(fractions, dtype=np.float32).reshape(
+            len(self.table), len(labels)
+        )
+        self.labels = labels
+
+    def to_frame(self):
+        """Return the statistics as a DataFrame, a column per state name"""
+        df = pd.DataFrame(self.table)
+        for i, name in enumerate(self.labels.values()):
+            df[name] = self.fractions[:, i]
+        return df
+
+    @classmethod
+    def from_sidecar(cls, path):
+        """Read statistics from a sidecar file"""
+        with h5py.File(path, "r") as fh:
+            labels = OrderedDict(zip(fh["codes"][()].tolist(), fh["names"].asstr()[()]))
+            return cls(fh["table"][()], fh["fractions"][()], labels)
+
+    def write(self, bulk_path):
+        """Write the statistics to the sidecar of a bulk file
+        Returns
+        -------
+        pathlib.Path
+            Path to the sidecar file
+        """
+        out_path = sidecar_path(bulk_path)
+        tmp_path = out_path.with_name(
+            "{n}.{pid}.tmp".format(n=out_path.name, pid=os.getpid())
+        )
+        with h5py.File(tmp_path, "w") as out:
+            out.create_dataset("table", data=self.table)
+            out.create_dataset("fractions", data=self.fractions, dtype="<f4")
+            out.create_dataset("codes", data=list(self.labels), dtype="u1")
+            out.create_dataset(
+                "names", data=list(self.labels.values()), dtype=h5py.string_dtype()
+            )
+            out.attrs["version"] = STATS_VERSION
+            out.attrs["source"] = Path(bulk_path).name
+            size, mtime = _source_stamp(bulk_path)
+            out.attrs["source_size"] = size
+            out.attrs["source_mtime"] = mtime
+        tmp_path.replace(out_path)
+        return out_path
+
+
+def read_stats(bulk_path):
+    """Return the ChannelStats of a bulk file, None if its sidecar is missing or stale"""
+    if not is_current(bulk_path):
+        return None
+    try:
+        return ChannelStats.from_sidecar(sidecar_path(bulk_path))
+    except (OSError, KeyError):
+        return None
+
+
+def signal_histogram(dataset, block_size=DEFAULT_BLOCK_SIZE):
+    """Count how often each value occurs in a signal dataset, a block at a time
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        8 or 16 bit integer signal
+    block_size : int
+        Samples read at a time, rounded up to whole HDF5 chunks
+    Returns
+    -------
+    tuple
+        (values, counts), every value the dtype can hold, ascending, and the
+        number of samples with that value
+    """
+    dtype = dataset.dtype
+    if dtype.kind not in "iu" or dtype.itemsize > 2:
+        raise TypeError("Expected 8 or 16 bit integer signal, got {d}".format(d=dtype))
+    info = np.iinfo(dtype)
+    unsigned = np.dtype("u{n}".format(n=dtype.itemsize))
+    if dataset.chunks:
+        block_size = math.ceil(block_size / dataset.chunks[0]) * dataset.chunks[0]
+    length = int(dataset.shape[0])
+    block_size = max(min(block_size, length), 1)
+    counts = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+    buffer = np.empty(block_size, dtype=dtype)
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        block = buffer[: end - start]
+        dataset.read_direct(block, np.s_[start:end])
+        record_read(len(block), block.itemsize)
+        counts += np.bincount(block.view(unsigned), minlength=len(counts))
+    # as unsigned, negative values are counted after the positive ones
+    if info.min < 0:
+        counts = np.roll(counts, -int(info.min))
+    return np.arange(int(info.min), int(info.max) + 1), counts
+
+
+def _weighted_median(values, counts):
+    """Return the median of ascending values each repeated counts times"""
+    cum = np.cumsum(counts)
+    n = cum[-1]
+    lower = values[np.searchsorted(cum, (n + 1) // 2)]
+    upper = values[np.searchsorted(cum, n // 2 + 1)]
+    return (lower + upper) / 2
+
+
+def histogram_stats(values, counts, saturation):
+    """Return median, MAD, standard deviation, range and saturation of a histogram
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Ascending signal values
+    counts : numpy.ndarray
+        Number of samples with each value
+    saturation : tuple
+        (low, high), samples at or beyond either are saturated
+    Returns
+    -------
+    dict
+        median, mad, std, min, max and saturated, NaN or 0 if counts is empty
+    """
+    n = int(counts.sum())
+    if n == 0:
+        nan = float("nan")
+        return dict(median=nan, mad=nan, std=nan, min=0, max=0, saturated=0)
+    median = _weighted_median(values, counts)
+    deviations = np.abs(values - median)
+    order = np.argsort(deviations, kind="stable")
+    mad = _weighted_median(deviations[order], counts[order])
+    mean = np.dot(values, counts) / n
+    std = math.sqrt(np.dot((values - mean) ** 2, counts) / n)
+    present = values[counts > 0]
+    low, high = saturation
+    saturated = counts[values <= low].sum() + counts[values >= high].sum()
+    return dict(
+        median=median,
+        mad=mad,
+        std=std,
+        min=present[0],
+        max=present[-1],
+        saturated=saturated,
+    )
+
+
+def saturation_limits(bulkfile, channel_str, dtype):
+    """Return the (low, high) ADC values at which a channel saturates
+
+    The ADC covers digitisation values centred on zero, as in MinKNOW's
+    software saturation limits; without a recorded digitisation the limits
+    of the signal dtype are used.
+    """
+    info = np.iinfo(dtype)
+    meta = channel_meta(bulkfile, channel_str)
+    if meta is None or not float(meta["digitisation"]):
+        return int(info.min), int(info.max)
+    half = int(float(meta["digitisation"])) // 2
+    return max(-half, int(info.min)), min(half - 1, int(info.max))
+
+
+def state_fractions(times, codes, n_samples, states):
+    """Return the fraction of a channel's samples spent in each state
+    Parameters
+    ----------
+    times : numpy.ndarray
+        Sample index of each state change, ascending
+    codes : numpy.ndarray
+        State entered at each change, a state lasts until the next change
+        or the end of the signal
+    n_samples : int
+        Length of the channel's signal
+    states : numpy.ndarray
+        Ascending states to report
+    Returns
+    -------
+    numpy.ndarray
+        Fraction of n_samples in each of states, samples before the first
+        change are in none of them
+    """
+    if len(times) == 0 or n_samples <= 0 or len(states) == 0:
+        return np.zeros(len(states))
+    starts = np.minimum(times, n_samples)
+    ends = np.append(starts[1:], n_samples)
+    index = np.minimum(np.searchsorted(states, codes), len(states) - 1)
+    known = states[index] == codes
+    durations = np.bincount(
+        index[known], weights=(ends - starts)[known], minlength=len(states)
+    )
+    return durations / n_samples
+
+
+def _channel_number(channel_str):
+    return int(channel_str.split("_")[-1])
+
+
+def _channel_stats(bulk_path, channel_strs, states, block_size):
+    """Return the stats rows and state fractions of some channels, run in a worker process"""
+    table = np.zeros(len(channel_strs), dtype=STATS_DTYPE)
+    fractions = np.zeros((len(channel_strs), len(states)), dtype=np.float32)
+    with open_bulk(bulk_path) as bulkfile:
+        for i, channel_str in enumerate(channel_strs):
+            dataset = signal_dataset(bulkfile, channel_str)
+            values, counts = signal_histogram(dataset, block_size)
+            row = histogram_stats(
+                values, counts, saturation_limits(bulkfile, channel_str, dataset.dtype)
+            )
+            row["channel"] = _channel_number(channel_str)
+            row["samples"] = int(dataset.shape[0])
+            calibration = read_calibration(bulkfile, channel_str)
+            if calibration is not None:
+                offset, scale = calibration
+                row["median_pa"] = (row["median"] + offset) * scale
+                row["mad_pa"] = row["mad"] * scale
+                row["std_pa"] = row["std"] * scale
+            else:
+                row.update(median_pa=np.nan, mad_pa=np.nan, std_pa=np.nan)
+            for name, value in row.items():
+                table[name][i] = value
+            try:
+                state_data = bulkfile["StateData"][channel_str]["States"][()]
+            except KeyError:
+                continue
+            order = np.argsort(state_data["acquisition_raw_index"], kind="stable")
+            fractions[i] = state_fractions(
+                state_data["acquisition_raw_index"][order].astype(np.int64),
+                state_data["summary_state"][order],
+                row["samples"],
+                states,
+            )
+    return table, fractions
+
+
+def compute_stats(
+    bulk_path, block_size=DEFAULT_BLOCK_SIZE, workers=None, progress=False
+):
+    """Summarise the signal and StateData of every channel of a bulk FAST5 file
+    Parameters
+    ----------
+    bulk_path : str or pathlib.Path
+        Path to the bulk FAST5 file
+    block_size : int
+        Samples read at a time by each process
+    workers : int or None
+        Number of processes, defaults to the number of CPUs
+    progress : bool
+        Show a progress bar
+    Returns
+    -------
+    ChannelStats
+    """
+    bulk_path = os.path.realpath(bulk_path)
+    with open_bulk(bulk_path) as bulkfile:
+        channels = sorted(bulkfile["Raw"], key=_channel_number)
+        if not channels:
+            raise KeyError("{f} has no Raw signal".format(f=bulk_path))
+        labels = OrderedDict()
+        if "StateData" in bulkfile:
+            for channel_str in bulkfile["StateData"]:
+                labels = enum_labels(
+                    bulkfile["StateData"][channel_str]["States"], "summary_state"
+                )
+                break
+    labels = OrderedDict(sorted(labels.items()))
+    states = np.array(list(labels), dtype=np.int64)
+    workers = workers or os.cpu_count() or 1
+    # a few batches per worker keeps them all busy to the end
+    n_batches = min(len(channels), workers * 4)
+    batches = [list(b) for b in np.array_split(channels, n_batches)]
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        results = list(
+            tqdm(
+                pool.map(
+                    _channel_stats,
+                    [bulk_path] * n_batches,
+                    batches,
+                    [states] * n_batches,
+                    [block_size] * n_batches,
+                ),
+                total=n_batches,
+                desc=Path(bulk_path).name,
+                disable=not progress,
+            )
+        )
+    return ChannelStats(
+        np.concatenate([table for table, _ in results]),
+        np.vstack([fractions for _, fractions in results]),
+        labels,
+    )
+
+
+def build_stats(bulk_path, block_size=DEFAULT_BLOCK_SIZE, workers=None, progress=True):
+    """Write the stats sidecar for a bulk FAST5 file
+    Returns
+    -------
+    pathlib.Path
+        Path to the sidecar file
+    """
+    stats = compute_stats(
+        bulk_path, block_size=block_size, workers=workers, progress=progress
+    )
+    return stats.write(bulk_path)
+
+
+def run(parser, args):
+    if args.block_size < 1:
+        parser.error("--block-size must be at least 1")
+    for bulk_file in args.bulk_files:
+        if not args.force and is_current(bulk_file):
+            print("{f} is up to date".format(f=sidecar_path(bulk_file)))
+            continue
+        try:
+            out = build_stats(
+                bulk_file, block_size=args.block_size, workers=args.threads
+            )
+        except (OSError, KeyError, TypeError) as e:
+            print("Could not summarise {f}: {e}".format(f=bulk_file, e=e))
+            continue
+        print("Channel statistics written to {f}".format(f=out))